@@ -18,19 +18,12 @@
 
 __version__ = '1.1'
 
-# Define max length to use dictionary
-_max_len = 180000000  # In bytes, this is approximately 5 million lines
-# Line length dictionary:
-#   1 million: ~ 35500000
-#   5 million: ~ 180000000
-#  10 million: ~ 366000000
-# 100 million: ~ 3660000000
-#
-# NOTE: All calculations are based on snp files, bed files with gene models
-# containing multiple exons will have different byte sizes. However, such files
-# will tend to be much smaller than the above cutoff anyway, so it should not
-# make much difference.
+# Default memory budget for the dictionary backend, in bytes. Bed files that
+# are estimated to need more than this use sqlite instead, unless a compiled
+# .bidx index exists. Can also be set per file with
+# BedFile(bedfile, memory_budget=...).
+_memory_budget = 1200000000  # About 8 million lines of a snp bed file
 
-from ._bed_lookup import BedFile
+from ._bed_lookup import BedFile, BedCollection, compile_index
 
-__all__ = ["BedFile", "_bed_lookup"]
+__all__ = ["BedFile", "BedCollection", "compile_index", "_bed_lookup"]
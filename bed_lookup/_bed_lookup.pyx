@@ -9,19 +9,118 @@ import os
 import sqlite3
 import gzip
 import bz2
+import time
+import zlib
+import mmap
+import hashlib
+import struct
+import threading
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 from subprocess import check_output as sub
-from collections import defaultdict
+from collections import defaultdict, Counter, deque, OrderedDict
+from collections.abc import Mapping
+from contextlib import contextmanager
 from os.path import getsize
+from urllib.request import pathname2url
+
+import numpy as np
 
 # C++ Library Import
+cimport cython
+from libc.stdint cimport int32_t, int64_t
+from libc.string cimport memchr, memcmp
+from cython.operator cimport dereference as deref
 from libcpp.string cimport string
+from libcpp.vector cimport vector
+from libcpp.utility cimport pair
+from libcpp.unordered_map cimport unordered_map
+from libcpp.algorithm cimport sort
 
-# Get max len from __init__.py
-from . import _max_len
+# Get the default memory budget from __init__.py
+from . import _memory_budget
 
 from . import logme
+from . import cache as _cache
+from . import tabix as _tabix
+from . import instrument as _instrument
 logme.MIN_LEVEL = 'info'
 
+# Bytes of a bed file parsed at a time, and by each worker when parsing in
+# parallel
+_parse_chunk_bytes = 32*1024*1024
+
+# Estimated bytes used by the dict backend per interval, plus the name length
+_dict_line_bytes = 130
+
+# Most runs of lines on one chromosome BedFile(lazy=True) records, files
+# with more are not sorted enough to load by chromosome and are loaded whole
+_lazy_max_runs = 100000
+
+# Bytes to read when estimating the size of a bed file
+_sample_bytes = 2*1024*1024
+
+# Warn about at most this many chromosomes missing from the lookup table
+_max_chrom_warnings = 10
+
+# Backends that can be requested from BedFile
+_backends = ['dict', 'sqlite', 'mmap', 'tabix']
+
+# Name columns lookup_df() can return
+_outputs = ['object', 'category', 'arrow']
+
+# Other names of chromosomes tried by BedFile(chrom_aliases=True), after
+# the name with and without a 'chr' prefix
+_chrom_aliases = {'M': 'MT', 'MT': 'M'}
+
+# BedFile methods timed by BedFile(profile=True), with the argument holding
+# the batch of positions, and the histograms of the sqlite queries
+_timed_methods = [('lookup', None), ('lookup_all', None), ('overlap', None),
+                  ('lookup_many', 1), ('lookup_columns', 1),
+                  ('lookup_df', 0), ('intersect', 1),
+                  ('_lookup_sqlite', None), ('_sqlite_hits', 1)]
+_timed_names   = {'_lookup_sqlite': 'sqlite_query',
+                  '_sqlite_hits': 'sqlite_batch_query'}
+
+# Memory mapped index format, see compile_index()
+_index_ext     = '.bidx'
+_index_magic   = b'BEDLKIDX'
+_index_version = 1
+# magic, version, chromosome count, name count, name offsets, name data
+_index_header  = struct.Struct('<8sIIQQQ')
+# name id, tree root level, interval count, data offset
+_index_chrom   = struct.Struct('<IiQQ')
+
+# Version of the sqlite schema written by _load_sqlite, databases without a
+# meta table are the original (name, start, end) schema, version 1
+_sqlite_schema = 2
+_sqlite_meta   = '_bed_lookup_meta'
+
+# UCSC style hierarchical bins: 128kb bins at the finest level, each level
+# 8 times larger up to a single 512Mb bin. Intervals past 512Mb all go into
+# an overflow bin that is checked by every query.
+_bin_offsets     = [512+64+8+1, 64+8+1, 8+1, 1, 0]
+_bin_first_shift = 17
+_bin_next_shift  = 3
+_bin_max         = 1 << 29
+_bin_overflow    = 4681
+
+# Pragmas used while bulk loading, the settings they replace are restored
+# afterwards
+_sqlite_load_pragmas = ['journal_mode=OFF', 'synchronous=OFF',
+                        'cache_size=-262144', 'temp_store=MEMORY']
+
+# Meta keys describing the bed file a database was built from, and the
+# prefix of the per chromosome content digests
+_sqlite_source = ['source_path', 'source_size', 'source_mtime', 'source_sha1']
+_sqlite_digest = 'chrom:'
+
+# Constants of the rolling hash of bed rows, see _digest_chunk()
+_digest_base = np.uint64(0x100000001b3)
+_digest_mix  = [np.uint64(0x9e3779b97f4a7c15), np.uint64(0xbf58476d1ce4e5b9),
+                np.uint64(0x94d049bb133111eb)]
+
 
 def gopen(infile, mode='r'):
     """ Return file handle of file regardless of zipped or not
@@ -41,14 +140,414 @@ def gopen(infile, mode='r'):
         return open(infile, p2mode)
 
 
-cdef large_file(infile):
-    """ Check if file is greater than _max_len """
-    size = getsize(infile)*3.7 if infile.endswith('.gz') else getsize(infile)
-    return size > _max_len
+def _factorize(values):
+    """Return (codes, uniques) for an array, codes index the uniques.
+
+    Uses pandas.factorize if pandas is installed, as it hashes instead of
+    sorting the values.
+    """
+    if not hasattr(values, 'dtype'):
+        values = np.asarray(values)
+    try:
+        from pandas import factorize
+        codes, uniques = factorize(values, sort=False)
+    except ImportError:
+        uniques, codes = np.unique(values, return_inverse=True)
+    return np.asarray(codes), np.asarray(uniques, dtype=object)
+
+
+def _chrom_codes(chromosomes):
+    """Return (codes, names) for an array of chromosome names.
+
+    pandas Categoricals and Arrow arrays are already encoded, their codes are
+    used as they are, so no string is created per row. Other inputs are
+    factorized.
+    """
+    if hasattr(chromosomes, 'cat'):
+        chromosomes = chromosomes.cat
+    if hasattr(chromosomes, 'categories'):
+        return (np.asarray(chromosomes.codes),
+                np.asarray(chromosomes.categories, dtype=object))
+    if hasattr(chromosomes, 'combine_chunks'):
+        if hasattr(chromosomes, 'unify_dictionaries') and hasattr(
+                chromosomes.type, 'value_type'):
+            chromosomes = chromosomes.unify_dictionaries()
+        chromosomes = chromosomes.combine_chunks()
+    if hasattr(chromosomes, 'dictionary_encode'):
+        if not hasattr(chromosomes, 'indices'):
+            chromosomes = chromosomes.dictionary_encode()
+        return (chromosomes.indices.fill_null(-1).to_numpy(),
+                np.asarray(chromosomes.dictionary.to_pylist(), dtype=object))
+    return _factorize(chromosomes)
+
+
+def _chrom_candidates(chromosome, aliases):
+    """Yield the names a chromosome may have in the bed file, in order.
+
+    Args:
+        chromosome (str): The name looked up
+        aliases (dict):   Names to use for chromosomes, True to try the name
+                          with and without a 'chr' prefix and the other
+                          name of the mitochondrial chromosome
+    """
+    if isinstance(aliases, dict):
+        if chromosome in aliases:
+            yield aliases[chromosome]
+        return
+    chromosome = str(chromosome)
+    bare = (chromosome[3:] if chromosome[:3].lower() == 'chr' else
+            chromosome)
+    for name in (bare, _chrom_aliases.get(bare.upper())):
+        if name:
+            yield name
+            yield 'chr' + name
+
+
+class ChromIds(object):
+
+    """Chromosome names encoded as ids into BedFile.chromosomes.
+
+    Returned by BedFile.encode_chromosomes(), batch lookups take it in place
+    of an array of names and use the ids without resolving any name. codes
+    holds the id of every row, -1 for unknown chromosomes, and categories
+    the names the ids refer to, like a pandas Categorical.
+    """
+
+    def __init__(self, codes, categories):
+        self.codes      = codes
+        self.categories = categories
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __getitem__(self, key):
+        return ChromIds(self.codes[key], self.categories)
+
+
+def _group_by_chrom(codes, names):
+    """Yield (chromosome, indices) for every chromosome present in a batch.
+
+    Args:
+        codes (array): Chromosome codes from _chrom_codes(), -1 for missing
+        names (array): The chromosome name of every code
+    """
+    order  = np.argsort(codes, kind='stable')
+    bounds = np.searchsorted(codes[order], np.arange(len(names) + 1))
+    for i, name in enumerate(names):
+        if bounds[i] < bounds[i+1]:
+            yield name, order[bounds[i]:bounds[i+1]]
+
+
+def _merge_codes(parts):
+    """Combine (codes, names) pairs into codes into one array of names.
+
+    Returns:
+        tuple: (list of int32 code arrays, one per part, object array of the
+               distinct names), codes of -1 are kept
+    """
+    if not parts:
+        return [], np.empty(0, dtype=object)
+    remap, names = _factorize(np.concatenate([i[1] for i in parts]))
+    merged = []
+    offset = 0
+    for codes, part_names in parts:
+        found = codes >= 0
+        out   = np.full(len(codes), -1, dtype=np.int32)
+        out[found] = remap[offset:offset + len(part_names)][codes[found]]
+        merged.append(out)
+        offset += len(part_names)
+    return merged, names
+
+
+def _compact_codes(ids, size):
+    """Renumber an array of ids in [0, size) to the ids present.
+
+    Returns:
+        tuple: (codes, uniq), codes index the sorted array of distinct ids
+    """
+    if len(ids)*8 < size:
+        uniq, codes = np.unique(ids, return_inverse=True)
+        return codes, uniq
+    used = np.zeros(size, dtype=bool)
+    used[ids] = True
+    return (np.cumsum(used) - 1)[ids], np.flatnonzero(used)
+
+
+def _names_array(codes, names):
+    """Return an object array of names[codes], None where codes is -1."""
+    result = np.full(len(codes), None, dtype=object)
+    found  = codes >= 0
+    result[found] = names[codes[found]]
+    return result
+
+
+def _track_name(bedfile):
+    """Name a track after its bed file, without directory or extensions."""
+    name = os.path.basename(bedfile)
+    for ext in ('.gz', '.bz2', '.bed'):
+        if name.endswith(ext) and len(name) > len(ext):
+            name = name[:-len(ext)]
+    return name
+
+
+def _arrow_columns(codes, names, starts, ends, coordinates=False):
+    """Return lookup columns as a pyarrow DictionaryArray, or a Table."""
+    import pyarrow as pa
+    missing = codes < 0
+    name    = pa.DictionaryArray.from_arrays(
+        pa.array(codes, mask=missing), pa.array(names, type=pa.string()))
+    if not coordinates:
+        return name
+    return pa.table({'name': name,
+                     'start': pa.array(starts, mask=missing),
+                     'end': pa.array(ends, mask=missing)})
+
+
+def _table(name):
+    """Return name quoted for use as an sqlite identifier."""
+    return '"{}"'.format(name.replace('"', '""'))
+
+
+cpdef int _bin_from_range(int64_t start, int64_t end):
+    """Return the smallest bin that fully contains [start, end)."""
+    cdef int64_t start_bin, end_bin
+    cdef int level
+    cdef int offsets[5]
+    offsets[:] = [512+64+8+1, 64+8+1, 8+1, 1, 0]
+    if end > _bin_max:
+        return _bin_overflow
+    if end <= start:
+        end = start + 1
+    start_bin = start >> _bin_first_shift
+    end_bin   = (end - 1) >> _bin_first_shift
+    for level in range(5):
+        if start_bin == end_bin:
+            return offsets[level] + start_bin
+        start_bin >>= _bin_next_shift
+        end_bin   >>= _bin_next_shift
+    return _bin_overflow
+
+
+def _bin_array(const int64_t[:] starts, const int64_t[:] ends):
+    """Return the bins of arrays of interval starts and ends."""
+    bins = np.empty(starts.shape[0], dtype=np.int64)
+    cdef int64_t[:] out = bins
+    cdef Py_ssize_t i
+    for i in range(starts.shape[0]):
+        out[i] = _bin_from_range(starts[i], ends[i])
+    return bins
+
+
+def _point_bins(int64_t pos):
+    """Return the six bins that may hold intervals containing pos.
+
+    Always returns six values, padding with the overflow bin, so queries
+    using them have a fixed number of parameters.
+    """
+    cdef int64_t shift = _bin_first_shift
+    if pos >= _bin_max:
+        return [_bin_overflow]*6
+    bins = [_bin_overflow]
+    for offset in _bin_offsets:
+        bins.append(offset + (pos >> shift))
+        shift += _bin_next_shift
+    return bins
+
+
+def _overlapping_bins(int64_t start, int64_t end):
+    """Return a list of all bins that may hold intervals overlapping
+    [start, end)."""
+    cdef int64_t start_bin, end_bin
+    bins = [_bin_overflow]
+    if start >= _bin_max:
+        return bins
+    if end <= start:
+        end = start + 1
+    if end > _bin_max:
+        end = _bin_max
+    start_bin = start >> _bin_first_shift
+    end_bin   = (end - 1) >> _bin_first_shift
+    for offset in _bin_offsets:
+        bins.extend(range(offset + start_bin, offset + end_bin + 1))
+        start_bin >>= _bin_next_shift
+        end_bin   >>= _bin_next_shift
+    return bins
+
+
+def _file_sha1(path, prefix=0):
+    """Return the SHA1 of the contents of a file and of its first bytes.
+
+    Args:
+        path (str):   The file
+        prefix (int): Also digest the first this many bytes
+
+    Returns:
+        tuple: (SHA1 of the file, SHA1 of the prefix or None)
+    """
+    sha1 = hashlib.sha1()
+    head = None
+    with open(path, 'rb') as fin:
+        while prefix:
+            block = fin.read(min(prefix, 1 << 20))
+            if not block:
+                break
+            sha1.update(block)
+            prefix -= len(block)
+        if not prefix:
+            head = sha1.hexdigest()
+        for block in iter(lambda: fin.read(1 << 20), b''):
+            sha1.update(block)
+    return sha1.hexdigest(), head
+
+
+def _ends_line(bedfile, offset):
+    """True if the first offset bytes of bedfile end with a whole line.
+
+    Compressed files are assumed to, as offset is the end of a complete
+    gzip or bzip2 stream.
+    """
+    if bedfile.endswith('.gz') or bedfile.endswith('.bz2') or not offset:
+        return True
+    with open(bedfile, 'rb') as fin:
+        fin.seek(offset - 1)
+        return fin.read(1) == b'\n'
+
+
+def _source_record(bedfile, sha1=None):
+    """Return the meta values identifying the current contents of bedfile."""
+    stat = os.stat(bedfile)
+    return {'source_path': os.path.abspath(bedfile),
+            'source_size': stat.st_size, 'source_mtime': stat.st_mtime_ns,
+            'source_sha1': sha1 or _file_sha1(bedfile)[0]}
+
+
+def _unwritable(error):
+    """True if an sqlite error means the database cannot be written to."""
+    message = str(error).lower()
+    return any(i in message for i in ('readonly', 'read-only', 'locked',
+                                      'unable to open'))
+
+
+def _digest_chunk(digests, names, chunk):
+    """Extend the per chromosome digests with the rows of a parsed chunk.
+
+    Every chromosome has a (row count, hash) pair. The hash is a polynomial
+    rolling hash of the rows in file order, so it does not depend on how
+    the file was split into chunks and rows appended to a chromosome can
+    be added to its hash without rereading the rest.
+
+    Args:
+        digests (dict): {chromosome: (count, hash)}, updated in place
+        names (list):   The names of the chunk, see _parse_chunk()
+        chunk (dict):   {chromosome: (starts, ends, ids)}
+    """
+    name_hashes = np.array([zlib.crc32(i.encode()) for i in names],
+                           dtype=np.uint64)
+    with np.errstate(over='ignore'):
+        for chrom, (starts, ends, ids) in chunk.items():
+            n = len(starts)
+            if not n:
+                continue
+            rows  = (starts.view(np.uint64) * _digest_mix[0] ^
+                     ends.view(np.uint64) * _digest_mix[1] ^
+                     name_hashes[ids])
+            rows ^= rows >> np.uint64(31)
+            rows *= _digest_mix[2]
+            rows ^= rows >> np.uint64(29)
+            powers     = np.empty(n, dtype=np.uint64)
+            powers[0]  = 1
+            powers[1:] = _digest_base
+            count, old = digests.get(chrom, (0, 0))
+            new   = int(np.sum(rows * np.cumprod(powers), dtype=np.uint64))
+            shift = pow(int(_digest_base), count, 1 << 64)
+            digests[chrom] = (count + n, (old + shift * new) % (1 << 64))
+
+
+def _sample_bed(bedfile, sample_bytes=_sample_bytes):
+    """Decompress the start of a bed file to estimate its size.
+
+    The compression ratio is measured on the sample, so this works for gzip
+    and bzip2 files without decompressing all of them.
+
+    Returns:
+        tuple: (estimated number of lines, mean name length)
+    """
+    size = getsize(bedfile)
+    with open(bedfile, 'rb') as raw:
+        chunk = raw.read(sample_bytes)
+    if bedfile.endswith('.gz'):
+        # bgzipped files are many gzip members, decompress all of them
+        data = []
+        rest = chunk
+        while rest:
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            data.append(decompressor.decompress(rest))
+            rest = decompressor.unused_data
+        data = b''.join(data)
+    elif bedfile.endswith('.bz2'):
+        data = bz2.BZ2Decompressor().decompress(chunk)
+    else:
+        data = chunk
+    if not data:
+        return 0, 0
+    lines = data.split(b'\n')
+    if len(chunk) < size or data.endswith(b'\n'):
+        # Drop the partial last line, or the empty string after the last
+        # newline, which is not a line and would bias the estimate low
+        lines.pop()
+    used     = 0
+    count    = 0
+    name_len = 0
+    for line in lines:
+        used += len(line) + 1
+        f = line.split(b'\t', 4)
+        if len(f) < 4:
+            continue
+        count    += 1
+        name_len += len(f[3].rstrip())
+    if not count:
+        return 0, 0
+    # The last line of a whole file may have no newline
+    used  = min(used, len(data))
+    total = size * len(data) / float(len(chunk))
+    return int(count * total / used), name_len / float(count)
+
+
+def _index_current(bedfile, index_file):
+    """True if index_file exists and is not older than bedfile."""
+    return (os.path.exists(index_file) and
+            os.path.getmtime(index_file) >= os.path.getmtime(bedfile))
+
+
+def _choose_backend(bedfile, memory_budget=None):
+    """Pick the fastest backend for a file that fits in memory_budget.
+
+    Returns:
+        tuple: (backend, reason)
+    """
+    if bedfile.endswith(_index_ext):
+        return 'mmap', 'file is a compiled index'
+    if bedfile.endswith('.db'):
+        return 'sqlite', 'file is an sqlite database'
+    index_file = bedfile + _index_ext
+    if _index_current(bedfile, index_file):
+        return 'mmap', 'an up to date index exists at ' + index_file
+    budget = memory_budget if memory_budget else _memory_budget
+    lines, name_len = _sample_bed(bedfile)
+    need = lines * (_dict_line_bytes + name_len)
+    estimate = ('the dict backend needs ~{:.0f}MB for ~{} lines, the ' +
+                'budget is {:.0f}MB').format(need/1e6, lines, budget/1e6)
+    if need <= budget:
+        return 'dict', estimate
+    tabix_index = _tabix.find_index(bedfile)
+    if tabix_index:
+        return 'tabix', estimate + ', and a tabix index exists at ' + \
+            tabix_index
+    return 'sqlite', estimate
 
 
 cdef class Gene(object):
-    cdef long start, end
+    cdef int64_t start, end
     cdef public string name
 
     def __init__(self, values):
@@ -63,26 +562,1447 @@ cdef class Gene(object):
         return "{}({}:{})".format(self.name, self.start, self.end)
 
 
-cdef class Chrom(list):
-    def add(self, aGene):
-        self.append(aGene)
+###############################################################################
+#                         Implicit Interval Tree Core                         #
+###############################################################################
+
+# The interval index is an implicit, augmented binary search tree laid over
+# arrays sorted by start, as described by Heng Li for cgranges. Node i at
+# level k has children i - 2**(k-1) and i + 2**(k-1), and maxends[i] holds the
+# largest end in the subtree rooted at i, so whole subtrees that end before
+# the query can be skipped. Everything here works on raw pointers and without
+# the GIL so that any backend holding sorted arrays can share it.
+
+cdef struct _Tree:
+    const int64_t *starts
+    const int64_t *ends
+    const int64_t *maxends
+    const int64_t *order
+    int64_t n
+    int root_k
+
+
+cdef int _index_prepare(const int64_t *ends, int64_t *maxends,
+                        int64_t n) nogil:
+    """Fill maxends for intervals sorted by start, return the root level."""
+    cdef int64_t i, x, i0, step, el, er, e, last_i = 0, last = 0
+    cdef int k
+    if n <= 0:
+        return -1
+    i = 0
+    while i < n:
+        last_i = i
+        maxends[i] = ends[i]
+        last = ends[i]
+        i += 2
+    k = 1
+    while (<int64_t>1 << k) <= n:
+        x = <int64_t>1 << (k - 1)
+        i0 = (x << 1) - 1
+        step = x << 2
+        i = i0
+        while i < n:
+            el = maxends[i - x]
+            er = maxends[i + x] if i + x < n else last
+            e = ends[i]
+            if el > e:
+                e = el
+            if er > e:
+                e = er
+            maxends[i] = e
+            i += step
+        last_i = last_i - x if (last_i >> k) & 1 else last_i + x
+        if last_i < n and maxends[last_i] > last:
+            last = maxends[last_i]
+        k += 1
+    return k - 1
+
+
+cdef int64_t _overlap(const _Tree *t, int64_t st, int64_t en,
+                      vector[int64_t] *out, int64_t *first) nogil:
+    """Find all intervals overlapping [st, en).
+
+    Indices of hits (in start-sorted order) are appended to out if it is not
+    NULL. If first is not NULL, it is set to the index of the hit that came
+    first in the original file, or -1. Returns the number of hits.
+    """
+    cdef int64_t stk_x[64]
+    cdef int stk_k[64]
+    cdef int stk_w[64]
+    cdef int sp = 0, zk, zw
+    cdef int64_t zx, i, i0, i1, y, hits = 0, best = -1
+    if first != NULL:
+        first[0] = -1
+    if t.n <= 0:
+        return 0
+    stk_k[0] = t.root_k
+    stk_x[0] = (<int64_t>1 << t.root_k) - 1
+    stk_w[0] = 0
+    sp = 1
+    while sp:
+        sp -= 1
+        zk = stk_k[sp]
+        zx = stk_x[sp]
+        zw = stk_w[sp]
+        if zk <= 3:
+            # Small subtree, just scan it
+            i0 = zx >> zk << zk
+            i1 = i0 + (<int64_t>1 << (zk + 1)) - 1
+            if i1 > t.n:
+                i1 = t.n
+            i = i0
+            while i < i1 and t.starts[i] < en:
+                if st < t.ends[i]:
+                    hits += 1
+                    if out != NULL:
+                        out.push_back(i)
+                    if best < 0 or t.order[i] < t.order[best]:
+                        best = i
+                i += 1
+        elif zw == 0:
+            # Revisit this node after its left child
+            y = zx - (<int64_t>1 << (zk - 1))
+            stk_k[sp] = zk
+            stk_x[sp] = zx
+            stk_w[sp] = 1
+            sp += 1
+            if y >= t.n or t.maxends[y] > st:
+                stk_k[sp] = zk - 1
+                stk_x[sp] = y
+                stk_w[sp] = 0
+                sp += 1
+        elif zx < t.n and t.starts[zx] < en:
+            if st < t.ends[zx]:
+                hits += 1
+                if out != NULL:
+                    out.push_back(zx)
+                if best < 0 or t.order[zx] < t.order[best]:
+                    best = zx
+            stk_k[sp] = zk - 1
+            stk_x[sp] = zx + (<int64_t>1 << (zk - 1))
+            stk_w[sp] = 0
+            sp += 1
+    if first != NULL:
+        first[0] = best
+    return hits
+
+
+cdef void _file_order(const _Tree *t, vector[int64_t] *hits) noexcept nogil:
+    """Sort a vector of hit indices into the order they appear in the file."""
+    cdef vector[pair[int64_t, int64_t]] keys
+    cdef size_t i
+    if hits.size() < 2:
+        return
+    keys.reserve(hits.size())
+    for i in range(hits.size()):
+        keys.push_back(pair[int64_t, int64_t](t.order[hits[0][i]],
+                                              hits[0][i]))
+    sort(keys.begin(), keys.end())
+    for i in range(hits.size()):
+        hits[0][i] = keys[i].second
+
+
+cdef _to_array(vector[int64_t] &values):
+    """Copy a vector into a new int64 numpy array."""
+    cdef int64_t n = values.size()
+    if n == 0:
+        return np.empty(0, dtype=np.int64)
+    return np.array(<int64_t[:n]> values.data())
+
+
+cdef class _Index(object):
+    """Base class for the interval index of one chromosome.
+
+    Subclasses own the sorted arrays, point self.tree at them and provide
+    the names of hits through _name() and _take().
+    """
+    cdef _Tree tree
+    cdef bint built
+
+    def build(self):
+        self.built = True
+
+    def _name(self, i):
+        raise NotImplementedError
+
+    def _take(self, hits):
+        raise NotImplementedError
 
     def find(self, loc):
-        cdef long i = int(loc)
-        for gene in self:
-            if gene.find(i):
-                # Handle python 2/3 strings
-                return gene.name.decode()
-        return None
+        cdef int64_t i = int(loc), best
+        if not self.built:
+            self.build()
+        with nogil:
+            _overlap(&self.tree, i, i + 1, NULL, &best)
+        if best < 0:
+            return None
+        return self._name(best)
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def find_hits(self, positions):
+        """Return the index of the first interval containing each position.
+
+        Args:
+            positions (array): Integer positions on this chromosome
+
+        Returns:
+            ndarray: int64 indices into the start sorted intervals, -1 where
+                     there is no hit
+        """
+        cdef const int64_t[:] pos = np.ascontiguousarray(positions,
+                                                         dtype=np.int64)
+        cdef Py_ssize_t i, n = pos.shape[0]
+        hits = np.empty(n, dtype=np.int64)
+        cdef int64_t[:] best = hits
+        if not self.built:
+            self.build()
+        with nogil:
+            for i in range(n):
+                _overlap(&self.tree, pos[i], pos[i] + 1, NULL, &best[i])
+        return hits
+
+    def find_many(self, positions):
+        """Find the first hit for every position in an array.
+
+        Args:
+            positions (array): Integer positions on this chromosome
+
+        Returns:
+            ndarray: An object array of names, None where there is no hit
+        """
+        hits   = self.find_hits(positions)
+        found  = hits >= 0
+        result = np.full(len(hits), None, dtype=object)
+        result[found] = self._take(hits[found])
+        return result
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def find_columns(self, positions):
+        """Find the first hit for every position, as columns.
+
+        Args:
+            positions (array): Integer positions on this chromosome
+
+        Returns:
+            tuple: (codes, names, starts, ends). codes is an int32 array of
+                   indices into the object array names, starts and ends are
+                   int64 arrays of the coordinates of the hit. All three are
+                   -1 where there is no hit.
+        """
+        hits = self.find_hits(positions)
+        cdef const int64_t[:] h = hits
+        cdef Py_ssize_t i, n = h.shape[0]
+        starts = np.full(n, -1, dtype=np.int64)
+        ends   = np.full(n, -1, dtype=np.int64)
+        cdef int64_t[:] s = starts
+        cdef int64_t[:] e = ends
+        with nogil:
+            for i in range(n):
+                if h[i] >= 0:
+                    s[i] = self.tree.starts[h[i]]
+                    e[i] = self.tree.ends[h[i]]
+        found = hits >= 0
+        codes = np.full(n, -1, dtype=np.int32)
+        codes[found], names = self._codes(hits[found])
+        return codes, names, starts, ends
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def find_tracks(self, positions, tracks, int n_tracks):
+        """Find the first hit of every track for every position.
+
+        The intervals of several bed files can share one index, tracks
+        gives the file each interval came from. Each position is searched
+        once, and the hit that came first in its file is kept per file.
+
+        Args:
+            positions (array): Integer positions on this chromosome
+            tracks (array):    The int32 track of every interval, in start
+                               sorted order
+            n_tracks (int):    The number of tracks
+
+        Returns:
+            ndarray: An int64 array of indices into the start sorted
+                     intervals, one row per track and one column per
+                     position, -1 where a track has no hit
+        """
+        cdef const int64_t[:] pos = np.ascontiguousarray(positions,
+                                                         dtype=np.int64)
+        cdef const int32_t[:] track = np.ascontiguousarray(tracks,
+                                                           dtype=np.int32)
+        cdef Py_ssize_t i, n = pos.shape[0]
+        cdef size_t j
+        cdef int64_t h
+        cdef int32_t k
+        cdef vector[int64_t] hits
+        result = np.full((n_tracks, n), -1, dtype=np.int64)
+        cdef int64_t[:, :] best = result
+        if not self.built:
+            self.build()
+        with nogil:
+            for i in range(n):
+                hits.clear()
+                _overlap(&self.tree, pos[i], pos[i] + 1, &hits, NULL)
+                for j in range(hits.size()):
+                    h = hits[j]
+                    k = track[h]
+                    if (best[k, i] < 0 or
+                            self.tree.order[h] < self.tree.order[best[k, i]]):
+                        best[k, i] = h
+        return result
+
+    def _codes(self, hits):
+        """Return (codes, names) for the names of an array of hits."""
+        return _factorize(self._take(hits))
+
+    def find_all(self, loc):
+        """Return the names of all intervals containing loc in file order."""
+        loc = int(loc)
+        return self.overlap(loc, loc + 1)
+
+    def overlap(self, start, end):
+        """Return the names of all intervals overlapping [start, end).
+
+        Names are returned in the order the intervals appear in the file.
+        """
+        cdef vector[int64_t] hits
+        cdef int64_t qstart = int(start), qend = int(end)
+        if not self.built:
+            self.build()
+        with nogil:
+            _overlap(&self.tree, qstart, qend, &hits, NULL)
+            _file_order(&self.tree, &hits)
+        return [self._name(i) for i in hits]
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def intersect(self, starts, ends):
+        """Find every interval overlapping each of an array of ranges.
+
+        Args:
+            starts (array): Query range starts
+            ends (array):   Query range ends, exclusive
+
+        Returns:
+            tuple: Arrays of the index of the query range, the name, start
+                   and end of every hit, hits for each query range are in
+                   file order.
+        """
+        cdef const int64_t[:] qstarts = np.ascontiguousarray(starts,
+                                                             dtype=np.int64)
+        cdef const int64_t[:] qends = np.ascontiguousarray(ends,
+                                                           dtype=np.int64)
+        cdef vector[int64_t] hits, query, found, hit_starts, hit_ends
+        cdef Py_ssize_t i, n = qstarts.shape[0]
+        cdef size_t j
+        if not self.built:
+            self.build()
+        with nogil:
+            for i in range(n):
+                hits.clear()
+                _overlap(&self.tree, qstarts[i], qends[i], &hits, NULL)
+                _file_order(&self.tree, &hits)
+                for j in range(hits.size()):
+                    query.push_back(i)
+                    found.push_back(hits[j])
+                    hit_starts.push_back(self.tree.starts[hits[j]])
+                    hit_ends.push_back(self.tree.ends[hits[j]])
+        found_array = _to_array(found)
+        names = np.empty(len(found_array), dtype=object)
+        if len(found_array):
+            names[:] = self._take(found_array)
+        return (_to_array(query), names, _to_array(hit_starts),
+                _to_array(hit_ends))
+
+    def __len__(self):
+        return self.tree.n
 
     def __repr__(self):
+        if not self.built:
+            self.build()
         astr = []
-        for gene in self:
-            astr += [repr(gene)]
+        for i in range(self.tree.n):
+            astr += ["{}({}:{})".format(self._name(i), self.tree.starts[i],
+                                        self.tree.ends[i])]
         return '; '.join(astr)
 
 
-class BedFile():
+cdef class Chrom(_Index):
+    """All intervals on a single chromosome.
+
+    Intervals are collected with add() and sorted into an interval tree on
+    first lookup (or by calling build()), lookups are then O(log n).
+    """
+    cdef vector[int64_t] starts, ends, maxends, order
+    cdef list names
+    cdef object name_array
+    cdef object name_codes
+
+    def __cinit__(self):
+        self.names = []
+        self.built = False
+
+    def add(self, Gene aGene):
+        self.starts.push_back(aGene.start)
+        self.ends.push_back(aGene.end)
+        self.order.push_back(self.starts.size() - 1)
+        # Handle python 2/3 strings
+        self.names.append(aGene.name.decode())
+        self.built = False
+
+    def extend(self, starts, ends, ids, names):
+        """Add intervals in file order from the output of _parse_chunk()."""
+        cdef const int64_t[:] s = starts
+        cdef const int64_t[:] e = ends
+        cdef const int32_t[:] name_ids = ids
+        cdef Py_ssize_t i, n = s.shape[0]
+        cdef int64_t first = self.starts.size()
+        for i in range(n):
+            self.starts.push_back(s[i])
+            self.ends.push_back(e[i])
+            self.order.push_back(first + i)
+            self.names.append(names[name_ids[i]])
+        self.built = False
+
+    def build(self):
+        """Sort intervals by start and build the max-end augmentation."""
+        cdef int64_t i, n = self.starts.size()
+        cdef vector[pair[int64_t, int64_t]] keys
+        cdef vector[int64_t] starts, ends, order
+        keys.reserve(n)
+        for i in range(n):
+            keys.push_back(pair[int64_t, int64_t](self.starts[i],
+                                                  self.order[i]))
+        sort(keys.begin(), keys.end())
+        starts.reserve(n)
+        ends.reserve(n)
+        order.reserve(n)
+        names = []
+        for i in range(n):
+            starts.push_back(keys[i].first)
+            ends.push_back(self.ends[keys[i].second])
+            order.push_back(keys[i].second)
+            names.append(self.names[keys[i].second])
+        self.starts.swap(starts)
+        self.ends.swap(ends)
+        self.order.swap(order)
+        self.names = names
+        self.name_array = np.empty(n, dtype=object)
+        self.name_array[:] = names
+        self.name_codes = None
+        self.maxends.resize(n)
+        self.tree.starts  = self.starts.data()
+        self.tree.ends    = self.ends.data()
+        self.tree.maxends = self.maxends.data()
+        self.tree.order   = self.order.data()
+        self.tree.n       = n
+        self.tree.root_k  = _index_prepare(self.tree.ends,
+                                           self.maxends.data(), n)
+        self.built = True
+
+    def arrays(self):
+        """Return copies of the sorted index arrays.
+
+        Returns:
+            tuple: starts, ends, maxends and order as int64 arrays, and the
+                   list of names, all in start sorted order.
+        """
+        if not self.built:
+            self.build()
+        cdef int64_t n = self.starts.size()
+        if n == 0:
+            empty = np.empty(0, dtype=np.int64)
+            return empty, empty, empty, empty, []
+        return (np.array(<int64_t[:n]> self.starts.data()),
+                np.array(<int64_t[:n]> self.ends.data()),
+                np.array(<int64_t[:n]> self.maxends.data()),
+                np.array(<int64_t[:n]> self.order.data()),
+                list(self.names))
+
+    def _name(self, i):
+        return self.names[i]
+
+    def _take(self, hits):
+        return self.name_array[hits]
+
+    def _codes(self, hits):
+        # Number the distinct names once, then only renumber ids per batch
+        if self.name_codes is None:
+            self.name_codes = _factorize(self.name_array)
+        ids, pool = self.name_codes
+        codes, uniq = _compact_codes(ids[hits], len(pool))
+        return codes, pool[uniq]
+
+    def __len__(self):
+        return self.starts.size()
+
+    def __reduce__(self):
+        starts, ends, _, order, names = self.arrays()
+        return _rebuild_chrom, (starts, ends, order, names)
+
+
+def _rebuild_chrom(starts, ends, order, names):
+    """Unpickle a Chrom from the arrays returned by Chrom.arrays()."""
+    cdef Chrom chrom = Chrom()
+    cdef Py_ssize_t i
+    for i in np.argsort(order, kind='stable'):
+        chrom.starts.push_back(starts[i])
+        chrom.ends.push_back(ends[i])
+        chrom.order.push_back(order[i])
+        chrom.names.append(names[i])
+    chrom.build()
+    return chrom
+
+
+cdef class MappedChrom(_Index):
+    """The interval index of one chromosome, read from a memory mapped file.
+
+    Holds views straight into the map, so nothing is copied or parsed.
+    """
+    cdef object arrays
+    cdef object name_ids
+    cdef object pool
+
+    def __init__(self, buf, offset, n, root_k, pool):
+        self.pool     = pool
+        self.arrays   = [np.frombuffer(buf, dtype=np.int64, count=n,
+                                       offset=offset + i*8*n)
+                         for i in range(4)]
+        self.name_ids = np.frombuffer(buf, dtype=np.int32, count=n,
+                                      offset=offset + 32*n)
+        self.tree.n      = n
+        self.tree.root_k = root_k
+        if n:
+            self._point(self.arrays[0], self.arrays[1], self.arrays[2],
+                        self.arrays[3])
+        self.built = True
+
+    cdef void _point(self, const int64_t[:] starts, const int64_t[:] ends,
+                     const int64_t[:] maxends, const int64_t[:] order):
+        self.tree.starts  = &starts[0]
+        self.tree.ends    = &ends[0]
+        self.tree.maxends = &maxends[0]
+        self.tree.order   = &order[0]
+
+    def _name(self, i):
+        return self.pool[self.name_ids[i]]
+
+    def _take(self, hits):
+        return self.pool.take(self.name_ids[hits])
+
+    def _codes(self, hits):
+        # Names are already ids into the pool, only decode the ones found
+        codes, uniq = _compact_codes(self.name_ids[hits], len(self.pool))
+        names = np.empty(len(uniq), dtype=object)
+        names[:] = [self.pool[i] for i in uniq]
+        return codes, names
+
+
+class _NamePool(object):
+    """Deduplicated names stored in a memory mapped index.
+
+    Names are decoded on first access and then cached.
+    """
+
+    def __init__(self, buf, offset, blob_offset, count):
+        self._buf     = buf
+        self._offsets = np.frombuffer(buf, dtype=np.uint64, count=count + 1,
+                                      offset=offset)
+        self._blob    = blob_offset
+        self._cache   = {}
+
+    def __getitem__(self, i):
+        try:
+            return self._cache[i]
+        except KeyError:
+            start = self._blob + int(self._offsets[i])
+            end   = self._blob + int(self._offsets[i + 1])
+            name  = self._cache[i] = bytes(self._buf[start:end]).decode()
+            return name
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def take(self, ids):
+        """Return an object array of the names for an array of ids."""
+        uniq, inverse = np.unique(ids, return_inverse=True)
+        names = np.empty(len(uniq), dtype=object)
+        names[:] = [self[i] for i in uniq]
+        return names[inverse]
+
+
+def _load_chroms(bedfile, workers=1, profiler=_instrument.NULL):
+    """Parse a bed file into a dictionary of built Chrom objects."""
+    data     = defaultdict(Chrom)
+    interned = {}
+    for names, chunk in _parse_bed(bedfile, workers, profiler):
+        with profiler.phase('index'):
+            # Share one string object between chunks for each name
+            names = [interned.setdefault(i, i) for i in names]
+            for chrom, (starts, ends, ids) in chunk.items():
+                data[chrom].extend(starts, ends, ids, names)
+    with profiler.phase('index'):
+        for chrom in data.values():
+            chrom.build()
+    return dict(data)
+
+
+###############################################################################
+#                              Parallel Parsing                               #
+###############################################################################
+
+
+def _parse_bed(bedfile, workers=1, profiler=_instrument.NULL):
+    """Yield the parsed chunks of a bed file in file order.
+
+    Plain files are split into byte ranges on line boundaries and bgzipped
+    files into runs of BGZF blocks, the ranges are parsed by a pool of
+    workers processes. Other compressed files cannot be split and are
+    parsed in this process. The time spent reading and decompressing, and
+    parsing, is added to the 'read' and 'parse' phases of profiler.
+
+    Yields:
+        tuple: (names, {chromosome: (starts, ends, ids)}) for every chunk,
+               see _parse_chunk()
+    """
+    workers = workers or os.cpu_count() or 1
+    tasks   = _split_bed(bedfile, workers)
+    if tasks is None:
+        if workers > 1:
+            logme.log(('{} is compressed but not bgzipped, parsing it with ' +
+                       'a single process\n').format(bedfile), level='info')
+        chunks = _stream_chunks(bedfile)
+        while True:
+            with profiler.phase('read'):
+                chunk = next(chunks, None)
+            if chunk is None:
+                return
+            with profiler.phase('parse'):
+                parsed = _parse_chunk(chunk)
+            yield parsed
+    if workers == 1 or len(tasks) == 1:
+        for task in tasks:
+            parsed, read, parse = _parse_task(task)
+            profiler.add_phase('read', read)
+            profiler.add_phase('parse', parse)
+            yield parsed
+        return
+
+    # Keep a bounded number of chunks in flight so that a slow consumer,
+    # like an sqlite load, does not hold the whole file in memory
+    pool    = multiprocessing.Pool(workers)
+    tasks   = iter(tasks)
+    pending = deque(pool.apply_async(_parse_task, (task,))
+                    for task in islice(tasks, 2*workers))
+    try:
+        while pending:
+            parsed, read, parse = pending.popleft().get()
+            profiler.add_phase('read', read)
+            profiler.add_phase('parse', parse)
+            for task in islice(tasks, 1):
+                pending.append(pool.apply_async(_parse_task, (task,)))
+            yield parsed
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def _split_bed(bedfile, workers):
+    """Return a list of tasks for _parse_task, or None if unsplittable."""
+    size = getsize(bedfile)
+    if bedfile.endswith('.bz2'):
+        return None
+    if bedfile.endswith('.gz'):
+        blocks = _bgzf_blocks(bedfile)
+        if not blocks:
+            return None if blocks is None else []
+        # Bed files compress about four fold
+        n     = max(workers, -(-size*4 // _parse_chunk_bytes))
+        first = sorted(set(len(blocks)*i // n for i in range(n)))
+        tasks = []
+        for i, block in enumerate(first):
+            # The block before the range tells if it starts on a line
+            prev = blocks[block - 1] if block else None
+            end  = blocks[first[i + 1]] if i + 1 < len(first) else size
+            tasks.append(('bgzf', bedfile, prev, blocks[block], end))
+        return tasks
+    n      = max(workers, -(-size // _parse_chunk_bytes))
+    bounds = [0]
+    with open(bedfile, 'rb') as fin:
+        for i in range(1, n):
+            fin.seek(size*i // n)
+            fin.readline()
+            if fin.tell() > bounds[-1]:
+                bounds.append(fin.tell())
+    if bounds[-1] < size:
+        bounds.append(size)
+    return [('plain', bedfile, None, bounds[i], bounds[i + 1])
+            for i in range(len(bounds) - 1)]
+
+
+def _bgzf_blocks(bedfile):
+    """Return the offsets of every BGZF block in a file, or None if the file
+    is not bgzipped."""
+    blocks = []
+    offset = 0
+    with open(bedfile, 'rb') as fin:
+        while True:
+            fin.seek(offset)
+            header = fin.read(18)
+            if not header:
+                return blocks
+            size = _bgzf_block_size(header, fin)
+            if size is None:
+                return None
+            blocks.append(offset)
+            offset += size
+
+
+def _bgzf_block_size(header, fin):
+    """Return the total size of the BGZF block starting with header, or
+    None if it is not one. fin must be positioned after the header."""
+    if len(header) < 18 or header[:4] != b'\x1f\x8b\x08\x04':
+        return None
+    xlen  = struct.unpack_from('<H', header, 10)[0]
+    extra = header[12:] + fin.read(max(xlen - 6, 0))
+    i     = 0
+    while i + 4 <= xlen:
+        slen = struct.unpack_from('<H', extra, i + 2)[0]
+        if extra[i:i + 2] == b'BC' and slen == 2:
+            return struct.unpack_from('<H', extra, i + 4)[0] + 1
+        i += 4 + slen
+    return None
+
+
+def _read_bgzf_block(fin):
+    """Read and decompress the BGZF block at the position of fin."""
+    offset = fin.tell()
+    size   = _bgzf_block_size(fin.read(18), fin)
+    if size is None:
+        return b''
+    fin.seek(offset)
+    return gzip.decompress(fin.read(size))
+
+
+def _parse_task(task):
+    """Read one range of a bed file and parse every line starting in it.
+
+    Returns:
+        tuple: The parsed chunk, see _parse_chunk(), and the seconds spent
+               reading and parsing it
+    """
+    start  = time.perf_counter()
+    data   = _read_task(task)
+    middle = time.perf_counter()
+    parsed = _parse_chunk(data)
+    return parsed, middle - start, time.perf_counter() - middle
+
+
+def _read_task(task):
+    """Return the decompressed lines starting in one range of a bed file."""
+    kind, bedfile, prev, start, end = task
+    with open(bedfile, 'rb') as fin:
+        fin.seek(start)
+        data = fin.read(end - start)
+        if kind == 'plain':
+            return data
+        data = gzip.decompress(data)
+        # Drop a line begun in the previous block, it belongs to the range
+        # before this one
+        if prev is not None:
+            fin.seek(prev)
+            if not _read_bgzf_block(fin).endswith(b'\n'):
+                data = data[data.find(b'\n') + 1:] if b'\n' in data else b''
+        # Finish the last line from the blocks after the range
+        fin.seek(end)
+        while data and not data.endswith(b'\n'):
+            block = _read_bgzf_block(fin)
+            if not block:
+                break
+            if b'\n' in block:
+                block = block[:block.index(b'\n') + 1]
+            data += block
+    return data
+
+
+def _stream_chunks(bedfile, offset=0):
+    """Yield blocks of whole lines from a file that cannot be split.
+
+    Args:
+        bedfile (str): The bed file
+        offset (int):  Start reading at this byte of the file, which must be
+                       the start of a line, or of a gzip or bzip2 stream
+    """
+    raw = open(bedfile, 'rb')
+    raw.seek(offset)
+    if bedfile.endswith('.gz'):
+        fin = gzip.GzipFile(fileobj=raw, mode='rb')
+    elif bedfile.endswith('.bz2'):
+        fin = bz2.BZ2File(raw, 'rb')
+    else:
+        fin = raw
+    with raw, fin:
+        rest = b''
+        for block in iter(lambda: fin.read(_parse_chunk_bytes), b''):
+            block = rest + block
+            end   = block.rfind(b'\n') + 1
+            rest  = block[end:]
+            yield block[:end]
+        if rest:
+            yield rest
+
+
+def _parse_chunk(bytes data):
+    """Parse a block of bed lines.
+
+    Coordinates are parsed straight from the bytes and every distinct name
+    is decoded once. Blank lines, lines with fewer than four fields and
+    track, browser and # comment lines are skipped.
+
+    Returns:
+        tuple: (names, {chromosome: (starts, ends, ids)}), names is a list of
+               the distinct names in the chunk, starts and ends are int64
+               arrays and ids int32 arrays of indices into names, all in
+               file order.
+    """
+    cdef const char *p = data
+    cdef const char *end = p + len(data)
+    cdef const char *line_end
+    cdef const char *stop
+    cdef const char *t0
+    cdef const char *t1
+    cdef const char *t2
+    cdef const char *t3
+    cdef int64_t start, stop_pos
+    cdef int chrom = -1
+    cdef int32_t name_id
+    cdef string key, last_chrom
+    cdef unordered_map[string, int] chrom_ids
+    cdef unordered_map[string, int32_t] name_ids
+    cdef unordered_map[string, int32_t].iterator found
+    cdef vector[string] chroms
+    cdef vector[vector[int64_t]] starts, ends
+    cdef vector[vector[int32_t]] ids
+    names = []
+    # Avoid rehashing, names are often unique per line
+    name_ids.reserve(len(data) // 32)
+
+    while p < end:
+        line_end = <const char*> memchr(p, b'\n', end - p)
+        if line_end == NULL:
+            line_end = end
+        stop = line_end
+        while stop > p and _is_space(stop[-1]):
+            stop -= 1
+        t0 = _next_tab(p, stop)
+        t1 = _next_tab(t0 + 1, stop) if t0 else NULL
+        t2 = _next_tab(t1 + 1, stop) if t1 else NULL
+        if t2 == NULL or _is_header(p, stop):
+            p = line_end + 1
+            continue
+        t3 = _next_tab(t2 + 1, stop)
+        if t3 == NULL:
+            t3 = stop
+        if (not _parse_int(t0 + 1, t1, &start) or
+                not _parse_int(t1 + 1, t2, &stop_pos)):
+            raise ValueError('Invalid coordinates in bed line: ' +
+                             p[:stop - p].decode('utf-8', 'replace'))
+
+        # Chromosomes come in runs, only look them up when they change
+        if chrom < 0 or last_chrom.compare(0, last_chrom.size(), p,
+                                           t0 - p) != 0:
+            last_chrom.assign(p, t0 - p)
+            if chrom_ids.count(last_chrom):
+                chrom = chrom_ids[last_chrom]
+            else:
+                chrom = chroms.size()
+                chrom_ids[last_chrom] = chrom
+                chroms.push_back(last_chrom)
+                starts.push_back(vector[int64_t]())
+                ends.push_back(vector[int64_t]())
+                ids.push_back(vector[int32_t]())
+
+        key.assign(t2 + 1, t3 - t2 - 1)
+        found = name_ids.find(key)
+        if found == name_ids.end():
+            name_id = len(names)
+            name_ids[key] = name_id
+            names.append((t2 + 1)[:t3 - t2 - 1].decode('utf-8'))
+        else:
+            name_id = deref(found).second
+
+        starts[chrom].push_back(start)
+        ends[chrom].push_back(stop_pos)
+        ids[chrom].push_back(name_id)
+        p = line_end + 1
+
+    return names, {chroms[i].decode(): (_to_array(starts[i]),
+                                        _to_array(ends[i]),
+                                        _to_id_array(ids[i]))
+                   for i in range(chroms.size())}
+
+
+def _scan_chroms(bytes data, int64_t offset, list runs):
+    """Record where the runs of lines on each chromosome are in a block.
+
+    Only the first field of each line is read, so this is much faster than
+    parsing. Lines that _parse_chunk() skips are not counted and do not
+    start a run.
+
+    Args:
+        data (bytes):  A block of whole lines
+        offset (int):  The position of data in the file
+        runs (list):   [chromosome, start offset, lines] for every run so
+                       far, extended in place. A run continuing from the
+                       previous block is extended instead of restarted.
+    """
+    cdef const char *base = data
+    cdef const char *p = base
+    cdef const char *end = p + len(data)
+    cdef const char *line_end
+    cdef const char *stop
+    cdef const char *t0
+    cdef const char *t1
+    cdef const char *t2
+    cdef string last
+    cdef int64_t count = 0
+    cdef bint in_run = False
+    if runs:
+        last   = runs[-1][0].encode()
+        count  = runs[-1][2]
+        in_run = True
+    while p < end:
+        line_end = <const char*> memchr(p, b'\n', end - p)
+        if line_end == NULL:
+            line_end = end
+        stop = line_end
+        while stop > p and _is_space(stop[-1]):
+            stop -= 1
+        t0 = _next_tab(p, stop)
+        t1 = _next_tab(t0 + 1, stop) if t0 else NULL
+        t2 = _next_tab(t1 + 1, stop) if t1 else NULL
+        if t2 == NULL or _is_header(p, stop):
+            p = line_end + 1
+            continue
+        if not in_run or last.compare(0, last.size(), p, t0 - p) != 0:
+            if in_run:
+                runs[-1][2] = count
+            last.assign(p, t0 - p)
+            runs.append([last.decode(), offset + (p - base), 0])
+            count  = 0
+            in_run = True
+        count += 1
+        p = line_end + 1
+    if in_run:
+        runs[-1][2] = count
+
+
+cdef inline bint _is_space(char c):
+    """True for the bytes that bytes.strip() removes."""
+    return c == b' ' or b'\t' <= c <= b'\r'
+
+
+cdef inline const char *_next_tab(const char *p, const char *stop):
+    """Return a pointer to the next tab before stop, or NULL."""
+    return <const char*> memchr(p, b'\t', stop - p)
+
+
+cdef bint _is_header(const char *p, const char *stop):
+    """True if a line is a track, browser or # comment line."""
+    cdef Py_ssize_t n = stop - p
+    if n and p[0] == b'#':
+        return True
+    return _starts_word(p, n, b'track', 5) or _starts_word(p, n, b'browser', 7)
+
+
+cdef inline bint _starts_word(const char *p, Py_ssize_t n, const char *word,
+                              Py_ssize_t size):
+    """True if the n bytes at p are word, or word and then whitespace."""
+    return (n >= size and memcmp(p, word, size) == 0 and
+            (n == size or _is_space(p[size])))
+
+
+cdef bint _parse_int(const char *p, const char *stop, int64_t *value):
+    """Parse a decimal integer surrounded by optional spaces, like int().
+
+    Returns:
+        bool: False if the field is not a valid integer
+    """
+    cdef int64_t result = 0
+    cdef bint negative = False
+    while p < stop and _is_space(p[0]):
+        p += 1
+    while stop > p and _is_space(stop[-1]):
+        stop -= 1
+    if p < stop and (p[0] == b'-' or p[0] == b'+'):
+        negative = p[0] == b'-'
+        p += 1
+    if p == stop:
+        return False
+    while p < stop:
+        if p[0] < b'0' or p[0] > b'9':
+            return False
+        result = result*10 + (p[0] - 48)
+        p += 1
+    value[0] = -result if negative else result
+    return True
+
+
+cdef _to_id_array(vector[int32_t] &values):
+    """Copy a vector into a new int32 numpy array."""
+    cdef int64_t n = values.size()
+    if n == 0:
+        return np.empty(0, dtype=np.int32)
+    return np.array(<int32_t[:n]> values.data())
+
+
+def compile_index(bedfile, index_file=None, workers=1):
+    """Compile a bed file into a binary index that BedFile can memory map.
+
+    The index holds, for every chromosome, the sorted start, end, max-end
+    and file order arrays of the interval tree and an array of ids into a
+    single deduplicated pool of names. Opening it is near instant and the
+    pages are shared between all processes using it.
+
+    Args:
+        bedfile (str):    The bed file to compile, may be gzipped
+        index_file (str): Where to write the index, default bedfile.bidx
+        workers (int):    Processes to parse the bed file with, None for
+                          one per CPU
+
+    Returns:
+        str: The path to the index
+    """
+    if not index_file:
+        index_file = bedfile + _index_ext
+    return _write_index(_load_chroms(bedfile, workers), index_file)
+
+
+def _write_index(data, index_file):
+    """Write a dictionary of Chrom objects to a binary index file."""
+    pool  = {}
+    names = []
+
+    def name_id(name):
+        try:
+            return pool[name]
+        except KeyError:
+            pool[name] = len(names)
+            names.append(name)
+            return pool[name]
+
+    chroms = sorted(data)
+    for chrom in chroms:
+        name_id(chrom)
+
+    tmp_file = index_file + '.tmp'
+    with open(tmp_file, 'wb') as fout:
+        fout.write(b'\0' * (_index_header.size +
+                            _index_chrom.size * len(chroms)))
+        _pad(fout)
+        records = []
+        for chrom in chroms:
+            starts, ends, maxends, order, chrom_names = data[chrom].arrays()
+            ids = np.array([name_id(i) for i in chrom_names], dtype=np.int32)
+            records.append(_index_chrom.pack(
+                pool[chrom], _tree_root(len(starts)), len(starts),
+                fout.tell()))
+            for array in (starts, ends, maxends, order, ids):
+                fout.write(array.tobytes())
+            _pad(fout)
+        encoded = [i.encode() for i in names]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.uint64)
+        offsets[1:] = np.cumsum([len(i) for i in encoded])
+        names_offset = fout.tell()
+        fout.write(offsets.tobytes())
+        blob_offset = fout.tell()
+        fout.write(b''.join(encoded))
+        fout.seek(0)
+        fout.write(_index_header.pack(_index_magic, _index_version,
+                                      len(chroms), len(names),
+                                      names_offset, blob_offset))
+        fout.write(b''.join(records))
+    os.rename(tmp_file, index_file)
+    return index_file
+
+
+def _pad(fout):
+    """Pad an open file with zeros to the next 8 byte boundary."""
+    fout.write(b'\0' * (-fout.tell() % 8))
+
+
+def _tree_root(n):
+    """Return the level of the root of an implicit tree of n nodes."""
+    cdef int k = 0
+    if n <= 0:
+        return -1
+    while (<int64_t>1 << (k + 1)) <= n:
+        k += 1
+    return k
+
+
+class _LookupCache(object):
+    """The results of recent BedFile.lookup() calls.
+
+    A bounded map of (chromosome, position) to gene name, evicting the least
+    recently used entry when full. Safe to share between threads, copies
+    made by pickling start empty.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._cache   = OrderedDict()
+        self._lock    = threading.Lock()
+        self.hits     = 0
+        self.misses   = 0
+
+    def get(self, key):
+        """Return (True, name) if key is cached, else (False, None)."""
+        with self._lock:
+            try:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return True, self._cache[key]
+            except KeyError:
+                self.misses += 1
+                return False, None
+
+    def put(self, key, name):
+        """Cache the name for key, evicting the oldest entry if full."""
+        with self._lock:
+            self._cache[key] = name
+            if len(self._cache) > self.max_size:
+                self._cache.popitem(last=False)
+
+    def stats(self):
+        """Return the hit and miss counts and the size of the cache."""
+        return {'hits': self.hits, 'misses': self.misses,
+                'size': len(self._cache), 'max_size': self.max_size}
+
+    def __reduce__(self):
+        return _LookupCache, (self.max_size,)
+
+
+class _LazyChroms(Mapping):
+    """A dictionary of Chrom objects that reads each chromosome of a bed
+    file the first time it is used.
+
+    Chromosomes are read from byte ranges of a plain bed file recorded by
+    _scan_bed(), or through the tabix index of a bgzipped one. If the
+    estimated memory of the chromosomes in memory passes max_bytes, the
+    least recently used are dropped and read again when next needed. Safe to
+    share between threads, copies made by pickling start empty.
+    """
+
+    def __init__(self, bedfile, blocks=None, max_bytes=None,
+                 profiler=_instrument.NULL):
+        """Set up lazy loading, nothing is read until a chromosome is used.
+
+        Args:
+            bedfile (str):    A plain bed file, or a bgzipped one with a
+                              tabix or CSI index
+            blocks (dict):    (start, end) byte ranges of every chromosome
+                              of a plain file, see _scan_bed(). None to use
+                              the tabix index.
+            max_bytes (int):  Estimated bytes of chromosomes to keep
+            profiler:         Adds the time spent reading chromosomes to its
+                              'lazy_load' phase
+        """
+        self.bedfile      = bedfile
+        self.max_bytes    = max_bytes
+        self.loads        = 0
+        self.evictions    = 0
+        self._blocks      = blocks
+        self._tabix       = None
+        self._profiler    = profiler
+        self._loaded      = OrderedDict()
+        self._sizes       = {}
+        self._lock        = threading.Lock()
+        if blocks is None:
+            self._tabix  = _tabix.TabixFile(bedfile)
+            self._chroms = self._tabix.chromosomes
+        else:
+            self._chroms = list(blocks)
+        self._known = set(self._chroms)
+
+    def __getitem__(self, chromosome):
+        chrom = self._loaded.get(chromosome)
+        if chrom is not None:
+            try:
+                self._loaded.move_to_end(chromosome)
+            except KeyError:
+                pass  # Evicted by another thread meanwhile
+            return chrom
+        if chromosome not in self._known:
+            raise KeyError(chromosome)
+        with self._lock:
+            # Another thread may have read it while we waited
+            chrom = self._loaded.get(chromosome)
+            if chrom is None:
+                chrom = self._read(chromosome)
+                self._loaded[chromosome] = chrom
+                self._sizes[chromosome]  = len(chrom)*_dict_line_bytes
+                self.loads += 1
+                self._evict()
+        return chrom
+
+    def __contains__(self, chromosome):
+        return chromosome in self._known
+
+    def __iter__(self):
+        return iter(self._chroms)
+
+    def __len__(self):
+        return len(self._chroms)
+
+    def stats(self):
+        """Return the chromosomes in memory and their estimated bytes, and
+        the number of loads and evictions."""
+        with self._lock:
+            return {'loaded': list(self._loaded),
+                    'loaded_bytes': sum(self._sizes.values()),
+                    'max_bytes': self.max_bytes, 'loads': self.loads,
+                    'evictions': self.evictions}
+
+    def _read(self, chromosome):
+        """Parse one chromosome into a built Chrom."""
+        start = time.time()
+        chrom = Chrom()
+        with self._profiler.phase('lazy_load'):
+            if self._tabix is not None:
+                records = list(self._tabix.fetch(chromosome, 0, 1 << 62))
+                if records:
+                    starts, ends, names = zip(*records)
+                    ids, names = _factorize(np.array(names, dtype=object))
+                    chrom.extend(np.array(starts, dtype=np.int64),
+                                 np.array(ends, dtype=np.int64),
+                                 ids.astype(np.int32), list(names))
+            else:
+                with open(self.bedfile, 'rb') as fin:
+                    for offset, end in self._blocks[chromosome]:
+                        fin.seek(offset)
+                        names, chunk = _parse_chunk(fin.read(end - offset))
+                        if chromosome in chunk:
+                            chrom.extend(*chunk[chromosome], names)
+            chrom.build()
+        logme.log('Loaded {} intervals on {} in {:.2f}s\n'.format(
+            len(chrom), chromosome, time.time() - start), level='debug')
+        return chrom
+
+    def _evict(self):
+        """Drop the least recently used chromosomes over max_bytes, always
+        keeping the one just read."""
+        if not self.max_bytes:
+            return
+        while (len(self._loaded) > 1 and
+               sum(self._sizes.values()) > self.max_bytes):
+            chromosome, _ = self._loaded.popitem(last=False)
+            del self._sizes[chromosome]
+            self.evictions += 1
+            logme.log('Dropped {} from memory\n'.format(chromosome),
+                      level='debug')
+
+    def __reduce__(self):
+        return _LazyChroms, (self.bedfile, self._blocks, self.max_bytes)
+
+
+def _scan_bed(bedfile):
+    """Find the byte ranges of every chromosome of a plain bed file.
+
+    Returns:
+        tuple: ({chromosome: [(start, end), ...]}, lines), or None if the
+               chromosomes of the file change more than _lazy_max_runs
+               times
+    """
+    runs   = []
+    offset = 0
+    for block in _stream_chunks(bedfile):
+        _scan_chroms(block, offset, runs)
+        offset += len(block)
+        if len(runs) > _lazy_max_runs:
+            return None
+    blocks = OrderedDict()
+    for i, (chrom, start, _) in enumerate(runs):
+        end = runs[i + 1][1] if i + 1 < len(runs) else offset
+        blocks.setdefault(chrom, []).append((start, end))
+    return blocks, sum(i[2] for i in runs)
+
+
+class _Chromosomes(object):
+
+    """Chromosome numbering and name resolution shared by BedFile and
+    BedCollection.
+
+    Subclasses call _index_chromosomes() once loaded, and set _aliases,
+    _unknown_chroms, _stats_lock and _threads, None until a batch lookup
+    first needs threads.
+    """
+
+    def chrom_id(self, chromosome):
+        """Return the id of a chromosome in self.chromosomes, -1 if it is
+        not in the bed file.
+
+        With chrom_aliases, names that are not in the bed file are resolved
+        through the aliases the first time they are seen, later calls are a
+        single dictionary lookup.
+        """
+        try:
+            return self._chrom_ids[chromosome]
+        except KeyError:
+            pass
+        try:
+            return self._resolved[chromosome]
+        except KeyError:
+            pass
+        found = -1
+        if self._aliases:
+            for name in _chrom_candidates(chromosome, self._aliases):
+                if name in self._chrom_ids:
+                    found = self._chrom_ids[name]
+                    logme.log("Looking up chromosome '{}' as '{}'\n".format(
+                        chromosome, name), level='debug')
+                    break
+        self._resolved[chromosome] = found
+        return found
+
+    def encode_chromosomes(self, chromosomes):
+        """Encode chromosome names as ids into self.chromosomes.
+
+        Batch lookups resolve the names of every batch again. Encoding a
+        column once and passing the result to lookup_many(),
+        lookup_columns() or intersect() instead skips that step.
+
+        Args:
+            chromosomes (array): Chromosome names, any input lookup_many()
+                                 takes
+
+        Returns:
+            ChromIds: The int32 id of every name in codes, -1 where the
+                      chromosome is not in the bed file
+        """
+        return ChromIds(self._encode(chromosomes, count=False),
+                        self._chrom_names)
+
+    def _index_chromosomes(self, names):
+        """Number the chromosomes of the bed file.
+
+        self.chromosomes lists them in sorted order, so every backend gives
+        a bed file the same ids, see chrom_id().
+        """
+        self.chromosomes  = sorted(names)
+        self._chrom_names = np.array(self.chromosomes, dtype=object)
+        self._chrom_ids   = {name: i for i, name in
+                             enumerate(self.chromosomes)}
+        self._resolved    = {}
+
+    def _encode(self, chromosomes, count=True):
+        """Return an int32 array of chromosome ids for a batch.
+
+        Every distinct name is resolved once with chrom_id(). If count,
+        lookups on chromosomes that are not in the bed file are counted in
+        stats().
+        """
+        codes, names = _chrom_codes(chromosomes)
+        if names is self._chrom_names:
+            return codes
+        # The extra -1 maps missing names, code -1, to id -1
+        ids     = np.array([self.chrom_id(i) for i in names] + [-1],
+                           dtype=np.int32)
+        unknown = np.flatnonzero(ids[:-1] < 0)
+        if count and len(unknown):
+            rows = np.bincount(codes[codes >= 0], minlength=len(names))
+            for i in unknown:
+                if rows[i]:
+                    self._miss_chromosome(names[i], rows[i])
+        return ids[codes]
+
+    def _alias(self, chromosome):
+        """Return the bed file's name for a chromosome that is not in it
+        under this name, None if there is none."""
+        if not self._aliases:
+            return None
+        i = self.chrom_id(chromosome)
+        return self.chromosomes[i] if i >= 0 else None
+
+    def _run_batch(self, func, chromosomes, locations, n_threads=1):
+        """Run func(codes, chroms, locations) over a batch of lookups.
+
+        codes are chromosome ids into chroms, self._chrom_names. Lookups on
+        chromosomes that are not in the bed file are counted here and have
+        code -1, so func only sees chromosomes that are.
+
+        Returns:
+            list: The results of func for contiguous slices of the batch,
+                  one per thread
+        """
+        codes     = self._encode(chromosomes)
+        chroms    = self._chrom_names
+        locations = np.asarray(locations, dtype=np.int64)
+        if codes.shape != locations.shape:
+            raise ValueError('chromosomes and locations must be the same ' +
+                             'length')
+        if n_threads > 1 and len(locations) > n_threads:
+            bounds = np.linspace(0, len(locations), n_threads + 1).astype(int)
+            # Submitted under the lock, so a call asking for more threads
+            # cannot shut the executor down in between
+            with self._stats_lock:
+                futures = [self._executor(n_threads).submit(
+                    func, codes[i:j], chroms, locations[i:j])
+                           for i, j in zip(bounds[:-1], bounds[1:])]
+            return [i.result() for i in futures]
+        return [func(codes, chroms, locations)]
+
+    def _executor(self, n_threads):
+        """Return the executor batch lookups run on, with self._stats_lock
+        held.
+
+        It is created on first use and kept, so its threads, and their
+        sqlite connections, are reused by later batches. It is only
+        replaced by a larger one when more threads are asked for.
+        """
+        if self._threads is None or self._threads._max_workers < n_threads:
+            if self._threads is not None:
+                self._threads.shutdown(wait=False)
+            self._threads = ThreadPoolExecutor(n_threads)
+        return self._threads
+
+    def close(self):
+        """Stop the threads of batch lookups.
+
+        They are started again by the next batch lookup that asks for
+        them.
+        """
+        with self._stats_lock:
+            threads, self._threads = self._threads, None
+        if threads is not None:
+            threads.shutdown()
+
+    def __del__(self):
+        # Nothing can be waiting on the threads any more, and a partly
+        # initialised object has none
+        threads = getattr(self, '_threads', None)
+        if threads is not None:
+            threads.shutdown(wait=False)
+
+    def _miss_chromosome(self, chromosome, count=1):
+        """Count lookups on a missing chromosome, warning the first time."""
+        with self._stats_lock:
+            if chromosome not in self._unknown_chroms:
+                if len(self._unknown_chroms) < _max_chrom_warnings:
+                    logme.log(("Chromosome '{}' is not in the lookup " +
+                               "table, lookups on it will fail. Failures " +
+                               "are counted in stats().\n").format(
+                                   chromosome), level='warn')
+                elif len(self._unknown_chroms) == _max_chrom_warnings:
+                    logme.log(('More than {} chromosomes are not in the ' +
+                               'lookup table, no longer warning.\n').format(
+                                   _max_chrom_warnings), level='warn')
+            self._unknown_chroms[chromosome] += int(count)
+
+
+class BedFile(_Chromosomes):
     """ An object to hold data from a bed file and allow lookup by coordinate.
         To use, create a bedfile object with your bedfile:
             b = BedFile(bedfile)
@@ -91,23 +2011,253 @@ class BedFile():
 
     def lookup(self, chromosome, location):
         """ Lookup your gene. Returns the gene name """
+        if self._memo is None:
+            return self._lookup(chromosome, location)
+        key = (chromosome, int(location))
+        found, name = self._memo.get(key)
+        if not found:
+            name = self._lookup(chromosome, location)
+            self._memo.put(key, name)
+        elif name is None:
+            # Count the failure again, as an uncached lookup would
+            if self.chrom_id(chromosome) >= 0:
+                self._miss_location(chromosome, key[1])
+            else:
+                self._miss_chromosome(chromosome)
+        return name
+
+    def _lookup(self, chromosome, location):
+        """Lookup a gene without the lookup cache."""
         if self._type == 'sq':
             return self._lookup_sqlite(chromosome, str(location))
-        elif self._type == 'dt':
+        else:
             return self._lookup_dict(chromosome, location)
 
-    def lookup_df(self, df, chrom_col, pos_col):
+    def lookup_all(self, chromosome, location):
+        """ Lookup every gene containing a location. Returns a list of
+            names in file order, empty if there are none """
+        location = int(location)
+        return self.overlap(chromosome, location, location + 1)
+
+    def overlap(self, chromosome, start, end):
+        """Find all genes overlapping a range.
+
+        Args:
+            chromosome (str): The chromosome name
+            start (int):      The start of the range
+            end (int):        The end of the range, exclusive, as in bed
+
+        Returns:
+            list: Names of overlapping genes in file order, empty if none.
+        """
+        start = int(start)
+        end   = int(end)
+        if end <= start:
+            raise ValueError('end must be greater than start')
+        if self._type == 'sq':
+            return [i[0] for i in self._overlap_sqlite(chromosome, start, end)]
+        if chromosome not in self._data:
+            alias = self._alias(chromosome)
+            if alias is None:
+                self._miss_chromosome(chromosome)
+                return []
+            chromosome = alias
+        return self._data[chromosome].overlap(start, end)
+
+    def intersect(self, chromosomes, starts, ends):
+        """Intersect many ranges with the bed file, like bedtools intersect.
+
+        Args:
+            chromosomes (array): Chromosome names
+            starts (array):      Range starts
+            ends (array):        Range ends, exclusive
+
+        Returns:
+            tuple: Four arrays with one entry per overlapping pair: the index
+                   of the query range in the input, and the name, start and
+                   end of the bed interval. Pairs are sorted by query index,
+                   then by the order of the intervals in the bed file.
+                   Ranges with no overlap are not included.
+        """
+        codes  = self._encode(chromosomes, count=False)
+        starts = np.asarray(starts, dtype=np.int64)
+        ends   = np.asarray(ends, dtype=np.int64)
+        if not codes.shape == starts.shape == ends.shape:
+            raise ValueError('chromosomes, starts and ends must be the ' +
+                             'same length')
+        parts = []
+        for chrom, indices in _group_by_chrom(codes, self._chrom_names):
+            if self._type == 'sq':
+                rows = [(i, name, start, end) for i in indices
+                        for name, start, end in self._overlap_sqlite(
+                            chrom, starts[i], ends[i])]
+                if rows:
+                    query, names, hit_starts, hit_ends = zip(*rows)
+                    names = np.array(names, dtype=object)
+                    parts.append((np.array(query, dtype=np.int64), names,
+                                  np.array(hit_starts, dtype=np.int64),
+                                  np.array(hit_ends, dtype=np.int64)))
+            else:
+                query, names, hit_starts, hit_ends = \
+                    self._data[chrom].intersect(starts[indices],
+                                                ends[indices])
+                parts.append((indices[query], names, hit_starts, hit_ends))
+        if not parts:
+            return (np.empty(0, dtype=np.int64), np.empty(0, dtype=object),
+                    np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64))
+        query, names, hit_starts, hit_ends = [np.concatenate(i)
+                                              for i in zip(*parts)]
+        order = np.argsort(query, kind='stable')
+        return (query[order], names[order], hit_starts[order],
+                hit_ends[order])
+
+    def lookup_many(self, chromosomes, locations, n_threads=1):
+        """Lookup many positions at once.
+
+        Positions are grouped by chromosome and each group is resolved in a
+        single pass, this is much faster than calling lookup() in a loop.
+
+        Args:
+            chromosomes (array): Chromosome names, a list, numpy array,
+                                 pandas Series or Categorical, or pyarrow
+                                 array. Categorical and dictionary encoded
+                                 columns are used without decoding them,
+                                 each distinct name is only resolved once.
+                                 ChromIds from encode_chromosomes() are
+                                 used as they are.
+            locations (array):   Integer positions, same length as chromosomes
+            n_threads (int):     Split the batch over this many threads. The
+                                 in memory and mmap backends search without
+                                 the GIL and sqlite threads use their own
+                                 read-only connections, so this scales
+                                 across cores without copying the index.
+
+        Returns:
+            ndarray: An object array of gene names aligned to the input, None
+                     where the lookup failed.
+        """
+        parts = self._run_batch(self._lookup_many, chromosomes, locations,
+                                n_threads)
+        return parts[0] if len(parts) == 1 else np.concatenate(parts)
+
+    def lookup_columns(self, chromosomes, locations, n_threads=1):
+        """Lookup many positions at once, returning name codes and
+        coordinates instead of an array of names.
+
+        Takes the same arguments as lookup_many(). Every distinct gene name
+        found is only returned once, so this is the cheapest way to annotate
+        very large batches.
+
+        Returns:
+            tuple: (codes, names, starts, ends). names is an object array of
+                   the distinct gene names found, codes an int32 array of
+                   indices into names aligned to the input, starts and ends
+                   int64 arrays of the coordinates of the gene found. All
+                   three are -1 where the lookup failed.
+        """
+        parts = self._run_batch(self._lookup_columns, chromosomes, locations,
+                                n_threads)
+        if len(parts) == 1:
+            return parts[0]
+        codes, names = _merge_codes([i[:2] for i in parts])
+        return (np.concatenate(codes), names,
+                np.concatenate([i[2] for i in parts]),
+                np.concatenate([i[3] for i in parts]))
+
+    def _lookup_many(self, codes, chroms, locations):
+        """Resolve one batch of lookup_many() in the calling thread."""
+        result = np.full(len(locations), None, dtype=object)
+        if self._type == 'sq':
+            if self._schema >= 2:
+                return self._lookup_many_sqlite(codes, chroms, locations,
+                                                result)
+            for i, (code, loc) in enumerate(zip(codes, locations)):
+                if code >= 0:
+                    result[i] = self.lookup(chroms[code], loc)
+            return result
+        for chrom, indices in _group_by_chrom(codes, chroms):
+            found = self._data[chrom].find_many(locations[indices])
+            result[indices] = found
+            misses = np.equal(found, None).sum()
+            if misses:
+                self._miss_location(chrom, 'batch', misses)
+        return result
+
+    def _lookup_columns(self, codes, chroms, locations):
+        """Resolve one batch of lookup_columns() in the calling thread."""
+        n      = len(locations)
+        result = np.full(n, -1, dtype=np.int32)
+        starts = np.full(n, -1, dtype=np.int64)
+        ends   = np.full(n, -1, dtype=np.int64)
+        groups = []
+        parts  = []
+        for chrom, indices in _group_by_chrom(codes, chroms):
+            if self._type == 'sq':
+                found = self._find_columns_sqlite(chrom, locations[indices])
+            else:
+                found = self._data[chrom].find_columns(locations[indices])
+            hit_codes, names, starts[indices], ends[indices] = found
+            misses = (hit_codes < 0).sum()
+            if misses:
+                self._miss_location(chrom, 'batch', misses)
+            groups.append(indices)
+            parts.append((hit_codes, names))
+        merged, names = _merge_codes(parts)
+        for indices, hit_codes in zip(groups, merged):
+            result[indices] = hit_codes
+        return result, names, starts, ends
+
+    def lookup_df(self, df, chrom_col, pos_col, n_threads=1, output='object',
+                  coordinates=False):
         """Use a pandas dataframe and return a series with the same index.
 
         Args:
-            df (DataFrame):  A pandas dataframe
-            chrom_col (str): The name of the column with the chromosome name
-            pos_col (str):   The name of the column with the position
+            df (DataFrame):     A pandas dataframe or a pyarrow Table
+            chrom_col (str):    The name of the column with the chromosome
+                                name
+            pos_col (str):      The name of the column with the position
+            n_threads (int):    Threads to split the lookup over, see
+                                lookup_many()
+            output (str):       'object' for gene names as python strings,
+                                'category' for a pandas Categorical or
+                                'arrow' for a pyarrow DictionaryArray. The
+                                last two hold an integer code per row into
+                                the distinct names found.
+            coordinates (bool): Also return the start and end of the gene
+                                found
 
         Returns:
             Series: A pandas series with the same index as the original df.
+                    With coordinates, a DataFrame of name, start and end
+                    columns, start and end are nullable integers. With
+                    output='arrow', a DictionaryArray, or a pyarrow Table
+                    with coordinates.
         """
-        return df.apply(self.lookup_series, args=(chrom_col, pos_col), axis=1)
+        if output not in _outputs:
+            raise ValueError('output must be one of ' + ', '.join(_outputs))
+        if output == 'object' and not coordinates:
+            from pandas import Series
+            return Series(self.lookup_many(df[chrom_col], df[pos_col],
+                                           n_threads),
+                          index=getattr(df, 'index', None), dtype=object)
+        codes, names, starts, ends = self.lookup_columns(
+            df[chrom_col], df[pos_col], n_threads)
+        if output == 'arrow':
+            return _arrow_columns(codes, names, starts, ends, coordinates)
+
+        import pandas as pd
+        index = getattr(df, 'index', None)
+        if output == 'category':
+            name = pd.Categorical.from_codes(codes, names)
+        else:
+            name = _names_array(codes, names)
+        if not coordinates:
+            return pd.Series(name, index=index)
+        missing = codes < 0
+        return pd.DataFrame({'name': name,
+                             'start': pd.arrays.IntegerArray(starts, missing),
+                             'end': pd.arrays.IntegerArray(ends, missing)},
+                            index=index)
 
     def lookup_series(self, series, chrom_col, pos_col):
         """To use with pandas DataFrame.apply().
@@ -126,53 +2276,389 @@ class BedFile():
 
     # Private functions
     def _lookup_sqlite(self, chromosome, location):
-        """ Simple sqlite query """
-        expr = ("SELECT name FROM '{0}' INDEXED BY '{0}_start_end' " +
-                "WHERE {1} BETWEEN start AND end").format(chromosome, location)
+        """ Simple sqlite query over the bin index """
+        if chromosome not in self._tables:
+            alias = self._alias(chromosome)
+            if alias is None:
+                self._miss_chromosome(chromosome)
+                return None
+            chromosome = alias
+        if self._schema < 2:
+            return self._lookup_sqlite_legacy(chromosome, location)
+        location = int(location)
+        c = self._cursor()
+        # The SQL text only depends on the chromosome, so sqlite3 can reuse
+        # the prepared statement from its cache
+        c.execute(
+            ("SELECT name FROM {} WHERE bin IN (?,?,?,?,?,?) AND " +
+             "start <= ? AND end > ? ORDER BY rowid LIMIT 1").format(
+                 _table(chromosome)),
+            _point_bins(location) + [location, location])
 
+        answer = c.fetchone()
+        if answer:
+            return answer[0]
+        else:
+            self._miss_location(chromosome, location)
+            return None
+
+    def _overlap_sqlite(self, chromosome, start, end):
+        """Return (name, start, end) for all rows overlapping [start, end)."""
+        if chromosome not in self._tables:
+            alias = self._alias(chromosome)
+            if alias is None:
+                self._miss_chromosome(chromosome)
+                return []
+            chromosome = alias
+        start = int(start)
+        end   = int(end)
+        c     = self._cursor()
+        if self._schema < 2:
+            c.execute(("SELECT name, start, end FROM {} WHERE " +
+                       "start < ? AND end > ? ORDER BY rowid").format(
+                           _table(chromosome)), (end, start))
+        else:
+            bins = _overlapping_bins(start, end)
+            c.execute(
+                ("SELECT name, start, end FROM {} WHERE bin IN ({}) AND " +
+                 "start < ? AND end > ? ORDER BY rowid").format(
+                     _table(chromosome), ','.join(['?']*len(bins))),
+                bins + [end, start])
+        return c.fetchall()
+
+    def _lookup_many_sqlite(self, codes, chroms, locations, result):
+        """Resolve a batch of lookups with one query per chromosome, see
+        _sqlite_hits(). Answers are written into result in input order.
+        """
+        for chrom, indices in _group_by_chrom(codes, chroms):
+            for i, name, _, _ in self._sqlite_hits(chrom, locations[indices]):
+                result[indices[i]] = name
+            misses = np.equal(result[indices], None).sum()
+            if misses:
+                self._miss_location(chrom, 'batch', misses)
+        return result
+
+    def _find_columns_sqlite(self, chrom, positions):
+        """The sqlite version of find_columns()."""
+        n      = len(positions)
+        codes  = np.full(n, -1, dtype=np.int32)
+        starts = np.full(n, -1, dtype=np.int64)
+        ends   = np.full(n, -1, dtype=np.int64)
+        hits   = self._sqlite_hits(chrom, positions)
+        if not hits:
+            return codes, np.empty(0, dtype=object), starts, ends
+        index, names, hit_starts, hit_ends = zip(*hits)
+        index = np.array(index, dtype=np.int64)
+        codes[index], names = _factorize(np.array(names, dtype=object))
+        starts[index] = hit_starts
+        ends[index]   = hit_ends
+        return codes, names, starts, ends
+
+    def _sqlite_hits(self, chrom, positions):
+        """Return (index, name, start, end) of the first hit for positions.
+
+        The positions are loaded into a temporary table along with their bins
+        and joined against the chromosome table in a single statement.
+        Positions without a hit are left out.
+        """
+        c = self._cursor()
+        if self._schema < 2:
+            hits = []
+            for i, loc in enumerate(positions):
+                c.execute(("SELECT name, start, end FROM {} WHERE ? " +
+                           "BETWEEN start AND end LIMIT 1").format(
+                               _table(chrom)), (int(loc),))
+                row = c.fetchone()
+                if row:
+                    hits.append((i,) + row)
+            return hits
+        c.execute('CREATE TEMP TABLE IF NOT EXISTS _bed_query ' +
+                  '(i int, pos int, b0 int, b1 int, b2 int, b3 int, ' +
+                  'b4 int, b5 int)')
+        columns = [np.arange(len(positions)), positions]
+        for offset, shift in zip(_bin_offsets, range(
+                _bin_first_shift, 64, _bin_next_shift)):
+            columns.append(np.where(positions < _bin_max,
+                                    offset + (positions >> shift),
+                                    _bin_overflow))
+        columns.append(np.full(len(positions), _bin_overflow))
+        c.execute('DELETE FROM temp._bed_query')
+        c.executemany('INSERT INTO temp._bed_query VALUES ' +
+                      '(?,?,?,?,?,?,?,?)',
+                      np.column_stack(columns).tolist())
+        c.execute(('SELECT q.i, t.name, t.start, t.end FROM ' +
+                   'temp._bed_query q JOIN {0} t ON t.rowid = ' +
+                   '(SELECT s.rowid FROM {0} s WHERE s.bin ' +
+                   'IN (q.b0,q.b1,q.b2,q.b3,q.b4,q.b5) AND ' +
+                   's.start <= q.pos AND s.end > q.pos ' +
+                   'ORDER BY s.rowid LIMIT 1)').format(_table(chrom)))
+        hits = c.fetchall()
+        c.connection.commit()
+        return hits
+
+    def _cursor(self):
+        """Return an sqlite cursor for the calling thread.
+
+        The thread that opened the BedFile uses the main connection, every
+        other thread gets its own read-only connection, opened on first use
+        and kept in self._readers until close(). The threads of batch
+        lookups live as long as the BedFile, so they reuse theirs.
+        """
+        thread = threading.get_ident()
+        if thread == self._owner:
+            return self._c
         try:
-            self._c.execute(expr)
+            return self._readers[thread]
+        except KeyError:
+            # Only used by this thread, but closed by the one calling close()
+            conn = sqlite3.connect('file:{}?mode=ro'.format(
+                pathname2url(os.path.abspath(self._db_name))), uri=True,
+                                   check_same_thread=False)
+            self._readers[thread] = conn.cursor()
+            return self._readers[thread]
+
+    def _lookup_sqlite_legacy(self, chromosome, location):
+        """ Query a version 1 database on its (start, end) index """
+        location = int(location)
+        expr = ("SELECT name FROM {} INDEXED BY {} " +
+                "WHERE ? BETWEEN start AND end").format(
+                    _table(chromosome), _table(chromosome + '_start_end'))
+
+        c = self._cursor()
+        try:
+            c.execute(expr, (location,))
         except sqlite3.OperationalError as e:
             if str(e).startswith('no such table'):
-                logme.log(("Chromosome '{}' is not in " +
-                           "the lookup table, lookup failed." +
-                           "\n").format(chromosome), level='error')
+                self._miss_chromosome(chromosome)
                 return None
             else:
                 raise(e)
 
-        answer = self._c.fetchone()
+        answer = c.fetchone()
         if answer:
             return answer[0]
         else:
-            logme.log(("Location '{}' on Chromosome '{}' " +
-                       "is not in the lookup table, lookup failed." +
-                       "\n").format(location, chromosome), level='debug')
+            self._miss_location(chromosome, location)
             return None
 
     def _lookup_dict(self, chromosome, location):
         """ Simple dictionary query with cython for math """
-        cdef int loc
-        loc = int(location)
-        if chromosome in self._data:
-            ans = self._data[chromosome].find(location)
-            if ans:
-                return ans
-            else:
-                logme.log(("Location '{}' on Chromosome '{}' " +
-                           "is not in the lookup table, lookup failed." +
-                           "\n").format(location, chromosome), level='debug')
+        try:
+            chrom = self._data[chromosome]
+        except KeyError:
+            alias = self._alias(chromosome)
+            if alias is None:
+                self._miss_chromosome(chromosome)
                 return None
+            chrom = self._data[alias]
+        ans = chrom.find(location)
+        if ans:
+            return ans
+        self._miss_location(chromosome, location)
+        return None
+
+    def stats(self):
+        """Return counts of failed lookups.
+
+        Returns:
+            dict: 'unknown_chromosome' maps each chromosome that is not in
+                  the bed file to the number of lookups on it,
+                  'not_found' maps each chromosome to the number of
+                  positions on it that were not in any interval. With a
+                  lookup cache, 'lookup_cache' holds its hits, misses, size
+                  and max_size. With profile=True, 'profile' holds the
+                  seconds spent in each phase of opening the file, the
+                  latency histograms of every lookup method, and backend
+                  statistics, see bed_lookup.instrument.
+        """
+        stats = {'unknown_chromosome': dict(self._unknown_chroms),
+                 'not_found': dict(self._not_found)}
+        if self._memo is not None:
+            stats['lookup_cache'] = self._memo.stats()
+        if self._profiler.enabled:
+            stats['profile'] = self._profiler.as_dict()
+            stats['profile']['backend'] = self._backend_stats()
+        return stats
+
+    def _backend_stats(self):
+        """Return a JSON serialisable description of the open backend."""
+        stats = {'backend': self.backend, 'reason': self.backend_reason}
+        if self._type == 'sq':
+            c = self._cursor()
+            for pragma in ('page_size', 'page_count', 'freelist_count',
+                           'cache_size'):
+                stats[pragma] = c.execute('PRAGMA ' + pragma).fetchone()[0]
+            stats.update(path=self._db_name, schema=self._schema,
+                         file_bytes=getsize(self._db_name),
+                         chromosomes=len(self._tables))
+        elif self._type == 'tb':
+            reader = self._tabix.reader
+            stats.update(path=self._tabix.path,
+                         chromosomes=len(self._data),
+                         block_cache_hits=reader.hits,
+                         block_cache_misses=reader.misses,
+                         block_cache_size=reader.cache_blocks)
+        elif isinstance(self._data, _LazyChroms):
+            stats.update(chromosomes=len(self._data),
+                         lazy=self._data.stats())
         else:
-            logme.log(("Chromosome '{}' is not in " +
-                       "the lookup table, lookup failed." +
-                       "\n").format(chromosome), level='error')
-            return None
+            stats.update(chromosomes=len(self._data),
+                         intervals=sum(len(i) for i in self._data.values()))
+            if self._type == 'mm':
+                stats['mapped_bytes'] = len(self._mmap)
+        return stats
+
+    def merge_stats(self, stats):
+        """Add counts from a stats() dictionary, e.g. from another process."""
+        with self._stats_lock:
+            self._unknown_chroms.update(stats['unknown_chromosome'])
+            self._not_found.update(stats['not_found'])
+            if self._memo is not None and 'lookup_cache' in stats:
+                self._memo.hits   += stats['lookup_cache']['hits']
+                self._memo.misses += stats['lookup_cache']['misses']
+        if self._profiler.enabled and 'profile' in stats:
+            self._profiler.merge(stats['profile'])
 
-    def _init_sqlite(self, bedfile):
+    def reset_stats(self):
+        """Zero the failed lookup, lookup cache and profile counters."""
+        with self._stats_lock:
+            self._unknown_chroms.clear()
+            self._not_found.clear()
+            if self._memo is not None:
+                self._memo.hits   = 0
+                self._memo.misses = 0
+        if self._profiler.enabled:
+            self._profiler.reset()
+
+    def log_stats(self, level='info'):
+        """Log a one line summary of failed lookups, if there were any."""
+        if self._unknown_chroms:
+            logme.log(('{} lookups failed on {} chromosomes not in the ' +
+                       'lookup table: {}\n').format(
+                           sum(self._unknown_chroms.values()),
+                           len(self._unknown_chroms),
+                           ', '.join('{} ({})'.format(*i) for i in
+                                     self._unknown_chroms.most_common(10))),
+                      level=level)
+        if self._not_found:
+            logme.log('{} positions were not in any interval\n'.format(
+                sum(self._not_found.values())), level=level)
+        memo = self._memo
+        if memo is not None and memo.hits:
+            logme.log('Lookup cache: {} hits, {} misses ({:.1%})\n'.format(
+                memo.hits, memo.misses, memo.hits/(memo.hits + memo.misses)),
+                level=level)
+
+    def _miss_location(self, chromosome, location, count=1):
+        """Count positions that are not in any interval."""
+        with self._stats_lock:
+            self._not_found[chromosome] += int(count)
+        if logme.enabled('debug'):
+            logme.log(("Location '{}' on Chromosome '{}' " +
+                       "is not in the lookup table, lookup failed." +
+                       "\n").format(location, chromosome), level='debug')
+
+    def migrate_db(self):
+        """Convert a version 1 sqlite database to the binned schema in place.
+
+        Version 1 databases only have an index on (start, end), which makes
+        every lookup scan about half of the chromosome table. This adds a
+        bin column to every table and indexes it, lookups then only touch
+        a handful of pages. Migrated databases use half-open intervals, the
+        same as the dictionary backend.
+        """
+        if self._type != 'sq':
+            raise ValueError('Only sqlite backed BedFiles can be migrated')
+        if self._schema >= _sqlite_schema:
+            return
+        logme.log('Migrating sqlite database to schema version {}\n'.format(
+            _sqlite_schema), level='info')
+        conn  = self._conn
+        c     = self._c
+        level = conn.isolation_level
+        conn.isolation_level = None
+        conn.create_function('bed_bin', 2, _bin_from_range)
+        c.execute('BEGIN')
+        try:
+            for chrom in self._sqlite_tables():
+                c.execute('ALTER TABLE {} ADD COLUMN bin int'.format(
+                    _table(chrom)))
+                c.execute('UPDATE {} SET bin = bed_bin(start, end)'.format(
+                    _table(chrom)))
+                c.execute('DROP INDEX IF EXISTS {}'.format(
+                    _table(chrom + '_start_end')))
+                c.execute('CREATE INDEX {} ON {} (bin, start, end)'.format(
+                    _table(chrom + '_bin_start_end'), _table(chrom)))
+            self._write_meta()
+            c.execute('COMMIT')
+        except:
+            c.execute('ROLLBACK')
+            raise
+        finally:
+            conn.isolation_level = level
+        self._schema = _sqlite_schema
+
+    def _sqlite_tables(self):
+        """Return the names of all chromosome tables in the database."""
+        self._c.execute("SELECT name FROM sqlite_master WHERE type='table'")
+        return [i[0] for i in self._c.fetchall() if i[0] != _sqlite_meta]
+
+    def _write_meta(self):
+        """Create the meta table and record the schema version."""
+        self._c.execute(('CREATE TABLE IF NOT EXISTS {} (key text PRIMARY ' +
+                         'KEY, value text)').format(_table(_sqlite_meta)))
+        self._c.execute('INSERT OR REPLACE INTO {} VALUES (?, ?)'.format(
+            _table(_sqlite_meta)), ('schema', str(_sqlite_schema)))
+
+    def _read_meta(self):
+        """Return the meta table as a dictionary."""
+        self._c.execute('SELECT key, value FROM {}'.format(
+            _table(_sqlite_meta)))
+        return dict(self._c.fetchall())
+
+    def _write_source(self, source, digests=None):
+        """Record the bed file the database holds, see _source_record().
+
+        Args:
+            source (dict):  The source meta values
+            digests (dict): Replace the chromosome digests with these
+        """
+        table = _table(_sqlite_meta)
+        rows  = [(key, str(source[key])) for key in _sqlite_source]
+        if digests is not None:
+            self._c.execute(
+                'DELETE FROM {} WHERE substr(key, 1, {}) = ?'.format(
+                    table, len(_sqlite_digest)), (_sqlite_digest,))
+            rows += [(_sqlite_digest + chrom, '{} {}'.format(*digest))
+                     for chrom, digest in digests.items()]
+        self._c.executemany('INSERT OR REPLACE INTO {} VALUES (?, ?)'.format(
+            table), rows)
+
+    def _check_schema(self, db_name, migrate=False):
+        """Set self._schema from the database, migrating it if requested."""
+        self._c.execute("SELECT name FROM sqlite_master WHERE type='table' " +
+                        "AND name = ?", (_sqlite_meta,))
+        if self._c.fetchone():
+            self._c.execute('SELECT value FROM {} WHERE key = ?'.format(
+                _table(_sqlite_meta)), ('schema',))
+            self._schema = int(self._c.fetchone()[0])
+        else:
+            self._schema = 1
+        if self._schema < _sqlite_schema:
+            if migrate:
+                self.migrate_db()
+            else:
+                logme.log(('{} uses the old (start, end) schema, lookups ' +
+                           'will be slow. Pass migrate=True or call ' +
+                           'migrate_db() to upgrade it in place.\n').format(
+                               db_name), level='warn')
+
+    def _init_sqlite(self, bedfile, migrate=False, workers=1, update=True):
         """ Initialize sqlite3 object """
-        logme.log('Bedfile is large, using sqlite\n', level='info')
         db_name = bedfile if bedfile.endswith('.db') else bedfile + '.db'
+        # The bed file the database belongs to, None to use the one recorded
+        # in the database
+        source  = None if bedfile.endswith('.db') else bedfile
         # Check if the alternate db exists if db doesn't exist
         if not os.path.exists(db_name):
             if bedfile.endswith('.gz'):
@@ -181,69 +2667,779 @@ class BedFile():
                 alt_path = bedfile + '.gz' + '.db'
             if os.path.exists(alt_path):
                 db_name = alt_path
-                exists = True
+                source  = None
+                exists  = True
             else:
-                exits = False
+                exists = False
         else:
             exists = True
 
         # If the database already exists, use it
         if exists:
-            logme.log('Using existing db, if this is ' +
-                      'not what you want, delete ' + db_name + '\n',
-                      level='info')
+            logme.log('Using existing db ' + db_name + '\n', level='info')
+            self._db_name = db_name
             self._conn = sqlite3.connect(db_name)
             self._c = self._conn.cursor()
+            self._check_schema(db_name, migrate)
+            if self._schema >= _sqlite_schema:
+                self._update_sqlite(source, workers, update)
+            self._tables = set(self._sqlite_tables())
             return
 
         # Create an sqlite database from bed file
         logme.log('Creating sqlite database, this ' +
                   'may take a long time.\n', level='info')
+        self._db_name = db_name
         self._conn = sqlite3.connect(db_name)
         self._c = self._conn.cursor()
+        self._load_sqlite(bedfile, workers)
+        self._schema = _sqlite_schema
+        self._tables = set(self._sqlite_tables())
+
+    def _load_sqlite(self, bedfile, workers=1):
+        """Bulk load a bed file into the open sqlite database.
+
+        The bed file is parsed in chunks, in parallel if workers > 1, and
+        every chunk is inserted with executemany inside a single
+        transaction, with journaling and syncing disabled for the duration
+        of the load. Indices are only created once all rows are in. The
+        size, modification time and SHA1 of the bed file and a digest of
+        every chromosome are recorded, see _update_sqlite().
+        """
+        source  = _source_record(bedfile)
+        digests = {}
+        start   = time.time()
+        with self._bulk_load():
+            count, tables = self._insert_chunks(
+                _parse_bed(bedfile, workers, self._profiler), digests)
+            self._index_tables(tables)
+            self._write_meta()
+            self._write_source(source, digests)
+
+        elapsed = time.time() - start
+        logme.log(('Loaded {} rows into {} tables in {:.1f}s ' +
+                   '({:.0f} rows/s)\n').format(
+                       count, len(tables), elapsed,
+                       count/elapsed if elapsed else count),
+                  level='info')
+
+    def _update_sqlite(self, bedfile=None, workers=1, update=True):
+        """Bring the database up to date if its bed file has changed.
+
+        The bed file is unchanged if its size and modification time, or
+        failing that its SHA1, match those recorded when the database was
+        built. If the old contents are still the start of the file, only
+        the new lines are inserted. Otherwise the file is parsed and only
+        the chromosomes whose intervals differ from the recorded digests are
+        rebuilt. A database that cannot be written to, because it is read
+        only or locked, is used as it is with a warning if it is stale.
 
-        with gopen(bedfile) as infile:
-            for line in infile:
-                f = line.rstrip().split('\t')
-                if len(f) < 4:
+        Args:
+            bedfile (str):  The bed file, default the one the database was
+                            built from
+            workers (int):  Processes to parse the bed file with
+            update (bool):  Update a stale database, if False only warn
+        """
+        meta = self._read_meta()
+        if 'source_sha1' not in meta:
+            logme.log(('{} does not record the bed file it was built from, ' +
+                       'it cannot be checked for changes. Delete it if it ' +
+                       'is out of date.\n').format(self._db_name),
+                      level='info')
+            return
+        bedfile = bedfile or meta['source_path']
+        if not os.path.isfile(bedfile):
+            logme.log(('{} was built from {}, which no longer exists, it ' +
+                       'cannot be checked for changes\n').format(
+                           self._db_name, bedfile), level='warn')
+            return
+        old_size = int(meta['source_size'])
+        stat     = os.stat(bedfile)
+        if (stat.st_size == old_size and
+                stat.st_mtime_ns == int(meta['source_mtime']) and
+                os.path.abspath(bedfile) == meta['source_path']):
+            return
+
+        with self._profiler.phase('checksum'):
+            sha1, head = _file_sha1(bedfile, old_size)
+        source     = _source_record(bedfile, sha1)
+        stale      = sha1 != meta['source_sha1']
+        if stale and not update:
+            logme.log(('{} has changed since {} was built, lookups may be ' +
+                       'wrong. Pass update=True to update it.\n').format(
+                           bedfile, self._db_name), level='warn')
+            return
+        try:
+            if stale:
+                self._refresh_sqlite(bedfile, meta, source, head, old_size,
+                                     workers)
+            else:
+                # Touched, copied or moved, but the contents are the same
+                with self._bulk_load(journal=True):
+                    self._write_source(source)
+        except sqlite3.OperationalError as e:
+            if not _unwritable(e):
+                raise
+            if stale:
+                logme.log(('{} has changed since {} was built, lookups may ' +
+                           'be wrong. It cannot be updated: {}\n').format(
+                               bedfile, self._db_name, e), level='warn')
+            else:
+                logme.log('Could not record the new mtime of {} in {}: {}\n'
+                          .format(bedfile, self._db_name, e), level='debug')
+
+    def _refresh_sqlite(self, bedfile, meta, source, head, old_size,
+                        workers=1):
+        """Insert the new lines of a grown bed file, or rebuild the tables
+        of the chromosomes that changed, see _update_sqlite()."""
+        digests = {key[len(_sqlite_digest):]: tuple(map(int, value.split()))
+                   for key, value in meta.items()
+                   if key.startswith(_sqlite_digest)}
+        start   = time.time()
+        if head == meta['source_sha1'] and _ends_line(bedfile, old_size):
+            logme.log('{} has grown, inserting the new lines\n'.format(
+                bedfile), level='info')
+            with self._bulk_load(journal=True):
+                count, tables = self._insert_chunks(
+                    (_parse_chunk(i) for i in _stream_chunks(bedfile,
+                                                             old_size)),
+                    digests)
+                self._index_tables(tables)
+                self._write_source(source, digests)
+        else:
+            new = {}
+            for names, chunk in _parse_bed(bedfile, workers,
+                                           self._profiler):
+                _digest_chunk(new, names, chunk)
+            changed = {i for i in new if new[i] != digests.get(i)}
+            removed = set(digests) - set(new)
+            logme.log(('{} has changed, rebuilding {} of {} chromosomes ' +
+                       'and removing {}\n').format(bedfile, len(changed),
+                                                   len(new), len(removed)),
+                      level='info')
+            with self._bulk_load(journal=True):
+                for chrom in changed | removed:
+                    self._c.execute('DROP TABLE IF EXISTS {}'.format(
+                        _table(chrom)))
+                count, tables = 0, set()
+                if changed:
+                    count, tables = self._insert_chunks(
+                        _parse_bed(bedfile, workers, self._profiler),
+                        only=changed)
+                    self._index_tables(tables)
+                self._write_source(source, new)
+
+        elapsed = time.time() - start
+        logme.log(('Updated {} with {} rows in {} tables in {:.1f}s\n').format(
+            self._db_name, count, len(tables), elapsed), level='info')
+
+    @contextmanager
+    def _bulk_load(self, journal=False):
+        """Run the body in one transaction with the bulk load pragmas, then
+        restore the settings the database had, e.g. a WAL journal.
+
+        Args:
+            journal (bool): Keep the rollback journal, so an interrupted
+                            write cannot corrupt an existing database
+        """
+        conn  = self._conn
+        c     = self._c
+        level = conn.isolation_level
+        conn.isolation_level = None
+        saved = []
+        try:
+            for pragma in _sqlite_load_pragmas:
+                name = pragma.split('=')[0]
+                if journal and name == 'journal_mode':
                     continue
-                # Check if db exists and create if it does
-                expr = ("SELECT * FROM sqlite_master WHERE name = '{}' " +
-                        "and type='table';").format(f[0])
-                self._c.execute(expr)
-                if not self._c.fetchall():
-                    exp = ("CREATE TABLE '{}' (name text, start int, " +
-                           "end int);").format(f[0])
-                    self._c.execute(exp)
-                    self._conn.commit()
-                expr = ("INSERT INTO '{}' VALUES " +
-                        "('{}','{}','{}')").format(f[0], f[3], f[1], f[2])
-                self._c.execute(expr)
-            self._conn.commit()
-            # Create indicies
-            self._c.execute('''SELECT name FROM sqlite_master WHERE type='table';''')
-            for i in self._c.fetchall():
-                exp = ("CREATE INDEX '{0}_start_end' ON '{0}' " +
-                       "(start, end)").format(i[0])
-                self._c.execute(exp)
-                self._conn.commit()
-
-    def _init_dict(self, bedfile):
-        self._data = defaultdict(Chrom)
-        with gopen(bedfile) as infile:
-            for line in infile:
-                f = line.rstrip().split('\t')
-                if len(f) < 4:
+                saved.append('{}={}'.format(
+                    name, c.execute('PRAGMA ' + name).fetchone()[0]))
+                c.execute('PRAGMA ' + pragma)
+            c.execute('BEGIN')
+            try:
+                yield
+                c.execute('COMMIT')
+            except:
+                if conn.in_transaction:
+                    c.execute('ROLLBACK')
+                raise
+        finally:
+            for pragma in saved:
+                c.execute('PRAGMA ' + pragma)
+            conn.isolation_level = level
+
+    def _insert_chunks(self, chunks, digests=None, only=None):
+        """Insert parsed bed chunks, creating tables as needed.
+
+        Args:
+            chunks (iterable): (names, chunk) pairs, see _parse_chunk()
+            digests (dict):    Chromosome digests to extend with every row,
+                               see _digest_chunk()
+            only (set):        Only insert these chromosomes
+
+        Returns:
+            tuple: (rows inserted, set of chromosomes inserted into)
+        """
+        c        = self._c
+        profiler = self._profiler
+        tables   = set(self._sqlite_tables())
+        written  = set()
+        count    = 0
+        for names, chunk in chunks:
+            if digests is not None:
+                _digest_chunk(digests, names, chunk)
+            names = np.array(names, dtype=object)
+            for chrom, (starts, ends, ids) in chunk.items():
+                if only is not None and chrom not in only:
                     continue
-                chr   = f[0]
-                gene  = Gene(f)
-                self._data[chr].add(gene)
+                if chrom not in tables:
+                    c.execute(('CREATE TABLE {} (name text, start int, ' +
+                               'end int, bin int)').format(_table(chrom)))
+                    tables.add(chrom)
+                with profiler.phase('insert'):
+                    c.executemany(
+                        'INSERT INTO {} VALUES (?, ?, ?, ?)'.format(
+                            _table(chrom)),
+                        zip(names[ids].tolist(), starts.tolist(),
+                            ends.tolist(), _bin_array(starts, ends).tolist()))
+                written.add(chrom)
+                count += len(starts)
+        profiler.count('rows_inserted', count)
+        return count, written
+
+    def _index_tables(self, chroms):
+        """Create the (bin, start, end) index of every chromosome table."""
+        with self._profiler.phase('create_index'):
+            for chrom in chroms:
+                self._c.execute(('CREATE INDEX IF NOT EXISTS {} ON {} ' +
+                                 '(bin, start, end)').format(
+                                     _table(chrom + '_bin_start_end'),
+                                     _table(chrom)))
+
+    def _init_dict(self, bedfile, workers=1):
+        self._data = _load_chroms(bedfile, workers, self._profiler)
+
+    def _init_lazy(self, bedfile, max_bytes=None, workers=1):
+        """Find each chromosome of bedfile, to parse it on first use.
+
+        Plain files are scanned for the byte ranges of every chromosome,
+        compressed files need a tabix or CSI index. Other files, and plain
+        files far from sorted by chromosome, are parsed whole.
+        """
+        if bedfile.endswith(('.gz', '.bz2')):
+            if not _tabix.find_index(bedfile):
+                logme.log(('{} is compressed and has no tabix index, ' +
+                           'loading every chromosome\n').format(bedfile),
+                          level='info')
+                self._init_dict(bedfile, workers)
+                return
+            blocks = None
+        else:
+            with self._profiler.phase('scan'):
+                found = _scan_bed(bedfile)
+            if found is None:
+                logme.log(('{} is not sorted by chromosome, loading every ' +
+                           'chromosome\n').format(bedfile), level='info')
+                self._init_dict(bedfile, workers)
+                return
+            blocks, lines = found
+            logme.log('Found {} lines on {} chromosomes in {}\n'.format(
+                lines, len(blocks), bedfile), level='debug')
+        self._data = _LazyChroms(bedfile, blocks, max_bytes, self._profiler)
+
+    def _init_cached(self, bedfile, cache_dir, cache_hash, cache_max_size,
+                     workers=1):
+        """Map a cached index of bedfile, parsing and caching it if needed."""
+        index_file = _cache.find(bedfile, cache_dir, cache_hash)
+        if index_file:
+            logme.log('Using cached index ' + index_file + '\n',
+                      level='debug')
+            self._type = 'mm'
+            self._init_mmap(index_file)
+            return
+        self._type = 'dt'
+        self._init_dict(bedfile, workers)
+        with self._profiler.phase('write_index'):
+            _write_index(self._data, _cache.index_path(bedfile, cache_dir))
+        _cache.store(bedfile, cache_dir, cache_hash, cache_max_size)
 
-    def __init__(self, bedfile):
-        if bedfile.endswith('.db') or large_file(bedfile):
-            # Use sqlite for files greater than max len
+    def _init_mmap(self, index_file):
+        """Open a binary index written by compile_index()."""
+        with self._profiler.phase('map'):
+            self._map_index(index_file)
+
+    def _map_index(self, index_file):
+        self._index_file = index_file
+        with open(index_file, 'rb') as fin:
+            self._mmap = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, n_chroms, n_names, names_offset, blob_offset = \
+            _index_header.unpack_from(self._mmap, 0)
+        if magic != _index_magic or version != _index_version:
+            raise ValueError(('{} is not a bed_lookup index, or was ' +
+                              'written by a different version').format(
+                                  index_file))
+        pool = _NamePool(self._mmap, names_offset, blob_offset, n_names)
+        self._data = {}
+        for i in range(n_chroms):
+            name_id, root_k, n, offset = _index_chrom.unpack_from(
+                self._mmap, _index_header.size + i*_index_chrom.size)
+            self._data[pool[name_id]] = MappedChrom(self._mmap, offset, n,
+                                                    root_k, pool)
+
+    def _init_tabix(self, bedfile, block_cache):
+        """Open a bgzipped bed file through its tabix or CSI index.
+
+        Every chromosome in the index gets a TabixChrom, which has the same
+        lookup methods as the in memory index, so the dict code paths are
+        used unchanged.
+        """
+        with self._profiler.phase('read_index'):
+            self._tabix = _tabix.TabixFile(bedfile, cache_blocks=block_cache)
+        self._data  = {chrom: _tabix.TabixChrom(self._tabix, chrom)
+                       for chrom in self._tabix.chromosomes}
+
+    def __init__(self, bedfile, migrate=False, cache=False,
+                 cache_hash=False, cache_max_size=_cache.MAX_SIZE,
+                 backend='auto', memory_budget=None, workers=1,
+                 block_cache=_tabix.CACHE_BLOCKS, update=True,
+                 lookup_cache=0, profile=False, chrom_aliases=False,
+                 lazy=False, lazy_memory=None):
+        """Open a bed file, sqlite database or binary index.
+
+        Args:
+            bedfile (str):        The bed file, optionally gzipped, a .db
+                                  database or a .bidx index
+            backend (str):        One of 'dict', 'sqlite', 'mmap', 'tabix' or
+                                  'auto'. 'auto' uses an up to date .bidx
+                                  index if there is one, otherwise the dict
+                                  backend if it is estimated to fit in
+                                  memory_budget, otherwise tabix if the
+                                  file has a .tbi or .csi index, otherwise
+                                  sqlite. The choice and reason are logged
+                                  and stored in self.backend and
+                                  self.backend_reason.
+            memory_budget (int):  Bytes of memory the dict backend may use,
+                                  default is bed_lookup._memory_budget
+            migrate (bool):       Upgrade an old sqlite database in place
+            update (bool):        Bring an existing sqlite database up to
+                                  date if its bed file has changed since it
+                                  was built, otherwise only warn
+            cache (bool/str):     Cache the parsed index of small bed files
+                                  on disk and reuse it while the bed file is
+                                  unchanged. True uses ~/.cache/bed_lookup,
+                                  a string is used as the cache directory.
+            cache_hash (bool):    Also check the SHA1 of the bed file before
+                                  using a cached index, not just its size
+                                  and modification time
+            cache_max_size (int): Evict least recently used cache entries to
+                                  keep the cache under this many bytes
+            workers (int):        Processes to parse a bed file with, None
+                                  for one per CPU. Plain and bgzipped files
+                                  are split into ranges parsed in parallel,
+                                  other compressed files use one process.
+            block_cache (int):    Decompressed BGZF blocks the tabix
+                                  backend keeps in memory
+            lookup_cache (int):   Remember the results of up to this many
+                                  lookup() calls by chromosome and
+                                  position, evicting the least recently
+                                  used. 0 disables the cache.
+            profile (bool):       Time the phases of opening the bed file
+                                  and record the latency of every lookup,
+                                  reported under 'profile' in stats().
+                                  Lookups are not slowed down when False.
+            chrom_aliases (bool/dict): Look up chromosomes that are not in
+                                  the bed file under another name. True
+                                  tries the name with and without a 'chr'
+                                  prefix, and MT for M. A dictionary maps
+                                  names to the names in the bed file.
+            lazy (bool):          Only parse each chromosome when it is
+                                  first looked up, with the dict backend.
+                                  A plain bed file is scanned for where
+                                  each chromosome is, a compressed one
+                                  needs a tabix index.
+            lazy_memory (int):    With lazy, drop the least recently used
+                                  chromosomes when those in memory are
+                                  estimated to need more bytes than this
+        """
+        self._unknown_chroms = Counter()
+        self._not_found      = Counter()
+        self._stats_lock     = threading.Lock()
+        self._owner          = threading.get_ident()
+        self._readers        = {}
+        self._threads        = None
+        self._memo           = (_LookupCache(lookup_cache) if lookup_cache
+                                else None)
+        self._profiler       = (_instrument.Profiler() if profile else
+                                _instrument.NULL)
+        if not isinstance(chrom_aliases, (bool, dict)):
+            raise ValueError('chrom_aliases must be True, False or a dict')
+        self._aliases        = chrom_aliases
+        start = time.perf_counter()
+        if lazy and backend not in ('auto', 'dict'):
+            raise ValueError('lazy loading needs the dict backend')
+        if lazy:
+            backend, reason = 'dict', 'lazy loading requested'
+        elif backend == 'auto':
+            with self._profiler.phase('choose_backend'):
+                backend, reason = _choose_backend(bedfile, memory_budget)
+        elif backend in _backends:
+            reason = 'requested'
+        else:
+            raise ValueError('backend must be one of auto, ' +
+                             ', '.join(_backends))
+        logme.log('Using the {} backend: {}\n'.format(backend, reason),
+                  level='info')
+        self.backend        = backend
+        self.backend_reason = reason
+
+        if backend == 'mmap':
+            if not bedfile.endswith(_index_ext):
+                index_file = bedfile + _index_ext
+                if not _index_current(bedfile, index_file):
+                    if os.path.exists(index_file):
+                        logme.log(('{} is older than {}, compiling it ' +
+                                   'again\n').format(index_file, bedfile),
+                                  level='info')
+                    with self._profiler.phase('compile'):
+                        compile_index(bedfile, index_file, workers)
+                bedfile = index_file
+            self._type = 'mm'
+            self._init_mmap(bedfile)
+        elif backend == 'sqlite':
             self._type = 'sq'
-            self._init_sqlite(bedfile)
+            self._init_sqlite(bedfile, migrate, workers, update)
+        elif backend == 'tabix':
+            self._type = 'tb'
+            self._init_tabix(bedfile, block_cache)
+        elif bedfile.endswith(_index_ext) or bedfile.endswith('.db'):
+            raise ValueError('The dict backend needs a bed file')
+        elif lazy:
+            self._type = 'dt'
+            self._init_lazy(bedfile, lazy_memory, workers)
+        elif cache:
+            self._init_cached(bedfile, None if cache is True else cache,
+                              cache_hash, cache_max_size, workers)
         else:
             self._type = 'dt'
-            self._init_dict(bedfile)
+            self._init_dict(bedfile, workers)
+        self._index_chromosomes(self._tables if self._type == 'sq' else
+                                self._data)
+        self._profiler.add_phase('load', time.perf_counter() - start)
+        if self._profiler.enabled:
+            self._instrument()
+
+    def _instrument(self):
+        """Replace the lookup methods of this instance with timed wrappers.
+
+        The class methods are left alone, so an unprofiled BedFile runs
+        without any wrapping.
+        """
+        profiler = self._profiler
+        for name, items in _timed_methods:
+            setattr(self, name, profiler.wrap(
+                _timed_names.get(name, name), getattr(type(self), name)
+                .__get__(self), items))
+
+    def close(self):
+        """Stop the threads of batch lookups and close the read-only sqlite
+        connections they opened.
+
+        The main sqlite connection is left open, the BedFile can still be
+        used and opens the others again when needed.
+        """
+        super(BedFile, self).close()
+        with self._stats_lock:
+            readers, self._readers = self._readers, {}
+        for cursor in readers.values():
+            cursor.connection.close()
+
+    def __del__(self):
+        super(BedFile, self).__del__()
+        for cursor in getattr(self, '_readers', {}).values():
+            cursor.connection.close()
+
+    def __getstate__(self):
+        """Drop the thread state, which cannot be pickled, the timed
+        wrappers and a memory mapped index, which are recreated."""
+        state = self.__dict__.copy()
+        for key in ('_stats_lock', '_owner', '_readers', '_threads'):
+            state.pop(key, None)
+        for name, _ in _timed_methods:
+            state.pop(name, None)
+        if self._type == 'mm':
+            state.pop('_mmap', None)
+            state.pop('_data', None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._stats_lock = threading.Lock()
+        self._owner      = threading.get_ident()
+        self._readers    = {}
+        self._threads    = None
+        if self._type == 'mm':
+            self._map_index(self._index_file)
+        if self._profiler.enabled:
+            self._instrument()
+
+
+class BedCollection(_Chromosomes):
+
+    """Several bed files, or tracks, held in one index.
+
+    Every position is searched once for all tracks, and the answers come
+    back with one column per track:
+        c = BedCollection({'gene': 'genes.bed', 'exon': 'exons.bed'})
+        c.lookup('chr1', 10003021)
+        {'gene': 'ABC1', 'exon': None}
+    """
+
+    def __init__(self, tracks, workers=1, chrom_aliases=False):
+        """Load every track into one in memory index.
+
+        Args:
+            tracks (dict/list):        Bed files by track name, or a list of
+                                       bed files, each named after its file
+                                       name without extensions
+            workers (int):             Processes to parse each bed file
+                                       with, see BedFile
+            chrom_aliases (bool/dict): Look up chromosomes that are not in
+                                       any track under another name, see
+                                       BedFile
+        """
+        if not isinstance(tracks, dict):
+            tracks = [(_track_name(i), i) for i in tracks]
+            if len(set(i[0] for i in tracks)) < len(tracks):
+                raise ValueError('Two bed files have the same name, pass ' +
+                                 'a dictionary of track names instead')
+            tracks = OrderedDict(tracks)
+        if not tracks:
+            raise ValueError('No tracks given')
+        if not isinstance(chrom_aliases, (bool, dict)):
+            raise ValueError('chrom_aliases must be True, False or a dict')
+        self.tracks          = list(tracks)
+        self._aliases        = chrom_aliases
+        self._unknown_chroms = Counter()
+        self._not_found      = {track: Counter() for track in self.tracks}
+        self._stats_lock     = threading.Lock()
+        self._threads        = None
+
+        # Tracks are added one after the other, so the file order of every
+        # interval also tells which track it is from
+        data       = defaultdict(Chrom)
+        track_ends = {}
+        interned   = {}
+        for k, bedfile in enumerate(tracks.values()):
+            for names, chunk in _parse_bed(bedfile, workers):
+                names = [interned.setdefault(i, i) for i in names]
+                for chrom, (starts, ends, ids) in chunk.items():
+                    data[chrom].extend(starts, ends, ids, names)
+            for chrom, index in data.items():
+                if chrom not in track_ends:
+                    track_ends[chrom] = np.zeros(len(tracks), dtype=np.int64)
+                track_ends[chrom][k:] = len(index)
+
+        self._data   = {}
+        self._tracks = {}
+        self._coords = {}
+        for chrom, index in data.items():
+            index.build()
+            starts, ends, _, order, _ = index.arrays()
+            self._data[chrom]   = index
+            self._tracks[chrom] = np.searchsorted(
+                track_ends[chrom], order, side='right').astype(np.int32)
+            self._coords[chrom] = (starts, ends)
+        self._index_chromosomes(self._data)
+
+    def lookup(self, chromosome, location):
+        """Return the name of the first gene containing location in every
+        track, or None, as a dictionary by track."""
+        return {track: names[0] for track, names in
+                self.lookup_many([chromosome], [location]).items()}
+
+    def lookup_many(self, chromosomes, locations, n_threads=1):
+        """Lookup many positions in every track at once.
+
+        Takes the same arguments as BedFile.lookup_many().
+
+        Returns:
+            OrderedDict: An object array of gene names aligned to the input
+                         for every track, None where the lookup failed.
+        """
+        parts = self._run_batch(self._lookup_many, chromosomes, locations,
+                                n_threads)
+        if len(parts) == 1:
+            return parts[0]
+        return OrderedDict((track, np.concatenate([i[track] for i in parts]))
+                           for track in self.tracks)
+
+    def _lookup_many(self, codes, chroms, locations):
+        """Resolve one batch of lookup_many() in the calling thread."""
+        result = OrderedDict((track, np.full(len(locations), None,
+                                             dtype=object))
+                             for track in self.tracks)
+        for chrom, indices, best in self._find_tracks(codes, chroms,
+                                                      locations):
+            index = self._data[chrom]
+            for track, hits in zip(self.tracks, best):
+                found = hits >= 0
+                result[track][indices[found]] = index._take(hits[found])
+        return result
+
+    def lookup_columns(self, chromosomes, locations, n_threads=1):
+        """Lookup many positions in every track at once, as columns.
+
+        Takes the same arguments as BedFile.lookup_many(). Positions are
+        grouped by chromosome and searched once for all tracks.
+
+        Returns:
+            OrderedDict: (codes, names, starts, ends) for every track, as
+                         returned by BedFile.lookup_columns()
+        """
+        parts = self._run_batch(self._lookup_columns, chromosomes, locations,
+                                n_threads)
+        if len(parts) == 1:
+            return parts[0]
+        result = OrderedDict()
+        for track in self.tracks:
+            columns      = [i[track] for i in parts]
+            codes, names = _merge_codes([i[:2] for i in columns])
+            result[track] = (np.concatenate(codes), names,
+                             np.concatenate([i[2] for i in columns]),
+                             np.concatenate([i[3] for i in columns]))
+        return result
+
+    def _lookup_columns(self, codes, chroms, locations):
+        """Resolve one batch of lookup_columns() in the calling thread."""
+        n        = len(locations)
+        n_tracks = len(self.tracks)
+        starts   = np.full((n_tracks, n), -1, dtype=np.int64)
+        ends     = np.full((n_tracks, n), -1, dtype=np.int64)
+        groups   = []
+        parts    = [[] for _ in self.tracks]
+        for chrom, indices, best in self._find_tracks(codes, chroms,
+                                                      locations):
+            index = self._data[chrom]
+            chrom_starts, chrom_ends = self._coords[chrom]
+            groups.append(indices)
+            for k, hits in enumerate(best):
+                found     = hits >= 0
+                hit_codes = np.full(len(hits), -1, dtype=np.int32)
+                hit_codes[found], names = index._codes(hits[found])
+                starts[k, indices[found]] = chrom_starts[hits[found]]
+                ends[k, indices[found]]   = chrom_ends[hits[found]]
+                parts[k].append((hit_codes, names))
+        result = OrderedDict()
+        for k, track in enumerate(self.tracks):
+            merged, names = _merge_codes(parts[k])
+            track_codes   = np.full(n, -1, dtype=np.int32)
+            for indices, hit_codes in zip(groups, merged):
+                track_codes[indices] = hit_codes
+            result[track] = (track_codes, names, starts[k], ends[k])
+        return result
+
+    def _find_tracks(self, codes, chroms, locations):
+        """Yield (chromosome, indices, hits) for every chromosome in a batch.
+
+        hits holds the first hit of every track for the positions at
+        indices, see _Index.find_tracks(). Positions without a hit are
+        counted in stats().
+        """
+        for chrom, indices in _group_by_chrom(codes, chroms):
+            best = self._data[chrom].find_tracks(
+                locations[indices], self._tracks[chrom], len(self.tracks))
+            for track, misses in zip(self.tracks, (best < 0).sum(axis=1)):
+                if misses:
+                    self._miss_location(track, chrom, misses)
+            yield chrom, indices, best
+
+    def lookup_df(self, df, chrom_col, pos_col, n_threads=1, output='object',
+                  coordinates=False):
+        """Annotate a dataframe with one column per track.
+
+        Takes the same arguments as BedFile.lookup_df().
+
+        Returns:
+            DataFrame: A column of gene names for every track, named after
+                       the track, with the same index as df. With
+                       coordinates, also <track>_start and <track>_end
+                       columns. With output='arrow', a pyarrow Table of the
+                       same columns.
+        """
+        if output not in _outputs:
+            raise ValueError('output must be one of ' + ', '.join(_outputs))
+        if output == 'object' and not coordinates:
+            import pandas as pd
+            index = getattr(df, 'index', None)
+            return pd.DataFrame(OrderedDict(
+                (track, pd.Series(names, index=index, dtype=object))
+                for track, names in self.lookup_many(
+                    df[chrom_col], df[pos_col], n_threads).items()),
+                index=index)
+        columns = self.lookup_columns(df[chrom_col], df[pos_col], n_threads)
+        result  = OrderedDict()
+        if output == 'arrow':
+            import pyarrow as pa
+            for track, track_columns in columns.items():
+                table = _arrow_columns(*track_columns, coordinates=True)
+                result[track] = table.column('name').combine_chunks()
+                if coordinates:
+                    result[track + '_start'] = table.column('start')
+                    result[track + '_end']   = table.column('end')
+            return pa.table(result)
+
+        import pandas as pd
+        index = getattr(df, 'index', None)
+        for track, (codes, names, starts, ends) in columns.items():
+            if output == 'category':
+                result[track] = pd.Categorical.from_codes(codes, names)
+            else:
+                result[track] = pd.Series(_names_array(codes, names),
+                                          index=index, dtype=object)
+            if coordinates:
+                missing = codes < 0
+                result[track + '_start'] = pd.arrays.IntegerArray(starts,
+                                                                  missing)
+                result[track + '_end']   = pd.arrays.IntegerArray(ends,
+                                                                  missing)
+        return pd.DataFrame(result, index=index)
+
+    def stats(self):
+        """Return counts of failed lookups.
+
+        Returns:
+            dict: 'unknown_chromosome' maps each chromosome that is in no
+                  track to the number of lookups on it, 'not_found' maps
+                  every track to the number of positions on each
+                  chromosome that were not in any of its intervals.
+        """
+        return {'unknown_chromosome': dict(self._unknown_chroms),
+                'not_found': {track: dict(counts) for track, counts in
+                              self._not_found.items()}}
+
+    def reset_stats(self):
+        """Zero the failed lookup counters."""
+        with self._stats_lock:
+            self._unknown_chroms.clear()
+            for counts in self._not_found.values():
+                counts.clear()
+
+    def _miss_location(self, track, chromosome, count=1):
+        """Count positions that are not in any interval of a track."""
+        with self._stats_lock:
+            self._not_found[track][chromosome] += int(count)
+
+    def __len__(self):
+        return len(self.tracks)
+
+    def __getstate__(self):
+        """Drop the lock and the threads, which cannot be pickled."""
+        state = self.__dict__.copy()
+        state.pop('_stats_lock', None)
+        state.pop('_threads', None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._stats_lock = threading.Lock()
+        self._threads    = None
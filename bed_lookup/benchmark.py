@@ -0,0 +1,315 @@
+"""
+Benchmark BedFile load and lookup speed across backends.
+
+Generates a synthetic bed file, bgzipped and tabix indexed too if pysam or
+the htslib bgzip and tabix tools are installed, then for every backend times
+opening it, single lookups, lookup_many and lookup_df (if pandas is
+installed), and records the peak memory use. Each backend is run in its own
+process so the peak memory figures are independent. Results are written as
+JSON so runs of different versions can be compared.
+
+Everything runs offline, the only input is the random seed.
+
+Usage:
+    python -m bed_lookup.benchmark --lines 1000000 --output bench.json
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import subprocess
+import resource
+import argparse
+import tempfile
+import multiprocessing
+
+import numpy as np
+
+from . import __version__
+
+__all__ = ['generate_bed', 'run', 'BACKENDS']
+
+BACKENDS = ['dict', 'sqlite', 'mmap', 'tabix']
+
+LENGTH_DISTRIBUTIONS = ['fixed', 'uniform', 'lognormal']
+
+
+def generate_bed(path, lines, chroms=24, length=1000,
+                 distribution='lognormal', density=0.5, seed=1):
+    """Write a random bed file.
+
+    Args:
+        path (str):         Where to write the bed file
+        lines (int):        Number of intervals
+        chroms (int):       Number of chromosomes to spread them over
+        length (int):       Mean interval length
+        distribution (str): Interval length distribution, one of fixed,
+                            uniform (1 to 2*length) or lognormal
+        density (float):    Mean number of intervals covering each position,
+                            sets the chromosome length
+        seed (int):         Random seed
+
+    Returns:
+        int: The length of each chromosome
+    """
+    rng       = np.random.RandomState(seed)
+    chrom_len = max(int(lines * length / (density * chroms)), length + 1)
+    per_chrom = np.bincount(rng.randint(0, chroms, lines), minlength=chroms)
+    with open(path, 'w') as fout:
+        for c, n in enumerate(per_chrom):
+            if distribution == 'fixed':
+                lengths = np.full(n, length, dtype=np.int64)
+            elif distribution == 'uniform':
+                lengths = rng.randint(1, 2*length + 1, n)
+            elif distribution == 'lognormal':
+                lengths = np.maximum(rng.lognormal(np.log(length) - 0.5, 1.0,
+                                                   n).astype(np.int64), 1)
+            else:
+                raise ValueError('Unknown distribution ' + distribution)
+            starts = np.sort(rng.randint(0, chrom_len, n))
+            fout.writelines(['chr{}\t{}\t{}\tgene{}\n'.format(c + 1, s, s + l,
+                                                              i)
+                             for i, (s, l) in enumerate(zip(starts,
+                                                            lengths))])
+    return chrom_len
+
+
+def run(lines=100000, queries=100000, single=10000, length=1000,
+        distribution='lognormal', density=0.5, chroms=24, backends=None,
+        seed=1, workdir=None, workers=1):
+    """Run the benchmark and return the results as a dictionary.
+
+    Args:
+        lines (int):        Intervals in the synthetic bed file
+        queries (int):      Positions for the batch lookups
+        single (int):       Positions for the single lookup timing
+        length (int):       Mean interval length
+        distribution (str): Interval length distribution
+        density (float):    Mean intervals covering each position
+        chroms (int):       Number of chromosomes
+        backends (list):    Backends to run, default all of BACKENDS
+        seed (int):         Random seed
+        workdir (str):      Directory for the bed file and indices, default
+                            a temporary directory that is removed after
+        workers (int):      Processes to parse the bed file with
+    """
+    params  = {'lines': lines, 'queries': queries, 'single': single,
+               'length': length, 'distribution': distribution,
+               'density': density, 'chroms': chroms, 'seed': seed,
+               'workers': workers}
+    tmpdir  = workdir or tempfile.mkdtemp(prefix='bed_lookup_bench')
+    bedfile = os.path.join(tmpdir, 'bench.bed')
+    results = {}
+    try:
+        start     = time.time()
+        chrom_len = generate_bed(bedfile, lines, chroms, length,
+                                 distribution, density, seed)
+        params['generate_seconds'] = time.time() - start
+        params['bed_bytes']        = os.path.getsize(bedfile)
+
+        rng         = np.random.RandomState(seed + 1)
+        chromosomes = np.array(['chr{}'.format(i + 1) for i in
+                                rng.randint(0, chroms, queries)],
+                               dtype=object)
+        positions   = rng.randint(0, chrom_len, queries)
+
+        backends = backends or BACKENDS
+        tabixed  = None
+        if 'tabix' in backends:
+            start   = time.time()
+            tabixed = _bgzip_index(bedfile)
+            if tabixed:
+                params['tabix_seconds'] = time.time() - start
+
+        # Fork a fresh process per backend so peak RSS is per backend
+        ctx = multiprocessing.get_context('fork')
+        for backend in backends:
+            if backend == 'tabix' and not tabixed:
+                results[backend] = {'error': 'bgzipping needs pysam or ' +
+                                             'the htslib bgzip and tabix ' +
+                                             'tools'}
+                continue
+            queue = ctx.Queue()
+            proc  = ctx.Process(target=_run_backend,
+                                args=(queue, backend,
+                                      tabixed if backend == 'tabix' else
+                                      bedfile, chromosomes, positions,
+                                      single, workers))
+            proc.start()
+            results[backend] = queue.get()
+            proc.join()
+    finally:
+        if not workdir:
+            shutil.rmtree(tmpdir)
+
+    return {'bed_lookup_version': __version__,
+            'python': sys.version.split()[0],
+            'platform': platform.platform(),
+            'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'params': params,
+            'results': results}
+
+
+###############################################################################
+#                              Private Functions                              #
+###############################################################################
+
+
+def _run_backend(queue, backend, bedfile, chromosomes, positions, single,
+                 workers=1):
+    """Time one backend and put a dictionary of results on queue."""
+    try:
+        queue.put(_time_backend(backend, bedfile, chromosomes, positions,
+                                single, workers))
+    except Exception as e:
+        queue.put({'error': '{}: {}'.format(type(e).__name__, e)})
+
+
+def _time_backend(backend, bedfile, chromosomes, positions, single,
+                  workers=1):
+    """Return timings and peak memory for one backend."""
+    from . import _bed_lookup
+    from ._bed_lookup import BedFile, compile_index
+
+    result = {}
+    _bed_lookup.logme.MIN_LEVEL = 'warn'
+
+    # Import pandas and touch numpy before the baseline, so the memory
+    # figures only count the backend
+    try:
+        import pandas as pd
+    except ImportError:
+        pd = None
+    else:
+        pd.DataFrame({'chrom': chromosomes[:10], 'pos': positions[:10]})
+    np.unique(chromosomes[:10])
+    np.argsort(positions[:10])
+    base_rss = _peak_rss()
+    result['base_rss_bytes'] = base_rss
+
+    path = bedfile
+    if backend == 'mmap':
+        start = time.time()
+        path  = compile_index(bedfile, workers=workers)
+        result['build_seconds'] = time.time() - start
+
+    start = time.time()
+    b     = BedFile(path, backend=backend, workers=workers)
+    result['init_seconds'] = time.time() - start
+    if backend == 'sqlite':
+        # Time opening the database that was just built as well
+        del b
+        start = time.time()
+        b     = BedFile(bedfile + '.db', backend=backend)
+        result['open_seconds'] = time.time() - start
+    result['init_rss_increase'] = _peak_rss() - base_rss
+
+    n     = min(single, len(positions))
+    start = time.time()
+    for chrom, pos in zip(chromosomes[:n], positions[:n]):
+        b.lookup(chrom, pos)
+    elapsed = time.time() - start
+    result['lookup_per_second'] = n/elapsed if elapsed else None
+
+    # Warm up
+    b.lookup_many(chromosomes[:10], positions[:10])
+    start = time.time()
+    b.lookup_many(chromosomes, positions)
+    elapsed = time.time() - start
+    result['lookup_many_seconds']    = elapsed
+    result['lookup_many_per_second'] = (len(positions)/elapsed if elapsed
+                                        else None)
+
+    if pd is None:
+        result['lookup_df_seconds'] = None
+    else:
+        df    = pd.DataFrame({'chrom': chromosomes, 'pos': positions})
+        start = time.time()
+        b.lookup_df(df, 'chrom', 'pos')
+        result['lookup_df_seconds'] = time.time() - start
+
+    result['peak_rss_bytes']      = _peak_rss()
+    result['peak_rss_increase']   = result['peak_rss_bytes'] - base_rss
+    return result
+
+
+def _bgzip_index(bedfile):
+    """Write a bgzipped, tabix indexed copy of bedfile.
+
+    Uses pysam if it is installed, otherwise the htslib command line tools.
+
+    Returns:
+        str: The path to the bgzipped file, None if neither is available
+    """
+    try:
+        import pysam
+    except ImportError:
+        pysam = None
+    if pysam is not None:
+        return pysam.tabix_index(bedfile, preset='bed', force=True,
+                                 keep_original=True)
+    if not (shutil.which('bgzip') and shutil.which('tabix')):
+        return None
+    with open(bedfile, 'rb') as fin, open(bedfile + '.gz', 'wb') as fout:
+        subprocess.check_call(['bgzip', '-c'], stdin=fin, stdout=fout)
+    subprocess.check_call(['tabix', '-f', '-p', 'bed', bedfile + '.gz'])
+    return bedfile + '.gz'
+
+
+def _peak_rss():
+    """Return the peak resident set size of this process in bytes."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def _get_args(argv=None):
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-n', '--lines', type=int, default=100000,
+                        help="Intervals in the synthetic bed file")
+    parser.add_argument('-q', '--queries', type=int, default=100000,
+                        help="Positions for the batch lookups")
+    parser.add_argument('-s', '--single', type=int, default=10000,
+                        help="Positions for timing single lookups")
+    parser.add_argument('-l', '--length', type=int, default=1000,
+                        help="Mean interval length")
+    parser.add_argument('--distribution', default='lognormal',
+                        choices=LENGTH_DISTRIBUTIONS,
+                        help="Interval length distribution")
+    parser.add_argument('--density', type=float, default=0.5,
+                        help="Mean intervals covering each position")
+    parser.add_argument('--chroms', type=int, default=24,
+                        help="Number of chromosomes")
+    parser.add_argument('-b', '--backends', nargs='+', choices=BACKENDS,
+                        help="Backends to benchmark, default all")
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help="Processes to parse the bed file with")
+    parser.add_argument('--seed', type=int, default=1, help="Random seed")
+    parser.add_argument('--workdir',
+                        help="Keep the bed file and indices here")
+    parser.add_argument('-o', '--output',
+                        help="Write JSON results here, default STDOUT")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """Run the benchmark from the command line."""
+    args    = _get_args(argv)
+    results = run(args.lines, args.queries, args.single, args.length,
+                  args.distribution, args.density, args.chroms,
+                  args.backends, args.seed, args.workdir, args.workers)
+    out = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as fout:
+            fout.write(out + '\n')
+    else:
+        sys.stdout.write(out + '\n')
+
+
+if __name__ == '__main__':
+    main()
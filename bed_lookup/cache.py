@@ -0,0 +1,173 @@
+"""
+On-disk cache of compiled bed indices.
+
+Parsing a bed file into the in-memory backend is repeated by every process
+that opens it. With caching enabled, BedFile writes the parsed index to a
+cache directory in the memory mapped format of compile_index(), and later
+processes map it instead of parsing the bed file again.
+
+Every entry is a pair of files named after a hash of the absolute bed path:
+the index itself (<key>.bidx) and a small JSON record (<key>.json) of the size
+and modification time of the bed file, and optionally the SHA1 of its
+contents. An entry is only used if these still match the bed file. The
+modification time of the record is touched whenever the entry is used, and
+least recently used entries are evicted once the cache grows past its size
+limit.
+"""
+import os
+import json
+import hashlib
+
+__all__ = ['DEFAULT_DIR', 'MAX_SIZE', 'find', 'index_path', 'store', 'evict',
+           'clear']
+
+DEFAULT_DIR = os.path.join(
+    os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')),
+    'bed_lookup')
+
+# Maximum total size of a cache directory in bytes
+MAX_SIZE = 10*1024**3
+
+_index_ext  = '.bidx'
+_record_ext = '.json'
+
+
+def index_path(bedfile, cache_dir=None):
+    """Return the path the cached index of bedfile is stored at."""
+    return _key_path(bedfile, cache_dir) + _index_ext
+
+
+def find(bedfile, cache_dir=None, check_hash=False):
+    """Return the path to a valid cached index of bedfile, or None.
+
+    Stale entries for bedfile are removed.
+
+    Args:
+        bedfile (str):     The bed file
+        cache_dir (str):   The cache directory, default DEFAULT_DIR
+        check_hash (bool): Also compare the SHA1 of the bed file contents,
+                           entries stored without one are not used
+    """
+    key    = _key_path(bedfile, cache_dir)
+    record = _read_record(key + _record_ext)
+    if not record or not os.path.isfile(key + _index_ext):
+        return None
+    if check_hash and 'sha1' not in record:
+        # Stored without a hash, so the contents cannot be checked; the
+        # entry is rewritten with one when the bed file is parsed again
+        return None
+    if not check_hash:
+        record.pop('sha1', None)
+    if record != _fingerprint(bedfile, check_hash):
+        _remove(key)
+        return None
+    os.utime(key + _record_ext, None)
+    return key + _index_ext
+
+
+def store(bedfile, cache_dir=None, check_hash=False, max_size=MAX_SIZE):
+    """Record the index written to index_path() as valid, then evict.
+
+    Args:
+        bedfile (str):     The bed file
+        cache_dir (str):   The cache directory, default DEFAULT_DIR
+        check_hash (bool): Store the SHA1 of the bed file contents too
+        max_size (int):    Evict entries until the cache is under this many
+                           bytes
+    """
+    key = _key_path(bedfile, cache_dir)
+    tmp = key + _record_ext + '.tmp'
+    with open(tmp, 'w') as fout:
+        json.dump(_fingerprint(bedfile, check_hash), fout)
+    os.rename(tmp, key + _record_ext)
+    evict(cache_dir, max_size, keep=key)
+
+
+def evict(cache_dir=None, max_size=MAX_SIZE, keep=None):
+    """Remove stale entries, then the least recently used until the cache is
+    smaller than max_size bytes.
+
+    Args:
+        cache_dir (str): The cache directory, default DEFAULT_DIR
+        max_size (int):  The size limit in bytes
+        keep (str):      The key path of an entry never to evict
+    """
+    cache_dir = cache_dir or DEFAULT_DIR
+    entries   = []
+    for name in os.listdir(cache_dir):
+        if not name.endswith(_record_ext):
+            continue
+        key    = os.path.join(cache_dir, name[:-len(_record_ext)])
+        record = _read_record(key + _record_ext)
+        if (not record or not os.path.isfile(key + _index_ext) or
+                not os.path.isfile(record['path']) or
+                os.path.getsize(record['path']) != record['size'] or
+                os.stat(record['path']).st_mtime_ns != record['mtime']):
+            if key != keep:
+                _remove(key)
+            continue
+        entries.append((os.path.getmtime(key + _record_ext),
+                        os.path.getsize(key + _index_ext), key))
+    total = sum(i[1] for i in entries)
+    for _, size, key in sorted(entries):
+        if total <= max_size:
+            break
+        if key != keep:
+            _remove(key)
+            total -= size
+
+
+def clear(cache_dir=None):
+    """Remove every entry from a cache directory."""
+    cache_dir = cache_dir or DEFAULT_DIR
+    for name in os.listdir(cache_dir):
+        if name.endswith(_record_ext):
+            _remove(os.path.join(cache_dir, name[:-len(_record_ext)]))
+
+
+###############################################################################
+#                              Private Functions                              #
+###############################################################################
+
+
+def _key_path(bedfile, cache_dir):
+    """Return the path of an entry without extension, creating the dir."""
+    cache_dir = cache_dir or DEFAULT_DIR
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    bedfile = os.path.abspath(bedfile)
+    digest  = hashlib.sha1(bedfile.encode()).hexdigest()[:16]
+    return os.path.join(cache_dir, '{}.{}'.format(os.path.basename(bedfile),
+                                                  digest))
+
+
+def _fingerprint(bedfile, check_hash=False):
+    """Return a dictionary identifying the current contents of bedfile."""
+    stat   = os.stat(bedfile)
+    record = {'path': os.path.abspath(bedfile), 'size': stat.st_size,
+              'mtime': stat.st_mtime_ns}
+    if check_hash:
+        sha1 = hashlib.sha1()
+        with open(bedfile, 'rb') as fin:
+            for block in iter(lambda: fin.read(1 << 20), b''):
+                sha1.update(block)
+        record['sha1'] = sha1.hexdigest()
+    return record
+
+
+def _read_record(path):
+    """Return the JSON record at path, or None if missing or corrupt."""
+    try:
+        with open(path) as fin:
+            return json.load(fin)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def _remove(key):
+    """Delete both files of a cache entry."""
+    for ext in (_index_ext, _record_ext):
+        try:
+            os.remove(key + ext)
+        except OSError:
+            pass
@@ -0,0 +1,220 @@
+"""
+Opt-in instrumentation of a BedFile.
+
+BedFile(profile=True) times the phases of opening the bed file (sampling
+it, reading and decompressing, parsing, building the index or database),
+and records the number of calls and a latency histogram for every lookup
+method and for the sqlite queries behind them. Everything is reported under
+the 'profile' key of BedFile.stats(), along with backend statistics.
+
+Lookup methods are timed by wrapping them on the BedFile instance, so a
+BedFile opened without profile=True runs exactly the same code as before.
+Phases that run in parallel workers are summed over the workers, so they
+can add up to more than the wall clock 'load' phase.
+"""
+import time
+import threading
+from functools import wraps
+from contextlib import contextmanager
+from collections import OrderedDict
+
+__all__ = ['Profiler', 'Histogram', 'NULL']
+
+# Latency buckets are powers of two of microseconds, the last one holds
+# everything from about 9 minutes up
+_buckets = 30
+
+
+class Histogram(object):
+
+    """Counts of durations in power of two microsecond buckets."""
+
+    def __init__(self):
+        self.counts  = [0]*_buckets
+        self.calls   = 0
+        self.items   = 0
+        self.seconds = 0.0
+        self.max     = 0.0
+
+    def record(self, seconds, items=1):
+        """Add one call that took seconds and handled items positions."""
+        bucket = min(int(seconds*1e6).bit_length(), _buckets - 1)
+        self.counts[bucket] += 1
+        self.calls   += 1
+        self.items   += items
+        self.seconds += seconds
+        self.max      = max(self.max, seconds)
+
+    def percentile(self, fraction):
+        """Return the upper bound in microseconds of a percentile."""
+        if not self.calls:
+            return 0
+        target = fraction*self.calls
+        seen   = 0
+        for bucket, count in enumerate(self.counts):
+            seen += count
+            if seen >= target:
+                return 1 << bucket
+        return 1 << (_buckets - 1)
+
+    def as_dict(self):
+        """Return a JSON serialisable summary.
+
+        Percentiles are the upper bound of the bucket they fall in, buckets
+        is a list of [upper bound in microseconds, calls] for every bucket
+        that is not empty.
+        """
+        return {'calls': self.calls, 'items': self.items,
+                'total_seconds': self.seconds,
+                'mean_us': self.seconds*1e6/self.calls if self.calls else 0,
+                'max_us': self.max*1e6,
+                'p50_us': self.percentile(0.5),
+                'p90_us': self.percentile(0.9),
+                'p99_us': self.percentile(0.99),
+                'buckets': [[1 << i, c] for i, c in enumerate(self.counts)
+                            if c]}
+
+    def merge(self, summary):
+        """Add the counts from an as_dict() summary."""
+        for upper, count in summary['buckets']:
+            self.counts[upper.bit_length() - 1] += count
+        self.calls   += summary['calls']
+        self.items   += summary['items']
+        self.seconds += summary['total_seconds']
+        self.max      = max(self.max, summary['max_us']/1e6)
+
+
+class Profiler(object):
+
+    """Phase timers, counters and latency histograms, safe to share between
+    threads. Copies made by pickling start empty."""
+
+    enabled = True
+
+    def __init__(self):
+        self.phases     = OrderedDict()
+        self.counters   = OrderedDict()
+        self.histograms = OrderedDict()
+        self._lock      = threading.Lock()
+
+    @contextmanager
+    def phase(self, name):
+        """Time the body of a with statement as phase name."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_phase(name, time.perf_counter() - start)
+
+    def add_phase(self, name, seconds):
+        """Add seconds to the time spent in a phase."""
+        with self._lock:
+            self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def count(self, name, n=1):
+        """Add n to a counter."""
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def histogram(self, name):
+        """Return the latency histogram called name, creating it."""
+        with self._lock:
+            if name not in self.histograms:
+                self.histograms[name] = Histogram()
+            return self.histograms[name]
+
+    def wrap(self, name, func, items=None):
+        """Return func, recording every call in the histogram name.
+
+        Args:
+            name (str):      The histogram
+            func (callable): The function to time
+            items (int):     The positional argument holding the batch of
+                             positions, its length is recorded as the number
+                             of items. Default one item per call.
+        """
+        histogram = self.histogram(name)
+        lock      = self._lock
+
+        @wraps(func)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                n = (len(args[items]) if items is not None and
+                     len(args) > items else 1)
+                with lock:
+                    histogram.record(elapsed, n)
+        return timed
+
+    def as_dict(self):
+        """Return a JSON serialisable summary of everything recorded,
+        leaving out histograms of functions that were never called."""
+        with self._lock:
+            return {'phases': dict(self.phases),
+                    'counters': dict(self.counters),
+                    'latency': {name: h.as_dict() for name, h in
+                                self.histograms.items() if h.calls}}
+
+    def merge(self, summary):
+        """Add the counters and histograms of an as_dict() summary, e.g. from
+        another process. Phases are not merged, they describe how this
+        process loaded the bed file."""
+        for name, n in summary.get('counters', {}).items():
+            self.count(name, n)
+        for name, latency in summary.get('latency', {}).items():
+            histogram = self.histogram(name)
+            with self._lock:
+                histogram.merge(latency)
+
+    def reset(self):
+        """Zero the counters and histograms, keeping the load phases."""
+        with self._lock:
+            self.counters.clear()
+            for name in self.histograms:
+                self.histograms[name].__init__()
+
+    def __reduce__(self):
+        return Profiler, ()
+
+
+###############################################################################
+#                              Private Functions                              #
+###############################################################################
+
+
+class _NullProfiler(object):
+
+    """Stands in for a Profiler when profiling is disabled."""
+
+    enabled = False
+
+    def phase(self, name):
+        return _null_phase
+
+    def add_phase(self, name, seconds):
+        pass
+
+    def count(self, name, n=1):
+        pass
+
+    def __reduce__(self):
+        return 'NULL'
+
+
+class _NullPhase(object):
+
+    """A do nothing context manager."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+_null_phase = _NullPhase()
+
+NULL = _NullProfiler()
@@ -45,7 +45,7 @@ import bz2
 import logging
 from datetime import datetime as dt
 
-__all__ = ['log', 'MIN_LEVEL', 'LOGFILE']
+__all__ = ['log', 'enabled', 'MIN_LEVEL', 'LOGFILE']
 
 ###################################
 #  Constants for printing colors  #
@@ -60,6 +60,22 @@ ENDC   = '\033[0m'
 MIN_LEVEL = 'info'
 LOGFILE   = sys.stderr
 
+LEVELS = {'debug': 1, 'info': 2, 'warn': 3, 'error': 4, 'critical': 5,
+          'd': 1, 'i': 2, 'w': 3, 'e': 4, 'c': 5,
+          0: 1, 1: 2, 2: 3, 3: 4, 4: 5}
+
+
+def enabled(level):
+    """Return True if a message at level would be printed.
+
+    Use to skip building expensive messages that would be discarded.
+    Always True when LOGFILE is a logging object, as those filter
+    themselves.
+    """
+    if isinstance(LOGFILE, (logging.RootLogger, logging.Logger)):
+        return True
+    return LEVELS[level] >= LEVELS[MIN_LEVEL]
+
 
 def log(message, level='info', logfile=None, also_write=None,
         min_level=None, kind=None):
@@ -95,9 +111,7 @@ def log(message, level='info', logfile=None, also_write=None,
     min_level = min_level if min_level else MIN_LEVEL
 
     # Level checking, not used with logging objects
-    level_map = {'debug': 1, 'info': 2, 'warn': 3, 'error': 4, 'critical': 5,
-                 'd': 1, 'i': 2, 'w': 3, 'e': 4, 'c': 5,
-                 0: 1, 1: 2, 2: 3, 3: 4, 4: 5}
+    level_map = LEVELS
 
     try:
         level = level_map[level]
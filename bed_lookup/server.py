@@ -0,0 +1,339 @@
+"""
+Serve lookups from one BedFile to many processes over a socket.
+
+The bed file is loaded once by a long running asyncio server, clients in
+other processes then query it over a Unix or TCP socket with LookupClient,
+which has the same lookup interface as BedFile. Lookup requests that arrive
+while a batch is being resolved are coalesced into a single lookup_many()
+call, so many small clients cost little more than one large one.
+
+Every message is a frame of a 9 byte header, the payload length (uint32),
+an operation or status code (uint8) and a request id (uint32), all big
+endian, followed by the payload. Lookup payloads carry the chromosomes as
+one newline separated string and the positions as little endian int64, the
+replies carry a byte per position that is 1 if it was found, and the names
+as one newline separated string.
+
+Usage:
+    bed_location_lookup annotation.bed --serve /tmp/annotation.sock
+
+    from bed_lookup.server import LookupClient
+    client = LookupClient('/tmp/annotation.sock')
+    client.lookup('chr1', 10003021)
+"""
+import os
+import json
+import signal
+import socket
+import struct
+import asyncio
+import threading
+
+import numpy as np
+
+from . import logme
+
+__all__ = ['serve', 'start_server', 'LookupClient', 'ServerError',
+           'parse_address']
+
+# Payload length, op or status, request id
+_header = struct.Struct('!IBI')
+
+_op_lookup  = 1
+_op_overlap = 2
+_op_stats   = 3
+
+_status_ok    = 0
+_status_error = 1
+
+# Most positions resolved by one lookup_many() call
+MAX_BATCH = 1000000
+
+# Batches smaller than this are resolved on the event loop, larger ones in
+# a thread so the server keeps reading requests meanwhile
+_inline_batch = 4096
+
+
+class ServerError(ValueError):
+
+    """Raised by LookupClient when the server could not answer a request."""
+
+    pass
+
+
+def parse_address(address):
+    """Return (socket family, address) for a socket path or host:port.
+
+    Args:
+        address (str/tuple): A Unix socket path, 'host:port', ':port' or a
+                             (host, port) tuple
+    """
+    if isinstance(address, tuple):
+        return socket.AF_INET, address
+    host, _, port = address.rpartition(':')
+    if port.isdigit() and '/' not in address:
+        return socket.AF_INET, (host or 'localhost', int(port))
+    return socket.AF_UNIX, address
+
+
+async def start_server(bed, address, max_batch=MAX_BATCH):
+    """Start serving bed on address from the running event loop.
+
+    Args:
+        bed (BedFile):   The open bed file to serve
+        address (str):   A Unix socket path or host:port, see parse_address()
+        max_batch (int): Most positions to coalesce into one lookup
+
+    Returns:
+        asyncio.Server: The running server, close() it to stop
+    """
+    handler = _Handler(bed, max_batch)
+    family, address = parse_address(address)
+    if family == socket.AF_UNIX:
+        server = await asyncio.start_unix_server(handler.handle, address)
+    else:
+        server = await asyncio.start_server(handler.handle, *address)
+    handler.batcher = asyncio.ensure_future(handler.run_batches())
+    return server
+
+
+def serve(bed, address, max_batch=MAX_BATCH):
+    """Serve bed on address until interrupted.
+
+    Args:
+        bed (BedFile):   The open bed file to serve
+        address (str):   A Unix socket path or host:port, see parse_address()
+        max_batch (int): Most positions to coalesce into one lookup
+    """
+    async def run():
+        server = await start_server(bed, address, max_batch)
+        logme.log('Serving lookups on {}\n'.format(address), level='info')
+        # Shut down cleanly on SIGTERM, so the socket file is removed
+        try:
+            asyncio.get_running_loop().add_signal_handler(signal.SIGTERM,
+                                                          server.close)
+        except (NotImplementedError, RuntimeError):
+            pass
+        async with server:
+            try:
+                await server.serve_forever()
+            except asyncio.CancelledError:
+                pass
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        family, path = parse_address(address)
+        if family == socket.AF_UNIX and os.path.exists(path):
+            os.remove(path)
+
+
+class LookupClient(object):
+
+    """Query a lookup server with the lookup interface of BedFile.
+
+    A client holds one connection and can be shared between threads, but
+    requests from different threads are answered one at a time. Open a
+    client per thread for concurrent requests.
+    """
+
+    def __init__(self, address, timeout=None):
+        """Connect to a server.
+
+        Args:
+            address (str):   A Unix socket path or host:port
+            timeout (float): Seconds to wait for a reply before raising
+                             socket.timeout, default is to wait forever
+        """
+        family, address = parse_address(address)
+        self._sock = socket.socket(family, socket.SOCK_STREAM)
+        self._sock.settimeout(timeout)
+        self._sock.connect(address)
+        if family == socket.AF_INET:
+            self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._reader  = self._sock.makefile('rb')
+        self._lock    = threading.Lock()
+        self._next_id = 0
+
+    def lookup(self, chromosome, location):
+        """Return the name of the first gene containing location, or None."""
+        return self.lookup_many([chromosome], [location])[0]
+
+    def lookup_many(self, chromosomes, locations):
+        """Lookup many positions at once, see BedFile.lookup_many().
+
+        Returns:
+            ndarray: An object array of gene names aligned to the input, None
+                     where the lookup failed.
+        """
+        locations = np.asarray(locations, dtype=np.int64)
+        if len(chromosomes) != len(locations):
+            raise ValueError('chromosomes and locations must be the same ' +
+                             'length')
+        return _unpack_names(self._request(
+            _op_lookup, _pack_lookup(chromosomes, locations)))
+
+    def lookup_all(self, chromosome, location):
+        """Return the names of every gene containing location."""
+        location = int(location)
+        return self.overlap(chromosome, location, location + 1)
+
+    def overlap(self, chromosome, start, end):
+        """Return the names of all genes overlapping [start, end)."""
+        return list(_unpack_names(self._request(
+            _op_overlap,
+            struct.pack('<qq', int(start), int(end)) + chromosome.encode())))
+
+    def stats(self):
+        """Return the failed lookup counts of the server's BedFile."""
+        return json.loads(self._request(_op_stats, b'').decode())
+
+    def close(self):
+        """Close the connection."""
+        self._reader.close()
+        self._sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _request(self, op, payload):
+        """Send a request and return the payload of the reply."""
+        with self._lock:
+            self._next_id = (self._next_id + 1) & 0xffffffff
+            self._sock.sendall(_header.pack(len(payload), op, self._next_id) +
+                               payload)
+            header = self._reader.read(_header.size)
+            if len(header) < _header.size:
+                raise ServerError('The server closed the connection')
+            length, status, request_id = _header.unpack(header)
+            reply = self._reader.read(length)
+        if request_id != self._next_id:
+            raise ServerError('Reply to the wrong request')
+        if status != _status_ok:
+            raise ServerError(reply.decode())
+        return reply
+
+
+###############################################################################
+#                              Private Functions                              #
+###############################################################################
+
+
+class _Handler(object):
+
+    """Read requests from connections and coalesce lookups into batches."""
+
+    def __init__(self, bed, max_batch):
+        self.bed       = bed
+        self.max_batch = max_batch
+        self.queue     = asyncio.Queue()
+        self.batcher   = None
+
+    async def handle(self, reader, writer):
+        """Answer the requests of one connection until it closes."""
+        try:
+            while True:
+                try:
+                    header = await reader.readexactly(_header.size)
+                    length, op, request_id = _header.unpack(header)
+                    payload = await reader.readexactly(length)
+                except asyncio.IncompleteReadError:
+                    break
+                try:
+                    if op == _op_lookup:
+                        chromosomes, locations = _unpack_lookup(payload)
+                        self.queue.put_nowait((chromosomes, locations,
+                                               request_id, writer))
+                        continue
+                    elif op == _op_overlap:
+                        start, end = struct.unpack_from('<qq', payload)
+                        reply = _pack_names(self.bed.overlap(
+                            payload[16:].decode(), start, end))
+                    elif op == _op_stats:
+                        reply = json.dumps(self.bed.stats()).encode()
+                    else:
+                        raise ValueError('Unknown operation {}'.format(op))
+                except Exception as e:
+                    _reply(writer, request_id, _status_error, str(e).encode())
+                else:
+                    _reply(writer, request_id, _status_ok, reply)
+                await writer.drain()
+        finally:
+            writer.close()
+
+    async def run_batches(self):
+        """Resolve queued lookups, all that are waiting in one batch."""
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            size  = len(batch[0][1])
+            while size < self.max_batch and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+                size += len(batch[-1][1])
+            chromosomes = np.concatenate([i[0] for i in batch])
+            locations   = np.concatenate([i[1] for i in batch])
+            try:
+                if size < _inline_batch:
+                    names = self.bed.lookup_many(chromosomes, locations)
+                else:
+                    names = await loop.run_in_executor(
+                        None, self.bed.lookup_many, chromosomes, locations)
+            except Exception as e:
+                for _, _, request_id, writer in batch:
+                    _reply(writer, request_id, _status_error,
+                           str(e).encode())
+                continue
+            offset = 0
+            for _, request_locations, request_id, writer in batch:
+                count   = len(request_locations)
+                _reply(writer, request_id, _status_ok,
+                       _pack_names(names[offset:offset + count]))
+                offset += count
+
+
+def _reply(writer, request_id, status, payload):
+    """Write a reply frame unless the client has gone."""
+    if not writer.is_closing():
+        writer.write(_header.pack(len(payload), status, request_id) +
+                     payload)
+
+
+def _pack_lookup(chromosomes, locations):
+    """Encode a lookup request."""
+    names = '\n'.join([str(i) for i in chromosomes]).encode()
+    return (struct.pack('!II', len(locations), len(names)) + names +
+            locations.astype('<i8').tobytes())
+
+
+def _unpack_lookup(payload):
+    """Decode a lookup request into chromosome and position arrays."""
+    count, length = struct.unpack_from('!II', payload)
+    chromosomes   = np.empty(count, dtype=object)
+    if count:
+        chromosomes[:] = payload[8:8 + length].decode().split('\n')
+    locations = np.frombuffer(payload, dtype='<i8', count=count,
+                              offset=8 + length).astype(np.int64)
+    return chromosomes, locations
+
+
+def _pack_names(names):
+    """Encode a sequence of names, which may include None."""
+    found = bytes(bytearray(name is not None for name in names))
+    blob  = '\n'.join([name or '' for name in names]).encode()
+    return struct.pack('!I', len(found)) + found + blob
+
+
+def _unpack_names(payload):
+    """Decode names encoded by _pack_names() into an object array."""
+    count = struct.unpack_from('!I', payload)[0]
+    names = np.empty(count, dtype=object)
+    if count:
+        names[:] = payload[4 + count:].decode().split('\n')
+        names[np.frombuffer(payload, dtype=np.uint8, count=count,
+                            offset=4) == 0] = None
+    return names
@@ -0,0 +1,147 @@
+"""
+Streaming lookups for coordinate sorted inputs.
+
+If both the bed file and the queries are sorted by chromosome and position,
+they can be walked together in a single merge sweep. Only the bed intervals
+that overlap the current query position are held in memory, so an unbounded
+stream of queries can be annotated against a bed file of any size without
+building an index or a database.
+
+Both inputs must use the same chromosome order. By default this is plain
+lexicographic order, as produced by ``LC_ALL=C sort -k1,1 -k2,2n``, any
+other order can be given as a list of chromosome names.
+"""
+import heapq
+
+from ._bed_lookup import gopen
+
+__all__ = ['sweep', 'read_bed', 'UnsortedError']
+
+
+class UnsortedError(ValueError):
+
+    """Raised when an input to sweep() is not coordinate sorted."""
+
+    pass
+
+
+def read_bed(bedfile):
+    """Yield (chromosome, start, end, name) from a bed file.
+
+    Args:
+        bedfile (str): A bed file, optionally gzipped or bzipped, or an open
+                       file handle
+    """
+    with gopen(bedfile) as infile:
+        for line in infile:
+            f = line.rstrip().split('\t')
+            if len(f) < 4 or _is_header(f[0]):
+                continue
+            yield f[0], int(f[1]), int(f[2]), f[3]
+
+
+def sweep(bedfile, queries, chrom_order=None):
+    """Annotate a sorted stream of positions against a sorted bed file.
+
+    Args:
+        bedfile (str):      A bed file sorted by chromosome and start
+        queries (iterable): (chromosome, position) pairs, sorted the same way
+        chrom_order (list): The order of chromosomes in both inputs, default
+                            is lexicographic
+
+    Yields:
+        tuple: (chromosome, position, name) for every query, in input order.
+               name is the first gene in the bed file containing the
+               position, as returned by BedFile.lookup(), or None.
+
+    Raises:
+        UnsortedError: As soon as either input is found to be out of order.
+    """
+    rank    = _ranker(chrom_order)
+    bed     = _check_sorted(read_bed(bedfile), rank, 'bed file')
+    pending = next(bed, None)
+    order   = 0  # Position of pending in the bed file
+    active  = []  # Heap of (end, order, name) of intervals at this chrom
+    current = None
+    last    = None
+
+    for chrom, pos in queries:
+        pos = int(pos)
+        if chrom != current:
+            if current is not None and rank(chrom) < rank(current):
+                raise UnsortedError(
+                    ('queries are not sorted: chromosome {} comes after ' +
+                     '{}').format(chrom, current))
+            current = chrom
+            last    = None
+            active  = []
+            # Skip bed intervals on earlier chromosomes
+            while pending and rank(pending[0]) < rank(chrom):
+                pending = next(bed, None)
+                order  += 1
+        elif pos < last:
+            raise UnsortedError(
+                'queries are not sorted: {}:{} comes after {}:{}'.format(
+                    chrom, pos, chrom, last))
+        last = pos
+
+        # Take in every interval that starts at or before this position
+        while pending and pending[0] == chrom and pending[1] <= pos:
+            heapq.heappush(active, (pending[2], order, pending[3]))
+            pending = next(bed, None)
+            order  += 1
+
+        # Drop intervals that end before it
+        while active and active[0][0] <= pos:
+            heapq.heappop(active)
+
+        if active:
+            yield chrom, pos, min(active, key=lambda i: i[1])[2]
+        else:
+            yield chrom, pos, None
+
+
+###############################################################################
+#                              Private Functions                              #
+###############################################################################
+
+
+def _is_header(field):
+    """True if the first field of a line is a track, browser or comment."""
+    if field.startswith('#'):
+        return True
+    words = field.split(None, 1)
+    return bool(words) and words[0] in ('track', 'browser')
+
+
+def _ranker(chrom_order):
+    """Return a function giving a sort key for a chromosome name."""
+    if chrom_order is None:
+        return lambda chrom: chrom
+    ranks = {chrom: i for i, chrom in enumerate(chrom_order)}
+
+    def rank(chrom):
+        try:
+            return ranks[chrom]
+        except KeyError:
+            raise UnsortedError(
+                'chromosome {} is not in chrom_order'.format(chrom))
+    return rank
+
+
+def _check_sorted(intervals, rank, label):
+    """Pass through (chrom, start, ...) tuples, raising if out of order."""
+    last = None
+    for interval in intervals:
+        if last is not None:
+            if interval[0] != last[0]:
+                if rank(interval[0]) < rank(last[0]):
+                    raise UnsortedError(
+                        ('{} is not sorted: chromosome {} comes after ' +
+                         '{}').format(label, interval[0], last[0]))
+            elif interval[1] < last[1]:
+                raise UnsortedError(
+                    '{} is not sorted: {}:{} comes after {}:{}'.format(
+                        label, interval[0], interval[1], last[0], last[1]))
+        last = interval
+        yield interval
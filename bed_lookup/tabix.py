@@ -0,0 +1,447 @@
+"""
+Random access to bgzipped bed files through a tabix or CSI index.
+
+A file compressed with ``bgzip`` is a series of independently compressed
+blocks of up to 64kb, and ``tabix -p bed`` (or ``tabix -C -p bed`` for CSI)
+writes an index of the blocks holding each genomic bin. A lookup reads the
+index once, then only decompresses the few blocks that can hold intervals
+overlapping the query, so opening even a very large annotation is instant.
+Decompressed blocks are kept in a least recently used cache, as neighbouring
+queries usually hit the same blocks.
+
+Only the index and block formats are implemented here, no external
+libraries are needed.
+"""
+import os
+import zlib
+import gzip
+import struct
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+__all__ = ['TabixFile', 'TabixChrom', 'BgzfReader', 'find_index',
+           'CACHE_BLOCKS']
+
+# Decompressed BGZF blocks kept by default, blocks are at most 64kb
+CACHE_BLOCKS = 256
+
+# Index extensions, in the order they are looked for
+_index_exts = ['.tbi', '.csi']
+
+# Tabix indices always use 16kb bins at the finest of 5 levels
+_tbi_min_shift = 14
+_tbi_depth     = 5
+
+# Format flag for 0-based, half-open coordinates like bed
+_zero_based = 0x10000
+
+
+def find_index(bedfile):
+    """Return the path to a tabix or CSI index of bedfile, or None."""
+    for ext in _index_exts:
+        if os.path.isfile(bedfile + ext):
+            return bedfile + ext
+    return None
+
+
+class BgzfReader(object):
+
+    """Read a BGZF file by virtual offset, caching decompressed blocks.
+
+    A virtual offset is the file offset of a compressed block shifted left
+    16 bits, plus an offset into the decompressed block. Blocks are read
+    with pread, so a reader inherited by a forked process is safe to use,
+    and the cache is locked, so one reader can be shared by threads. Copies
+    made by pickling reopen the file with an empty cache.
+    """
+
+    def __init__(self, path, cache_blocks=CACHE_BLOCKS):
+        """Open path.
+
+        Args:
+            path (str):         A bgzipped file
+            cache_blocks (int): Decompressed blocks to keep
+        """
+        self.path         = path
+        self.cache_blocks = cache_blocks
+        self._fd          = os.open(path, os.O_RDONLY)
+        self._cache       = OrderedDict()
+        self._lock        = threading.Lock()
+        self.hits         = 0
+        self.misses       = 0
+
+    def block(self, offset):
+        """Return (data, compressed size) of the block at a file offset.
+
+        Returns (b'', 0) at the end of the file.
+        """
+        with self._lock:
+            try:
+                self._cache.move_to_end(offset)
+                self.hits += 1
+                return self._cache[offset]
+            except KeyError:
+                self.misses += 1
+        header = os.pread(self._fd, 18, offset)
+        if len(header) < 18:
+            return b'', 0
+        size  = _block_size(header)
+        block = (zlib.decompress(os.pread(self._fd, size, offset), 31), size)
+        with self._lock:
+            self._cache[offset] = block
+            if len(self._cache) > self.cache_blocks:
+                self._cache.popitem(last=False)
+        return block
+
+    def lines(self, voffset):
+        """Yield (virtual offset, line) for every line from voffset on."""
+        offset  = voffset >> 16
+        pos     = voffset & 0xffff
+        pending = b''
+        start   = None
+        while True:
+            data, size = self.block(offset)
+            if not size:
+                if pending:
+                    yield start, pending
+                return
+            while True:
+                newline = data.find(b'\n', pos)
+                if newline < 0:
+                    if pos < len(data):
+                        if not pending:
+                            start = (offset << 16) | pos
+                        pending += data[pos:]
+                    break
+                if pending:
+                    yield start, pending + data[pos:newline]
+                    pending = b''
+                else:
+                    yield (offset << 16) | pos, data[pos:newline]
+                pos = newline + 1
+            offset += size
+            pos     = 0
+
+    def close(self):
+        """Close the file."""
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def __del__(self):
+        self.close()
+
+    def __reduce__(self):
+        return BgzfReader, (self.path, self.cache_blocks)
+
+
+class TabixFile(object):
+
+    """A bgzipped bed file with a tabix or CSI index.
+
+    Copies made by pickling read the index and open the file again.
+    """
+
+    def __init__(self, path, index=None, cache_blocks=CACHE_BLOCKS):
+        """Read the index of path.
+
+        Args:
+            path (str):         A bgzipped bed file
+            index (str):        The index, default path.tbi or path.csi
+            cache_blocks (int): Decompressed blocks to keep
+        """
+        index = index or find_index(path)
+        if not index:
+            raise ValueError('No .tbi or .csi index found for ' + path)
+        with open(index, 'rb') as fin:
+            data = gzip.decompress(fin.read())
+        if data[:4] == b'TBI\x01':
+            self._read_tbi(data)
+        elif data[:4] == b'CSI\x01':
+            self._read_csi(data)
+        else:
+            raise ValueError(index + ' is not a tabix or CSI index')
+        self.path   = path
+        self.index  = index
+        self.reader = BgzfReader(path, cache_blocks)
+
+    def __reduce__(self):
+        return TabixFile, (self.path, self.index, self.reader.cache_blocks)
+
+    @property
+    def chromosomes(self):
+        """The names of the chromosomes in the index."""
+        return list(self._refs)
+
+    def fetch(self, chromosome, start, end):
+        """Yield (start, end, name) for every interval overlapping a range.
+
+        Intervals are yielded in file order.
+
+        Args:
+            chromosome (str): The chromosome name
+            start (int):      The start of the range, 0-based
+            end (int):        The end of the range, exclusive
+        """
+        try:
+            bins, offsets = self._refs[chromosome]
+        except KeyError:
+            return
+        if end <= start:
+            return
+        name = chromosome.encode()
+        for chunk_start, chunk_end in self._chunks(bins, offsets, start, end):
+            for voffset, line in self.reader.lines(chunk_start):
+                if voffset >= chunk_end:
+                    break
+                record = self._parse(line, name)
+                if record is None:
+                    continue
+                if record[0] >= end:
+                    return
+                if record[1] > start:
+                    yield record[0], record[1], record[2].decode()
+
+    def _parse(self, line, chromosome):
+        """Return (start, end, name) if line is on chromosome, else None.
+
+        The name is not decoded, as most lines read are not hits.
+        """
+        if not line or line[0] == self._meta:
+            return None
+        f = line.split(b'\t', self._max_col + 1)
+        if len(f) < 4 or f[self._col_seq] != chromosome:
+            return None
+        start = int(f[self._col_beg]) - self._shift
+        end   = int(f[self._col_end]) if self._col_end >= 0 else start + 1
+        return start, end, f[3].rstrip() if len(f) == 4 else f[3]
+
+    def _chunks(self, bins, offsets, start, end):
+        """Return the sorted, merged chunks that can hold a range."""
+        min_offset = self._min_offset(offsets, start)
+        chunks = sorted(chunk
+                        for b in _reg2bins(start, end, self._min_shift,
+                                           self._depth)
+                        for chunk in bins.get(b, ())
+                        if chunk[1] > min_offset)
+        merged = []
+        for chunk_start, chunk_end in chunks:
+            chunk_start = max(chunk_start, min_offset)
+            if merged and chunk_start <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], chunk_end)
+            else:
+                merged.append([chunk_start, chunk_end])
+        return merged
+
+    def _min_offset(self, offsets, start):
+        """Return the lowest virtual offset an interval after start can be
+        at, from the linear index of a tabix index or the loffset of the
+        bins of a CSI index."""
+        if isinstance(offsets, list):
+            if not offsets:
+                return 0
+            return offsets[min(start >> self._min_shift, len(offsets) - 1)]
+        b = _bin_offset(self._depth) + (start >> self._min_shift)
+        while b > 0 and b not in offsets:
+            b = (b - 1) >> 3
+        return offsets.get(b, 0)
+
+    def _read_header(self, data, offset):
+        """Read the tabix header fields and sequence names at offset."""
+        fmt, col_seq, col_beg, col_end, meta, skip, l_nm = \
+            struct.unpack_from('<7i', data, offset)
+        self._col_seq = col_seq - 1
+        self._col_beg = col_beg - 1
+        self._col_end = col_end - 1
+        self._max_col = max(3, self._col_seq, self._col_beg, self._col_end)
+        self._shift   = 0 if fmt & _zero_based else 1
+        self._meta    = meta
+        offset += 28
+        names   = data[offset:offset + l_nm].split(b'\0')[:-1]
+        return [i.decode() for i in names]
+
+    def _read_tbi(self, data):
+        """Parse a tabix index."""
+        self._min_shift = _tbi_min_shift
+        self._depth     = _tbi_depth
+        names  = self._read_header(data, 8)
+        offset = 36 + struct.unpack_from('<i', data, 32)[0]
+        self._refs = OrderedDict()
+        for name in names:
+            bins, _, offset = _read_bins(data, offset, False, self._depth)
+            n_intv = struct.unpack_from('<i', data, offset)[0]
+            linear = np.frombuffer(data, dtype='<u8', count=n_intv,
+                                   offset=offset + 4)
+            offset += 4 + 8*n_intv
+            self._refs[name] = (bins, [int(i) for i in linear])
+
+    def _read_csi(self, data):
+        """Parse a CSI index, which must carry a tabix header."""
+        self._min_shift, self._depth, l_aux = struct.unpack_from('<3i', data,
+                                                                  4)
+        if l_aux < 28:
+            raise ValueError('CSI index has no tabix header, it does not ' +
+                             'index a bed file')
+        names      = self._read_header(data, 16)
+        offset     = 16 + l_aux + 4
+        self._refs = OrderedDict()
+        for name in names:
+            bins, loffsets, offset = _read_bins(data, offset, True,
+                                                self._depth)
+            self._refs[name] = (bins, loffsets)
+
+
+class TabixChrom(object):
+
+    """The intervals of one chromosome of a TabixFile.
+
+    Provides the lookup methods of the in memory Chrom index, so BedFile
+    can use it in place of one.
+    """
+
+    def __init__(self, tabix, chromosome):
+        self.tabix      = tabix
+        self.chromosome = chromosome
+
+    def find(self, loc):
+        """Return the name of the first interval containing loc, or None."""
+        loc = int(loc)
+        for _, _, name in self.tabix.fetch(self.chromosome, loc, loc + 1):
+            return name
+        return None
+
+    def find_many(self, positions):
+        """Find the first hit for every position in an array."""
+        result = np.full(len(positions), None, dtype=object)
+        for i, loc in enumerate(positions):
+            result[i] = self.find(loc)
+        return result
+
+    def find_columns(self, positions):
+        """Find the first hit for every position, as columns.
+
+        Returns:
+            tuple: (codes, names, starts, ends). codes is an int32 array of
+                   indices into the object array names, starts and ends are
+                   int64 arrays of the coordinates of the hit. All three are
+                   -1 where there is no hit.
+        """
+        n      = len(positions)
+        codes  = np.full(n, -1, dtype=np.int32)
+        starts = np.full(n, -1, dtype=np.int64)
+        ends   = np.full(n, -1, dtype=np.int64)
+        ids    = {}
+        for i, loc in enumerate(positions):
+            loc = int(loc)
+            for start, end, name in self.tabix.fetch(self.chromosome, loc,
+                                                     loc + 1):
+                codes[i]  = ids.setdefault(name, len(ids))
+                starts[i] = start
+                ends[i]   = end
+                break
+        names = np.empty(len(ids), dtype=object)
+        names[:] = list(ids)
+        return codes, names, starts, ends
+
+    def find_all(self, loc):
+        """Return the names of all intervals containing loc in file order."""
+        loc = int(loc)
+        return self.overlap(loc, loc + 1)
+
+    def overlap(self, start, end):
+        """Return the names of all intervals overlapping [start, end)."""
+        return [i[2] for i in self.tabix.fetch(self.chromosome, int(start),
+                                                int(end))]
+
+    def intersect(self, starts, ends):
+        """Find every interval overlapping each of an array of ranges.
+
+        Returns:
+            tuple: Arrays of the index of the query range, the name, start
+                   and end of every hit, hits for each query range are in
+                   file order.
+        """
+        query, hit_starts, hit_ends, names = [], [], [], []
+        for i, (start, end) in enumerate(zip(starts, ends)):
+            for hit_start, hit_end, name in self.tabix.fetch(
+                    self.chromosome, int(start), int(end)):
+                query.append(i)
+                hit_starts.append(hit_start)
+                hit_ends.append(hit_end)
+                names.append(name)
+        name_array = np.empty(len(names), dtype=object)
+        name_array[:] = names
+        return (np.array(query, dtype=np.int64), name_array,
+                np.array(hit_starts, dtype=np.int64),
+                np.array(hit_ends, dtype=np.int64))
+
+    def __repr__(self):
+        return 'TabixChrom({}:{})'.format(self.tabix.path, self.chromosome)
+
+
+###############################################################################
+#                              Private Functions                              #
+###############################################################################
+
+
+def _block_size(header):
+    """Return the total size of the BGZF block starting with header."""
+    if header[:4] != b'\x1f\x8b\x08\x04':
+        raise ValueError('Not a BGZF block, is the file bgzipped?')
+    xlen   = struct.unpack_from('<H', header, 10)[0]
+    offset = 12
+    # The BC subfield is always first in files written by bgzip
+    while offset + 4 <= 12 + xlen and offset + 6 <= len(header):
+        slen = struct.unpack_from('<H', header, offset + 2)[0]
+        if header[offset:offset + 2] == b'BC' and slen == 2:
+            return struct.unpack_from('<H', header, offset + 4)[0] + 1
+        offset += 4 + slen
+    raise ValueError('BGZF block has no size field')
+
+
+def _read_bins(data, offset, csi, depth):
+    """Read the bins of one sequence.
+
+    Returns:
+        tuple: ({bin: [(chunk start, chunk end)]}, {bin: loffset} for CSI
+               indices, new offset)
+    """
+    n_bin    = struct.unpack_from('<i', data, offset)[0]
+    offset  += 4
+    bins     = {}
+    loffsets = {}
+    # This bin holds mapped and unmapped counts instead of chunks
+    pseudo   = _bin_offset(depth + 1) + 1
+    for _ in range(n_bin):
+        b = struct.unpack_from('<I', data, offset)[0]
+        offset += 4
+        if csi:
+            loffsets[b] = struct.unpack_from('<Q', data, offset)[0]
+            offset += 8
+        n_chunk = struct.unpack_from('<i', data, offset)[0]
+        offset += 4
+        if b != pseudo:
+            bins[b] = list(struct.iter_unpack(
+                '<QQ', data[offset:offset + 16*n_chunk]))
+        offset += 16*n_chunk
+    return bins, loffsets, offset
+
+
+def _bin_offset(level):
+    """Return the number of the first bin at a level of the bin tree."""
+    return ((1 << 3*level) - 1) // 7
+
+
+def _reg2bins(start, end, min_shift, depth):
+    """Return every bin that can hold an interval overlapping [start, end)."""
+    shift = min_shift + 3*depth
+    end   = min(end, 1 << shift) - 1
+    bins  = []
+    for level in range(depth + 1):
+        first = _bin_offset(level)
+        bins.extend(range(first + (start >> shift),
+                          first + (end >> shift) + 1))
+        shift -= 3
+    return bins
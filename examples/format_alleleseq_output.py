@@ -73,7 +73,9 @@ def get_snp_data(count_files, tissue_file=tissue_lookup_file,
     tissues = {}  # Dictionary to hold all data
     tissue_lookup = create_tissue_lookup(tissue_file)
     master_lookup = create_master_lookup(master_file)
-    bed_lookup = BedFile(bed_file)
+    # The same SNPs are in every count file, cache their genes. Count files
+    # may leave out the chr prefix of the bed file.
+    bed_lookup = BedFile(bed_file, lookup_cache=1000000, chrom_aliases=True)
     for i in count_files:
         # Create entry for this count file
         t = i.split('.')[0]
@@ -108,7 +110,7 @@ def get_snp_data(count_files, tissue_file=tissue_lookup_file,
                 f = line.rstrip().split('\t')
                 chr   = f[0] if f[0].startswith('c') else 'chr' + str(f[0])
                 snp   = f[1]
-                gene  = bed_lookup.lookup(chr, int(snp))
+                gene  = bed_lookup.lookup(f[0], int(snp))
                 gene  = gene if gene else ''
                 model = master_lookup[gene] if gene else ''
                 sig   = 'Y' if chr + '_' + snp in hets else 'N'
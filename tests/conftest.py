@@ -0,0 +1,114 @@
+"""
+Shared fixtures: random bed files and brute force answers to check against.
+"""
+import random
+
+import pytest
+
+from bed_lookup import logme
+
+logme.MIN_LEVEL = 'error'
+
+CHROMS = ['chr1', 'chr2', 'chrX']
+
+
+def make_rows(seed=1, per_chrom=400, span=20000):
+    """Return random (chrom, start, end, name) rows sorted by position.
+
+    Every chromosome has short, long (nested) and zero-length intervals,
+    plus hand picked nested intervals and exact duplicates, so the order of
+    the file decides which one lookup() returns.
+    """
+    rng  = random.Random(seed)
+    rows = []
+    for chrom in CHROMS:
+        for _ in range(per_chrom):
+            start = rng.randrange(span)
+            kind  = rng.random()
+            if kind < 0.05:
+                length = 0
+            elif kind < 0.15:
+                length = rng.randrange(500, 5000)
+            else:
+                length = rng.randrange(1, 100)
+            rows.append((chrom, start, start + length))
+        rows.extend([(chrom, 100, 1000), (chrom, 200, 300), (chrom, 250, 260),
+                     (chrom, 250, 260), (chrom, 255, 255), (chrom, 0, 1)])
+    rows.sort(key=lambda r: (CHROMS.index(r[0]), r[1]))
+    return [(c, s, e, 'g{}'.format(i)) for i, (c, s, e) in enumerate(rows)]
+
+
+def write_bed(path, rows, header=True):
+    """Write rows as a bed file, with a track line to be skipped."""
+    with open(str(path), 'w') as fout:
+        if header:
+            fout.write('track name=test\n')
+        for row in rows:
+            fout.write('{}\t{}\t{}\t{}\n'.format(*row))
+    return str(path)
+
+
+def bgzip(path):
+    """bgzip and tabix index a sorted bed file, skip if pysam is missing."""
+    pysam = pytest.importorskip('pysam')
+    return pysam.tabix_index(str(path), preset='bed', force=True,
+                             keep_original=True)
+
+
+def brute_find(rows, chrom, pos):
+    """Name of the first row containing pos, or None."""
+    for c, start, end, name in rows:
+        if c == chrom and start <= pos < end:
+            return name
+    return None
+
+
+def brute_overlap(rows, chrom, start, end):
+    """Names of every row overlapping [start, end), in file order."""
+    return [name for c, s, e, name in rows
+            if c == chrom and s < end and e > start]
+
+
+def query_positions(rows, seed=2, n=300):
+    """Positions at every interval edge, and some random ones."""
+    rng       = random.Random(seed)
+    positions = set()
+    for chrom, start, end, _ in rows:
+        for pos in (start - 1, start, end - 1, end):
+            if pos >= 0:
+                positions.add((chrom, pos))
+    positions = sorted(positions)
+    positions = rng.sample(positions, min(n, len(positions)))
+    positions += [(rng.choice(CHROMS), rng.randrange(30000))
+                  for _ in range(n)]
+    return positions
+
+
+def query_ranges(seed=3, n=200):
+    """Random (chrom, start, end) ranges of varied length."""
+    rng    = random.Random(seed)
+    ranges = []
+    for _ in range(n):
+        start = rng.randrange(25000)
+        ranges.append((rng.choice(CHROMS), start,
+                       start + rng.choice([1, 2, 10, 100, 3000])))
+    return ranges + [('chr1', 254, 256), ('chr1', 255, 256)]
+
+
+@pytest.fixture(scope='session')
+def rows():
+    """Sorted random bed rows."""
+    return make_rows()
+
+
+@pytest.fixture(scope='session')
+def shuffled_rows(rows):
+    """The same rows with every chromosome shuffled, so file order and
+    position order differ."""
+    rng    = random.Random(4)
+    result = []
+    for chrom in CHROMS:
+        block = [r for r in rows if r[0] == chrom]
+        rng.shuffle(block)
+        result.extend(block)
+    return result
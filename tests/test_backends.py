@@ -0,0 +1,199 @@
+"""
+Every backend against brute force answers on the same intervals.
+"""
+import os
+import pickle
+
+import numpy as np
+import pytest
+
+from bed_lookup import BedFile, BedCollection
+
+from conftest import (CHROMS, bgzip, brute_find, brute_overlap, make_rows,
+                      query_positions, query_ranges, write_bed)
+
+BACKENDS = ['dict', 'sqlite', 'mmap', 'tabix', 'cache', 'lazy', 'lazy_evict']
+
+
+def open_backend(backend, directory, rows, shuffled_rows):
+    """Return (BedFile, rows in the order of its file) for a backend."""
+    if backend == 'tabix':
+        path = bgzip(write_bed(directory.join('sorted.bed'), rows,
+                               header=False))
+        return BedFile(path, backend='tabix'), rows
+    path = write_bed(directory.join('shuffled.bed'), shuffled_rows)
+    if backend == 'cache':
+        cache = str(directory.join('cache'))
+        BedFile(path, cache=cache)
+        bed = BedFile(path, cache=cache)
+        assert bed._type == 'mm'
+    elif backend == 'lazy':
+        bed = BedFile(path, lazy=True)
+    elif backend == 'lazy_evict':
+        bed = BedFile(path, lazy=True, lazy_memory=1)
+    else:
+        bed = BedFile(path, backend=backend)
+    return bed, shuffled_rows
+
+
+@pytest.fixture(scope='module', params=BACKENDS)
+def bed(request, tmpdir_factory, rows, shuffled_rows):
+    return open_backend(request.param,
+                        tmpdir_factory.mktemp(request.param), rows,
+                        shuffled_rows)
+
+
+def test_chromosomes(bed):
+    bed, _ = bed
+    assert sorted(bed.chromosomes) == sorted(CHROMS)
+
+
+def test_lookup(bed):
+    bed, rows = bed
+    for chrom, pos in query_positions(rows):
+        assert bed.lookup(chrom, pos) == brute_find(rows, chrom, pos), \
+            (chrom, pos)
+
+
+def test_lookup_all(bed):
+    bed, rows = bed
+    for chrom, pos in query_positions(rows, n=100):
+        assert bed.lookup_all(chrom, pos) == brute_overlap(rows, chrom, pos,
+                                                           pos + 1)
+
+
+def test_overlap(bed):
+    bed, rows = bed
+    for chrom, start, end in query_ranges():
+        assert bed.overlap(chrom, start, end) == brute_overlap(rows, chrom,
+                                                               start, end)
+
+
+def test_overlap_empty_range(bed):
+    bed, _ = bed
+    with pytest.raises(ValueError):
+        bed.overlap('chr1', 10, 10)
+
+
+def test_lookup_many(bed):
+    bed, rows = bed
+    queries   = query_positions(rows) + [('chrUnknown', 5)]
+    chroms    = np.array([c for c, _ in queries], dtype=object)
+    positions = np.array([p for _, p in queries], dtype=np.int64)
+    expected  = [brute_find(rows, c, p) for c, p in queries]
+    assert list(bed.lookup_many(chroms, positions)) == expected
+    assert list(bed.lookup_many(chroms, positions, n_threads=3)) == expected
+    ids = bed.encode_chromosomes(chroms)
+    assert list(bed.lookup_many(ids, positions)) == expected
+
+
+def test_lookup_columns(bed):
+    bed, rows = bed
+    queries = query_positions(rows, n=100)
+    codes, names, starts, ends = bed.lookup_columns(
+        [c for c, _ in queries], [p for _, p in queries])
+    for i, (chrom, pos) in enumerate(queries):
+        hit = [r for r in rows if r[0] == chrom and r[1] <= pos < r[2]]
+        if hit:
+            assert (names[codes[i]], starts[i], ends[i]) == \
+                (hit[0][3], hit[0][1], hit[0][2])
+        else:
+            assert (codes[i], starts[i], ends[i]) == (-1, -1, -1)
+
+
+def test_intersect(bed):
+    bed, rows = bed
+    ranges = query_ranges(n=80)
+    query, names, starts, ends = bed.intersect(
+        [r[0] for r in ranges], [r[1] for r in ranges],
+        [r[2] for r in ranges])
+    expected = [(i, name, s, e) for i, (chrom, start, end) in
+                enumerate(ranges) for c, s, e, name in rows
+                if c == chrom and s < end and e > start]
+    assert list(zip(query, names, starts, ends)) == expected
+
+
+def test_unknown_chromosome(bed):
+    bed, _ = bed
+    bed.reset_stats()
+    assert bed.lookup('chrUnknown', 10) is None
+    assert bed.overlap('chrUnknown', 10, 20) == []
+    assert bed.stats()['unknown_chromosome']['chrUnknown'] == 2
+
+
+def test_threads_reused(bed):
+    bed, rows = bed
+    queries  = query_positions(rows)
+    chroms   = [c for c, _ in queries]
+    expected = [brute_find(rows, c, p) for c, p in queries]
+    assert list(bed.lookup_many(chroms, [p for _, p in queries],
+                                n_threads=3)) == expected
+    threads = bed._threads
+    readers = dict(bed._readers)
+    for _ in range(5):
+        assert list(bed.lookup_many(chroms, [p for _, p in queries],
+                                    n_threads=3)) == expected
+        assert bed._threads is threads
+    # At most one read-only connection per thread, kept across batches
+    assert len(bed._readers) <= 3
+    assert all(bed._readers[i] is c for i, c in readers.items())
+    assert bool(bed._readers) == (bed._type == 'sq')
+    bed.close()
+    assert bed._threads is None and not bed._readers
+    assert list(bed.lookup_many(chroms, [p for _, p in queries],
+                                n_threads=3)) == expected
+
+
+def test_pickle(bed):
+    bed, rows = bed
+    if bed._type == 'sq':
+        pytest.skip('sqlite connections are opened again by each process')
+    copy = pickle.loads(pickle.dumps(bed))
+    for chrom, pos in query_positions(rows, n=50):
+        assert copy.lookup(chrom, pos) == brute_find(rows, chrom, pos)
+
+
+def test_stale_mmap_index(tmpdir):
+    path = write_bed(tmpdir.join('stale.bed'), [('chr1', 10, 20, 'old')])
+    assert BedFile(path, backend='mmap').lookup('chr1', 15) == 'old'
+    mtime = os.stat(path + '.bidx').st_mtime_ns
+    write_bed(path, [('chr1', 10, 20, 'new')])
+    os.utime(path, ns=(mtime + 10**9, mtime + 10**9))
+    assert BedFile(path, backend='mmap').lookup('chr1', 15) == 'new'
+    assert BedFile(path).lookup('chr1', 15) == 'new'
+
+
+def test_chrom_aliases(tmpdir):
+    path = write_bed(tmpdir.join('a.bed'), [('chr1', 10, 20, 'a'),
+                                            ('chrM', 0, 100, 'm'),
+                                            ('2', 5, 9, 'b')])
+    bed = BedFile(path, chrom_aliases=True)
+    assert bed.lookup('1', 15) == 'a'
+    assert bed.lookup('MT', 50) == 'm'
+    assert bed.lookup('chr2', 6) == 'b'
+    assert BedFile(path).lookup('1', 15) is None
+    bed = BedFile(path, chrom_aliases={'one': 'chr1'})
+    assert bed.lookup('one', 15) == 'a'
+
+
+def test_collection(tmpdir, rows):
+    tracks = {'a': write_bed(tmpdir.join('a.bed'), make_rows(seed=5)),
+              'b': write_bed(tmpdir.join('b.bed'), rows)}
+    collection = BedCollection(tracks)
+    queries    = query_positions(rows)
+    found      = collection.lookup_many([c for c, _ in queries],
+                                        [p for _, p in queries])
+    for track, path in tracks.items():
+        assert list(found[track]) == list(BedFile(path).lookup_many(
+            [c for c, _ in queries], [p for _, p in queries]))
+
+
+def test_lazy_eviction(tmpdir, shuffled_rows):
+    path = write_bed(tmpdir.join('lazy.bed'), shuffled_rows)
+    bed  = BedFile(path, lazy=True, lazy_memory=1)
+    for chrom in CHROMS + CHROMS:
+        assert bed.lookup(chrom, 255) == brute_find(shuffled_rows, chrom,
+                                                    255)
+    stats = bed._data.stats()
+    assert stats['loads'] == 6
+    assert stats['loaded'] == ['chrX']
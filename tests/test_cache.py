@@ -0,0 +1,64 @@
+"""
+The on-disk cache of parsed indices.
+"""
+import os
+import pickle
+
+from bed_lookup import BedFile, cache
+
+from conftest import brute_find, make_rows, query_positions, write_bed
+
+
+def test_hit_and_stale(tmpdir):
+    rows      = make_rows(seed=12, per_chrom=50)
+    path      = write_bed(tmpdir.join('c.bed'), rows)
+    cache_dir = str(tmpdir.join('cache'))
+    assert BedFile(path, cache=cache_dir)._type == 'dt'
+    assert cache.find(path, cache_dir) == cache.index_path(path, cache_dir)
+    bed = BedFile(path, cache=cache_dir)
+    assert bed._type == 'mm'
+    copy = pickle.loads(pickle.dumps(bed))
+    for chrom, pos in query_positions(rows, n=100):
+        assert copy.lookup(chrom, pos) == brute_find(rows, chrom, pos)
+
+    # A changed bed file invalidates the entry
+    write_bed(path, rows[:-1])
+    assert cache.find(path, cache_dir) is None
+    assert not os.path.exists(cache.index_path(path, cache_dir))
+
+
+def test_hash(tmpdir):
+    path      = write_bed(tmpdir.join('c.bed'), [('chr1', 10, 20, 'a')])
+    cache_dir = str(tmpdir.join('cache'))
+    BedFile(path, cache=cache_dir)
+    # Stored without a SHA1, so it cannot satisfy cache_hash
+    assert cache.find(path, cache_dir) is not None
+    assert cache.find(path, cache_dir, check_hash=True) is None
+    assert BedFile(path, cache=cache_dir, cache_hash=True)._type == 'dt'
+    assert cache.find(path, cache_dir, check_hash=True) is not None
+
+    # Same size and mtime, different contents
+    stat = os.stat(path)
+    write_bed(path, [('chr1', 10, 20, 'b')])
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    assert cache.find(path, cache_dir) is not None
+    assert cache.find(path, cache_dir, check_hash=True) is None
+    assert BedFile(path, cache=cache_dir,
+                   cache_hash=True).lookup('chr1', 15) == 'b'
+
+
+def test_evict(tmpdir):
+    cache_dir = str(tmpdir.join('cache'))
+    paths     = [write_bed(tmpdir.join('{}.bed'.format(i)),
+                           make_rows(seed=i, per_chrom=20)) for i in range(3)]
+    for i, path in enumerate(paths):
+        BedFile(path, cache=cache_dir)
+        # Entries are evicted least recently used first
+        record = cache.index_path(path, cache_dir)[:-len('.bidx')] + '.json'
+        os.utime(record, (1000 + i, 1000 + i))
+    size = os.path.getsize(cache.index_path(paths[0], cache_dir))
+    cache.evict(cache_dir, max_size=2*size + size//2)
+    assert [cache.find(i, cache_dir) is not None for i in paths] == \
+        [False, True, True]
+    cache.clear(cache_dir)
+    assert os.listdir(cache_dir) == []
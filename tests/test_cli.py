@@ -0,0 +1,72 @@
+"""
+The bed_location_lookup script on query files of each format.
+"""
+import os
+import subprocess
+import sys
+
+import pytest
+
+from conftest import brute_find, write_bed
+
+ROOT   = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCRIPT = os.path.join(ROOT, 'bin', 'bed_location_lookup')
+
+ROWS = [('chr1', 100, 200, 'a'), ('chr1', 150, 400, 'b'),
+        ('chr2', 10, 20, 'c')]
+
+POSITIONS = [('chr1', 120), ('chr1', 160), ('chr1', 500), ('chr2', 15)]
+
+
+def run(*args, returncode=0):
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    out = subprocess.run([sys.executable, SCRIPT] + list(args), env=env,
+                         stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                         universal_newlines=True, timeout=60)
+    assert out.returncode == returncode, out.stderr
+    return out.stdout.splitlines()
+
+
+@pytest.fixture
+def bed(tmpdir):
+    return write_bed(tmpdir.join('genes.bed'), ROWS)
+
+
+def query_file(tmpdir, header, lines):
+    path = str(tmpdir.join('queries'))
+    with open(path, 'w') as fout:
+        fout.write(''.join(i + '\n' for i in header + lines))
+    return path
+
+
+@pytest.mark.parametrize('args', [[], ['-j', '2', '-c', '1'], ['--sweep']])
+def test_bed_with_header(tmpdir, bed, args):
+    lines = ['{}\t{}\t{}'.format(c, p, p + 1) for c, p in POSITIONS]
+    path  = query_file(tmpdir, ['track name=q', 'browser hide all',
+                                '# positions'], lines)
+    assert run(bed, '-i', path, *args) == [
+        '{}\t{}'.format(line, brute_find(ROWS, c, p) or '')
+        for line, (c, p) in zip(lines, POSITIONS)]
+
+
+def test_vcf(tmpdir, bed):
+    lines = ['{}\t{}\t.\tA\tG'.format(c, p + 1) for c, p in POSITIONS]
+    path  = query_file(tmpdir, ['##fileformat=VCFv4.2',
+                                '#CHROM\tPOS\tID\tREF\tALT'], lines)
+    assert run(bed, '-i', path) == [
+        '{}\t{}'.format(line, brute_find(ROWS, c, p) or '')
+        for line, (c, p) in zip(lines, POSITIONS)]
+
+
+def test_regions(tmpdir, bed):
+    lines = ['{}:{}'.format(c, p) for c, p in POSITIONS]
+    path  = query_file(tmpdir, ['# regions'], lines)
+    assert run(bed, '-i', path) == [
+        '{}\t{}'.format(line, brute_find(ROWS, c, p) or '')
+        for line, (c, p) in zip(lines, POSITIONS)]
+
+
+@pytest.mark.parametrize('args', [[], ['-j', '2', '-c', '1']])
+def test_bad_line(tmpdir, bed, args):
+    path = query_file(tmpdir, ['track name=q'], ['chr1\t120\t121', 'bad'])
+    run(bed, '-i', path, *args, returncode=2)
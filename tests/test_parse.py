@@ -0,0 +1,90 @@
+"""
+Parsing bed files: skipped lines, compression and parallel chunks.
+"""
+import bz2
+import gzip
+
+import pytest
+
+from bed_lookup import BedFile
+from bed_lookup._bed_lookup import _parse_chunk
+
+from conftest import bgzip, brute_find, make_rows, query_positions, write_bed
+
+JUNK = ['browser position chr1:1-100', 'track name=junk', '# comment', '',
+        'chr1\t5\t10', 'chr1']
+
+
+def write_messy(path, rows):
+    """Write rows with extra columns, skipped lines between them and no
+    final newline."""
+    lines = []
+    for i, row in enumerate(rows):
+        if i % 50 == 0:
+            lines.append(JUNK[(i // 50) % len(JUNK)])
+        lines.append('{}\t{}\t{}\t{}\t0\t+'.format(*row))
+    with open(str(path), 'w') as fout:
+        fout.write('\n'.join(lines))
+    return str(path)
+
+
+def compress(path, kind):
+    if kind == 'gz':
+        opener = gzip.open
+    elif kind == 'bz2':
+        opener = bz2.open
+    else:
+        return path
+    with open(path, 'rb') as fin, opener(path + '.' + kind, 'wb') as fout:
+        fout.write(fin.read())
+    return path + '.' + kind
+
+
+@pytest.fixture(scope='module')
+def messy_rows():
+    return make_rows(seed=13, per_chrom=3000)
+
+
+@pytest.mark.parametrize('kind', ['plain', 'gz', 'bz2'])
+@pytest.mark.parametrize('workers', [1, 4])
+def test_formats(tmpdir, messy_rows, kind, workers):
+    path = compress(write_messy(tmpdir.join('m.bed'), messy_rows), kind)
+    bed  = BedFile(path, backend='dict', workers=workers)
+    for chrom, pos in query_positions(messy_rows, n=200):
+        assert bed.lookup(chrom, pos) == brute_find(messy_rows, chrom, pos)
+
+
+@pytest.mark.parametrize('workers', [1, 4])
+def test_bgzipped(tmpdir, messy_rows, workers):
+    path = bgzip(write_bed(tmpdir.join('b.bed'), messy_rows, header=False))
+    bed  = BedFile(path, backend='dict', workers=workers)
+    for chrom, pos in query_positions(messy_rows, n=200):
+        assert bed.lookup(chrom, pos) == brute_find(messy_rows, chrom, pos)
+
+
+@pytest.mark.parametrize('backend', ['sqlite', 'mmap'])
+def test_parallel_build(tmpdir, messy_rows, backend):
+    path = write_messy(tmpdir.join('p.bed'), messy_rows)
+    bed  = BedFile(path, backend=backend, workers=4)
+    for chrom, pos in query_positions(messy_rows, n=200):
+        assert bed.lookup(chrom, pos) == brute_find(messy_rows, chrom, pos)
+
+
+def test_parse_chunk():
+    data = (b'track name=x\nbrowser hide all\n# comment\n\nchr1\t5\t10\n'
+            b'chr1\t1\t2\ta\t0\t+\nchr2\t3\t9\tb\nchr1\t4\t8\ta\r\n'
+            b'trackless\t1\t2\tc')
+    names, chroms = _parse_chunk(data)
+    assert names == ['a', 'b', 'c']
+    assert {chrom: [list(i) for i in arrays] for chrom, arrays in
+            chroms.items()} == {'chr1': [[1, 4], [2, 8], [0, 0]],
+                                'chr2': [[3], [9], [1]],
+                                'trackless': [[1], [2], [2]]}
+
+
+def test_lazy_skips_junk(tmpdir, messy_rows):
+    path = write_messy(tmpdir.join('l.bed'), messy_rows)
+    bed  = BedFile(path, lazy=True)
+    assert sorted(bed.chromosomes) == ['chr1', 'chr2', 'chrX']
+    for chrom, pos in query_positions(messy_rows, n=200):
+        assert bed.lookup(chrom, pos) == brute_find(messy_rows, chrom, pos)
@@ -0,0 +1,35 @@
+"""
+Estimating the number of lines in a bed file from a sample of it.
+"""
+import gzip
+
+import pytest
+
+from bed_lookup._bed_lookup import _sample_bed
+
+from conftest import make_rows, write_bed
+
+
+@pytest.mark.parametrize('newline', [True, False])
+def test_whole_file(tmpdir, newline):
+    rows = make_rows(per_chrom=100)
+    path = write_bed(tmpdir.join('genes.bed'), rows, header=False)
+    if not newline:
+        with open(path, 'rb') as fin:
+            data = fin.read()
+        with open(path, 'wb') as fout:
+            fout.write(data.rstrip(b'\n'))
+    assert _sample_bed(path)[0] == len(rows)
+
+
+def test_sample(tmpdir):
+    # Lines of equal length, so only the compression ratio is estimated
+    rows = [('chr1', 100000 + i, 200000 + i, 'g{:06d}'.format(i))
+            for i in range(50000)]
+    path = write_bed(tmpdir.join('genes.bed'), rows, header=False)
+    with open(path, 'rb') as fin, gzip.open(path + '.gz', 'wb') as fout:
+        fout.write(fin.read())
+    for bedfile in (path, path + '.gz'):
+        lines, name_len = _sample_bed(bedfile, sample_bytes=1 << 14)
+        assert abs(lines - len(rows)) < len(rows) * 0.05, bedfile
+        assert name_len == 7
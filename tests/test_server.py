@@ -0,0 +1,110 @@
+"""
+Round trips through the lookup server.
+"""
+import asyncio
+import threading
+
+import numpy as np
+import pytest
+
+from bed_lookup import BedFile
+from bed_lookup.server import LookupClient, ServerError, start_server
+
+from conftest import (brute_find, brute_overlap, query_positions,
+                      query_ranges, write_bed)
+
+
+@pytest.fixture(scope='module', params=['unix', 'tcp'])
+def server(request, tmpdir_factory, rows):
+    """Serve a BedFile from a thread, yield (address, rows)."""
+    directory = tmpdir_factory.mktemp('server')
+    bed       = BedFile(write_bed(directory.join('s.bed'), rows))
+    address   = (str(directory.join('s.sock')) if request.param == 'unix'
+                 else '127.0.0.1:0')
+    loop      = asyncio.new_event_loop()
+    started   = loop.run_until_complete(start_server(bed, address,
+                                                     max_batch=1000))
+    if request.param == 'tcp':
+        address = '127.0.0.1:{}'.format(started.sockets[0].getsockname()[1])
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    yield address, rows
+
+    async def shutdown():
+        started.close()
+        tasks = [i for i in asyncio.all_tasks()
+                 if i is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    asyncio.run_coroutine_threadsafe(shutdown(), loop).result(10)
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+    loop.close()
+
+
+def test_lookup(server):
+    address, rows = server
+    with LookupClient(address, timeout=10) as client:
+        for chrom, pos in query_positions(rows, n=50):
+            assert client.lookup(chrom, pos) == brute_find(rows, chrom, pos)
+
+
+def test_lookup_many(server):
+    address, rows = server
+    queries = query_positions(rows) + [('chrUnknown', 1)]
+    with LookupClient(address, timeout=10) as client:
+        found = client.lookup_many([c for c, _ in queries],
+                                   [p for _, p in queries])
+    assert isinstance(found, np.ndarray)
+    assert list(found) == [brute_find(rows, c, p) for c, p in queries]
+
+
+def test_lookup_many_empty(server):
+    address, _ = server
+    with LookupClient(address, timeout=10) as client:
+        assert len(client.lookup_many([], [])) == 0
+
+
+def test_overlap(server):
+    address, rows = server
+    with LookupClient(address, timeout=10) as client:
+        for chrom, start, end in query_ranges(n=50):
+            assert client.overlap(chrom, start, end) == \
+                brute_overlap(rows, chrom, start, end)
+        assert client.lookup_all('chr1', 255) == \
+            brute_overlap(rows, 'chr1', 255, 256)
+
+
+def test_concurrent_clients(server):
+    """Lookups from many clients at once are batched together."""
+    address, rows = server
+    queries = query_positions(rows)
+    errors  = []
+
+    def run(offset):
+        part = queries[offset::8]
+        try:
+            with LookupClient(address, timeout=10) as client:
+                found = client.lookup_many([c for c, _ in part],
+                                           [p for _, p in part])
+            assert list(found) == [brute_find(rows, c, p) for c, p in part]
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+
+
+def test_errors(server):
+    address, _ = server
+    with LookupClient(address, timeout=10) as client:
+        with pytest.raises(ServerError):
+            client.overlap('chr1', 10, 5)
+        # The connection is still usable after an error
+        assert 'unknown_chromosome' in client.stats()
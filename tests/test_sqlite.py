@@ -0,0 +1,174 @@
+"""
+Building, updating and reopening sqlite databases.
+"""
+import os
+import sqlite3
+
+import pytest
+
+from bed_lookup import BedFile
+
+from conftest import (brute_find, brute_overlap, make_rows, query_positions,
+                      query_ranges, write_bed)
+
+
+def changed(path, rows):
+    """Rewrite a bed file with a later modification time."""
+    mtime = os.stat(path).st_mtime_ns
+    write_bed(path, rows)
+    os.utime(path, ns=(mtime + 10**9, mtime + 10**9))
+
+
+def open_db(path, **kwargs):
+    return BedFile(path, backend='sqlite', profile=True, **kwargs)
+
+
+def inserted(bed):
+    """Rows inserted while opening bed."""
+    return bed.stats()['profile']['counters'].get('rows_inserted', 0)
+
+
+def check(bed, rows):
+    for chrom, pos in query_positions(rows, n=150):
+        assert bed.lookup(chrom, pos) == brute_find(rows, chrom, pos)
+    for chrom, start, end in query_ranges(n=50):
+        assert bed.overlap(chrom, start, end) == brute_overlap(rows, chrom,
+                                                               start, end)
+
+
+@pytest.fixture
+def bed_rows(tmpdir):
+    rows = make_rows(seed=11, per_chrom=150)
+    path = write_bed(tmpdir.join('db.bed'), rows)
+    assert inserted(open_db(path)) == len(rows)
+    return path, rows
+
+
+def test_reopen_unchanged(bed_rows):
+    path, rows = bed_rows
+    bed = open_db(path)
+    assert inserted(bed) == 0
+    check(bed, rows)
+
+
+def test_open_by_database_name(bed_rows):
+    path, rows = bed_rows
+    check(open_db(path + '.db'), rows)
+
+
+def test_bins(tmpdir):
+    """Intervals in every level of the bin tree, and past its end."""
+    rows = [('chr1', 10, 20, 'a'), ('chr1', 16000, 17000, 'b'),
+            ('chr1', 100, 1 << 20, 'c'),
+            ('chr1', 1 << 26, (1 << 26) + 1, 'd'),
+            ('chr1', 5, 1 << 28, 'e'),
+            ('chr1', (1 << 29) - 5, (1 << 29) + 5, 'f'),
+            ('chr1', 1 << 30, (1 << 30) + 100, 'g'),
+            ('chr1', 1 << 29, 1 << 31, 'h')]
+    path = write_bed(tmpdir.join('bins.bed'), rows)
+    bed  = BedFile(path, backend='sqlite')
+    for _, start, end, _ in rows:
+        for pos in (start - 1, start, end - 1, end):
+            assert bed.lookup('chr1', pos) == brute_find(rows, 'chr1', pos)
+            assert bed.overlap('chr1', pos, pos + 10) == \
+                brute_overlap(rows, 'chr1', pos, pos + 10)
+    assert list(bed.lookup_many(['chr1']*3, [15, 1 << 29, 1 << 30])) == \
+        ['a', 'f', 'g']
+
+
+def test_touched(bed_rows):
+    path, rows = bed_rows
+    changed(path, rows)
+    assert inserted(open_db(path)) == 0
+    conn = sqlite3.connect(path + '.db')
+    assert dict(conn.execute('SELECT key, value FROM _bed_lookup_meta')
+                )['source_mtime'] == str(os.stat(path).st_mtime_ns)
+
+
+def test_append(bed_rows):
+    path, rows = bed_rows
+    new  = [('chr2', 50, 5000, 'new1'), ('chr9', 10, 20, 'new2'),
+            ('chr1', 100, 1000, 'new3')]
+    changed(path, rows + new)
+    bed = open_db(path)
+    assert inserted(bed) == len(new)
+    assert 'chr9' in bed.chromosomes
+    check(bed, rows + new)
+
+
+def test_modify(bed_rows):
+    path, rows = bed_rows
+    edited = [(c, s + 7, e + 7, n) if c == 'chr2' else (c, s, e, n)
+              for c, s, e, n in rows]
+    changed(path, edited)
+    bed = open_db(path)
+    assert inserted(bed) == len([r for r in rows if r[0] == 'chr2'])
+    check(bed, edited)
+
+
+def test_remove(bed_rows):
+    path, rows = bed_rows
+    kept = [r for r in rows if r[0] != 'chrX']
+    changed(path, kept[:-1])
+    bed = open_db(path)
+    assert 'chrX' not in bed.chromosomes
+    assert inserted(bed) == len([r for r in kept if r[0] == kept[-1][0]]) - 1
+    check(bed, kept[:-1])
+
+
+def test_update_disabled(bed_rows):
+    path, rows = bed_rows
+    changed(path, [r for r in rows if r[0] != 'chr1'])
+    bed = open_db(path, update=False)
+    assert inserted(bed) == 0
+    check(bed, rows)
+
+
+def test_wal_kept(bed_rows):
+    path, rows = bed_rows
+    conn = sqlite3.connect(path + '.db')
+    assert conn.execute('PRAGMA journal_mode=WAL').fetchone()[0] == 'wal'
+    conn.close()
+    changed(path, rows + [('chr1', 1, 2, 'new')])
+    bed = open_db(path)
+    assert inserted(bed) == 1
+    del bed
+    conn = sqlite3.connect(path + '.db')
+    assert conn.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+
+
+def test_locked_database(bed_rows):
+    path, rows = bed_rows
+    lock = sqlite3.connect(path + '.db', isolation_level=None)
+    lock.execute('BEGIN IMMEDIATE')
+    try:
+        changed(path, rows + [('chr1', 1, 2, 'new')])
+        bed = open_db(path)
+        assert inserted(bed) == 0
+        check(bed, rows)
+    finally:
+        lock.execute('ROLLBACK')
+    check(open_db(path), rows + [('chr1', 1, 2, 'new')])
+
+
+def test_legacy_schema(tmpdir):
+    rows = [('chr1', 10, 20, 'a'), ('chr1', 15, 30, 'b'), ('c"x', 1, 5, 'q')]
+    path = str(tmpdir.join('legacy.db'))
+    conn = sqlite3.connect(path)
+    for chrom in ('chr1', 'c"x'):
+        table = '"{}"'.format(chrom.replace('"', '""'))
+        conn.execute('CREATE TABLE {} (name text, start int, end int)'
+                     .format(table))
+        conn.executemany('INSERT INTO {} VALUES (?, ?, ?)'.format(table),
+                         [(n, s, e) for c, s, e, n in rows if c == chrom])
+        conn.execute('CREATE INDEX "{}" ON {} (start, end)'.format(
+            (chrom + '_start_end').replace('"', '""'), table))
+    conn.commit()
+    conn.close()
+    bed = BedFile(path, backend='sqlite')
+    assert bed._schema == 1
+    assert [bed.lookup('chr1', 16), bed.lookup('chr1', 40),
+            bed.lookup('c"x', 2)] == ['a', None, 'q']
+    bed = BedFile(path, backend='sqlite', migrate=True)
+    assert bed._schema == 2
+    assert bed.overlap('chr1', 0, 100) == ['a', 'b']
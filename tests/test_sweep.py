@@ -0,0 +1,27 @@
+"""
+The merge sweep over sorted inputs.
+"""
+import pytest
+
+from bed_lookup.sweep import UnsortedError, sweep
+
+from conftest import brute_find, query_positions, write_bed
+
+
+def test_sweep(tmpdir, rows):
+    path    = write_bed(tmpdir.join('sorted.bed'), rows)
+    queries = sorted(query_positions(rows))
+    assert list(sweep(path, queries)) == [
+        (chrom, pos, brute_find(rows, chrom, pos)) for chrom, pos in queries]
+
+
+def test_unsorted_queries(tmpdir, rows):
+    path = write_bed(tmpdir.join('sorted.bed'), rows)
+    with pytest.raises(UnsortedError):
+        list(sweep(path, [('chr1', 500), ('chr1', 100)]))
+
+
+def test_unsorted_bed(tmpdir, shuffled_rows):
+    path = write_bed(tmpdir.join('shuffled.bed'), shuffled_rows)
+    with pytest.raises(UnsortedError):
+        list(sweep(path, [('chrX', 30000)]))
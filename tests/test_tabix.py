@@ -0,0 +1,128 @@
+"""
+The tabix and CSI reader against pysam built indexes.
+"""
+import gzip
+import pickle
+import random
+
+import pytest
+
+from bed_lookup import tabix
+
+from conftest import brute_overlap, make_rows, query_ranges, write_bed
+
+pysam = pytest.importorskip('pysam')
+
+
+def pysam_fetch(path, chrom, start, end):
+    """(start, end, name) of every record pysam finds in [start, end)."""
+    with pysam.TabixFile(path, index=tabix.find_index(path)) as tbx:
+        if chrom not in tbx.contigs:
+            return []
+        return [(int(f[1]), int(f[2]), f[3]) for f in
+                (line.split('\t') for line in tbx.fetch(chrom, start, end))]
+
+
+@pytest.fixture(scope='module', params=['tbi', 'csi'])
+def indexed(request, tmpdir_factory):
+    """A bed file of several BGZF blocks and its pysam built index.
+
+    Zero-length intervals are left out, htslib indexes them as if they were
+    one base long.
+    """
+    rows = [r for r in make_rows(seed=7, per_chrom=3000) if r[1] < r[2]]
+    path = write_bed(tmpdir_factory.mktemp(request.param).join('t.bed'),
+                     rows, header=False)
+    gz   = pysam.tabix_index(path, preset='bed', force=True,
+                             keep_original=True,
+                             csi=request.param == 'csi')
+    assert tabix.find_index(gz) == gz + '.' + request.param
+    return gz, rows
+
+
+def test_chromosomes(indexed):
+    gz, _ = indexed
+    with pysam.TabixFile(gz, index=tabix.find_index(gz)) as tbx:
+        assert tabix.TabixFile(gz).chromosomes == list(tbx.contigs)
+
+
+def test_fetch_matches_pysam(indexed):
+    gz, rows = indexed
+    reader   = tabix.TabixFile(gz)
+    for chrom, start, end in query_ranges(n=300) + [('chr1', 0, 10**7)]:
+        found = list(reader.fetch(chrom, start, end))
+        assert found == pysam_fetch(gz, chrom, start, end)
+        assert [i[2] for i in found] == brute_overlap(rows, chrom, start,
+                                                      end)
+
+
+def test_fetch_points(indexed):
+    gz, rows = indexed
+    reader   = tabix.TabixFile(gz)
+    rng      = random.Random(8)
+    for _ in range(300):
+        chrom = rng.choice(['chr1', 'chr2', 'chrX'])
+        pos   = rng.randrange(25000)
+        assert list(reader.fetch(chrom, pos, pos + 1)) == \
+            pysam_fetch(gz, chrom, pos, pos + 1)
+
+
+def test_unknown_chromosome(indexed):
+    gz, _ = indexed
+    assert list(tabix.TabixFile(gz).fetch('chrUnknown', 0, 100)) == []
+
+
+def test_large_coordinates_csi(tmpdir):
+    base = 1 << 31
+    rows = [('chr1', base + i*1000, base + i*1000 + 1500, 'g{}'.format(i))
+            for i in range(2000)]
+    path = write_bed(tmpdir.join('large.bed'), rows, header=False)
+    gz   = pysam.tabix_index(path, preset='bed', force=True,
+                             keep_original=True, csi=True)
+    reader = tabix.TabixFile(gz)
+    hits   = 0
+    for start in (base - 10, base + 999, base + 1000000, base + 1999000):
+        found = list(reader.fetch('chr1', start, start + 10))
+        assert found == pysam_fetch(gz, 'chr1', start, start + 10)
+        hits += len(found)
+    assert hits == 6
+
+
+def test_bgzf_lines(indexed):
+    gz, _ = indexed
+    reader = tabix.BgzfReader(gz, cache_blocks=2)
+    lines  = [line for _, line in reader.lines(0)]
+    with gzip.open(gz, 'rb') as fin:
+        assert lines == fin.read().splitlines()
+    # Every line can be read again from the virtual offset it was found at
+    offsets = [(voffset, line) for voffset, line in reader.lines(0)]
+    for voffset, line in offsets[::97]:
+        assert next(reader.lines(voffset))[1] == line
+    assert reader.misses > 2
+
+
+def test_block_cache(indexed):
+    gz, _ = indexed
+    reader = tabix.BgzfReader(gz)
+    reader.block(0)
+    reader.block(0)
+    assert (reader.hits, reader.misses) == (1, 1)
+
+
+def test_pickle(indexed):
+    gz, _ = indexed
+    reader = tabix.TabixFile(gz, cache_blocks=3)
+    copy   = pickle.loads(pickle.dumps(reader))
+    assert copy.reader.cache_blocks == 3
+    assert list(copy.fetch('chr2', 0, 5000)) == \
+        list(reader.fetch('chr2', 0, 5000))
+
+
+def test_not_bgzipped(tmpdir):
+    path = str(tmpdir.join('plain.bed.gz'))
+    with gzip.open(path, 'wb') as fout:
+        fout.write(b'chr1\t1\t2\ta\n')
+    with pytest.raises(ValueError):
+        tabix.BgzfReader(path).block(0)
+    with pytest.raises(ValueError):
+        tabix.TabixFile(path)